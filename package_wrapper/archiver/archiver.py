@@ -1,6 +1,81 @@
+import bz2
+import collections
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import platform
+import shutil
+import struct
+import sys
 import tarfile
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+from package_wrapper.scanner.scanner import ScanEntry, ScannerE, scan_directory
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+ARCHIVE_TYPES = ["tar", "tar.gz", "tar.bz2", "tar.xz", "tar.zst", "zip"]
+TAR_TYPES = [_type for _type in ARCHIVE_TYPES if _type.startswith("tar")]
+# valid compression levels for each archive type, tar is not compressed
+COMPRESSION_LEVELS = {
+    "tar.gz": (0, 9),
+    "tar.bz2": (1, 9),
+    "tar.xz": (0, 9),
+    "tar.zst": (1, 22),
+    "zip": (0, 9),
+}
+# file types that are already compressed, zip stores them instead of deflating them again
+STORED_SUFFIXES = {
+    ".7z",
+    ".apk",
+    ".bz2",
+    ".gif",
+    ".gz",
+    ".jar",
+    ".jpeg",
+    ".jpg",
+    ".lz4",
+    ".lzma",
+    ".mp3",
+    ".mp4",
+    ".png",
+    ".rar",
+    ".tgz",
+    ".webp",
+    ".whl",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+# gzip extra field id of the trailer of seekable tar.gz archives
+SEEKABLE_EXTRA_ID = b"PW"
+_SEEKABLE_TRAILER_SIZE = 34
+# readers of compressed tar balls that continue past the end of the first member
+_STREAM_OPENERS = {"tar.gz": gzip.open, "tar.bz2": bz2.open, "tar.xz": lzma.open}
+# size of the fixed part of a zip local file header
+_ZIP_LOCAL_HEADER_SIZE = 30
+# zip members compressed on the worker pool, or copied from an identical member,
+# are written through private ZipFile internals that are only tested with the
+# CPython releases in this range
+ZIP_INTERNALS_PYTHON = ((3, 7), (3, 13))
+# zip members up to this size are deflated in memory on the worker pool
+PARALLEL_MEMBER_LIMIT = 64 * 1024 * 1024
+# size of the independently compressed blocks when compressing with several threads
+PARALLEL_BLOCK_SIZE = {
+    "tar.gz": 1024 * 1024,
+    "tar.bz2": 8 * 1024 * 1024,
+    "tar.xz": 24 * 1024 * 1024,
+}
 
 
 class ArchiveE(Exception):
@@ -9,30 +84,792 @@ class ArchiveE(Exception):
         self.msg = msg
 
 
+def zip_internals_supported() -> bool:
+    """
+    :return: True if zip members compressed outside of ZipFile can be written
+        on this interpreter, see ZIP_INTERNALS_PYTHON
+    """
+    _first, _last = ZIP_INTERNALS_PYTHON
+    return (
+        platform.python_implementation() == "CPython"
+        and _first <= sys.version_info[:2] <= _last
+        and hasattr(zipfile.ZipFile, "_writecheck")
+        and hasattr(zipfile.ZipInfo, "FileHeader")
+    )
+
+
+def is_stream(output) -> bool:
+    """
+    :return: True if an archive is written to a file object (stdout, a pipe or a
+        socket) instead of a file name
+    """
+    return hasattr(output, "write")
+
+
+class _ArchiveOutput:
+    """
+    Binary file object an archive is written to, either the archive file or the
+    file object of the caller. Once aborted every write is dropped, so closing
+    the archive after an error releases its compressors without finishing it
+    with end of archive blocks, a central directory or a compressor trailer.
+    """
+
+    def __init__(self, archive):
+        """
+        :param archive: path of the archive file, or a writable file object that
+            is flushed instead of closed and never seeked
+        """
+        self.stream = is_stream(archive)
+        self.path = None if self.stream else Path(archive)
+        # zip reads back the compressed data of duplicated members
+        self.raw = archive if self.stream else open(archive, "w+b")
+        self.aborted = False
+
+    def __getattr__(self, name):
+        # tell, seek and read of the archive file, name and mode for tarfile
+        return getattr(self.raw, name)
+
+    def write(self, data) -> int:
+        if not self.aborted:
+            self.raw.write(data)
+        return len(data)
+
+    def flush(self):
+        if not self.aborted:
+            self.raw.flush()
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        """
+        release the output, an aborted archive file is removed
+        """
+        if self.stream:
+            self.flush()
+            return
+        self.raw.close()
+        if self.aborted:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class _ParallelBlockWriter:
+    """
+    Write only file object compressing its input in fixed size blocks on a
+    thread pool. Every block becomes a complete gzip member / bz2 or xz stream
+    and the blocks are written in order, so the output is a plain multi-member
+    file that the standard tools (gunzip, bunzip2, unxz) decompress as one.
+    """
+
+    def __init__(
+        self, file_name: Path, compress_block, threads: int, block_size: int
+    ):
+        """
+        :param file_name: output file, or a file object that is flushed instead of
+            closed and never seeked
+        """
+        self.close_raw = not is_stream(file_name)
+        self.raw = open(file_name, "wb") if self.close_raw else file_name
+        self.raw_position = 0
+        self.compress_block = compress_block
+        self.block_size = block_size
+        self.threads = threads
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.submitted = 0
+        self.position = 0
+        # offset in the output of every block written so far
+        self.offsets = []
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[: self.block_size]))
+            del self.buffer[: self.block_size]
+        return len(data)
+
+    def tell(self) -> int:
+        """
+        :return: number of uncompressed bytes written
+        """
+        return self.position
+
+    def flush_block(self) -> int:
+        """
+        end the current block early, the next write starts a new block
+        :return: number of the block the next write goes to
+        """
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        return self.submitted
+
+    def block_offset(self, block: int) -> int:
+        """
+        :return: offset of a submitted block in the output, waits until it is written
+        """
+        while len(self.offsets) <= block:
+            self._write_next()
+        return self.offsets[block]
+
+    def _submit(self, block: bytes):
+        self.pending.append(self.pool.submit(self.compress_block, block))
+        self.submitted += 1
+        # bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self._write_next()
+
+    def _write_next(self):
+        self.offsets.append(self.raw_position)
+        _block = self.pending.popleft().result()
+        self.raw.write(_block)
+        self.raw_position += len(_block)
+
+    def close(self):
+        try:
+            # an empty archive still needs one (empty) block to be valid
+            if self.buffer or not self.submitted:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._write_next()
+        finally:
+            self.pool.shutdown()
+            if self.close_raw:
+                self.raw.close()
+            else:
+                self.raw.flush()
+
+
+def _remaining_size(file_pointer) -> int:
+    """
+    :return: number of bytes from the position of a seekable file object to its
+        end, the position is kept
+    """
+    _position = file_pointer.tell()
+    _size = file_pointer.seek(0, os.SEEK_END) - _position
+    file_pointer.seek(_position)
+    return _size
+
+
+def _block_compressor(archive_type: str, level: int):
+    if archive_type == "tar.gz":
+        return lambda block: gzip.compress(block, compresslevel=level)
+    elif archive_type == "tar.bz2":
+        return lambda block: bz2.compress(block, compresslevel=level)
+    elif archive_type == "tar.xz":
+        return lambda block: lzma.compress(block, preset=level)
+    raise ArchiveE("%s can not be compressed in parallel blocks" % archive_type)
+
+
+def _stream_compressor(archive_type: str, output, level: int):
+    """
+    :return: write only file object compressing into output, closing it leaves
+        output open
+    """
+    if archive_type == "tar.gz":
+        return gzip.GzipFile(
+            fileobj=output, mode="wb", compresslevel=9 if level is None else level
+        )
+    elif archive_type == "tar.bz2":
+        return bz2.BZ2File(output, "wb", compresslevel=9 if level is None else level)
+    elif archive_type == "tar.xz":
+        return lzma.LZMAFile(output, "wb", preset=level)
+    raise ArchiveE("%s can not be streamed" % archive_type)
+
+
+class _TarWriter:
+    """
+    Adds members to a tar archive, optionally reading file contents from an
+    already opened file object instead of the file system
+    """
+
+    def __init__(self, output: _ArchiveOutput, mode: str, compressor=None, **kwargs):
+        """
+        :param output: where the archive goes, closed with the writer
+        :param mode: tarfile mode of the archive, a stream mode for the file
+            object of a caller
+        :param compressor: write only file object taking the uncompressed tar
+            stream and compressing it into output, when given the archive is
+            written to it in stream mode
+        """
+        self.compressor = compressor
+        self.output = output
+        # symbolic links to files are archived as the file they point to, the
+        # scanner follows them and the manifest records the hash of the target
+        if compressor is not None:
+            self.tar_ref = tarfile.open(mode="w|", fileobj=compressor, dereference=True)
+        else:
+            self.tar_ref = tarfile.open(
+                mode=mode, fileobj=output, dereference=True, **kwargs
+            )
+
+    def add_file(self, abs_path: Path, arcname: str, file_pointer=None):
+        if file_pointer is None:
+            self.tar_ref.add(abs_path, arcname=arcname, recursive=False)
+            return
+        tarinfo = self.tar_ref.gettarinfo(name=abs_path, arcname=arcname)
+        self.tar_ref.addfile(tarinfo, file_pointer)
+
+    def add_link(self, abs_path: Path, arcname: str, target: str):
+        """
+        add a file identical to the already archived member target as a hard
+        link to it, the contents are not stored again
+        """
+        tarinfo = self.tar_ref.gettarinfo(name=abs_path, arcname=arcname)
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = target
+        tarinfo.size = 0
+        self.tar_ref.addfile(tarinfo)
+
+    def add_bytes(self, arcname: str, data: bytes):
+        self.add_stream(arcname, io.BytesIO(data))
+
+    def add_stream(self, arcname: str, file_pointer):
+        """
+        add a member with the contents of a seekable file object, read from its
+        current position to its end
+        """
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = _remaining_size(file_pointer)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        self.tar_ref.addfile(tarinfo, file_pointer)
+
+    def close(self):
+        try:
+            self.tar_ref.close()
+            if self.compressor is not None:
+                self.compressor.close()
+        finally:
+            self.output.close()
+
+    def abort(self):
+        """
+        release the archive after an error without finishing it, a partial
+        archive file is removed
+        """
+        self.output.abort()
+        # the error that aborted the archive is the one reported
+        with contextlib.suppress(Exception):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _seekable_trailer(manifest_offset: int) -> bytes:
+    """
+    empty gzip member whose extra field records where the manifest starts
+    """
+    _extra = SEEKABLE_EXTRA_ID + struct.pack("<HQ", 8, manifest_offset)
+    return (
+        struct.pack("<BBBBIBB", 0x1F, 0x8B, 8, 4, 0, 0, 255)
+        + struct.pack("<H", len(_extra))
+        + _extra
+        + b"\x03\x00"
+        + struct.pack("<II", 0, 0)
+    )
+
+
+class _SeekableTarWriter(_TarWriter):
+    """
+    Writes a tar.gz in which every member starts a new gzip member, so each
+    member can be decompressed on its own. The compressed offset of every
+    member is kept in index, and the archive ends with a gzip trailer pointing
+    to the last member added from memory (the manifest).
+    """
+
+    def __init__(self, output: _ArchiveOutput, compressor: _ParallelBlockWriter):
+        self.compressor = compressor
+        self.output = output
+        # not a stream, tarfile writes straight through to the compressor
+        self.tar_ref = tarfile.open(mode="w", fileobj=compressor, dereference=True)
+        self.blocks = {}
+        self.last_bytes_block = None
+
+    def add_file(self, abs_path: Path, arcname: str, file_pointer=None):
+        self.blocks[arcname] = self.compressor.flush_block()
+        super().add_file(abs_path, arcname, file_pointer=file_pointer)
+
+    def add_link(self, abs_path: Path, arcname: str, target: str):
+        # decompressing the target member gives the contents of the link
+        self.blocks[arcname] = self.blocks[target]
+        super().add_link(abs_path, arcname, target)
+
+    def add_stream(self, arcname: str, file_pointer):
+        self.last_bytes_block = self.compressor.flush_block()
+        super().add_stream(arcname, file_pointer)
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """
+        :return: member name to the offset of the gzip member it starts in
+        """
+        self.compressor.flush_block()
+        return {
+            _name: self.compressor.block_offset(_block)
+            for _name, _block in self.blocks.items()
+        }
+
+    def close(self):
+        try:
+            self.tar_ref.close()
+            _blocks = self.compressor.flush_block()
+            if self.last_bytes_block is not None:
+                _offset = self.compressor.block_offset(self.last_bytes_block)
+                # the trailer goes after every block
+                self.compressor.block_offset(_blocks - 1)
+                self.compressor.raw.write(_seekable_trailer(_offset))
+        finally:
+            try:
+                self.compressor.close()
+            finally:
+                self.output.close()
+
+
+def _deflate_member(data: bytes, level: int):
+    """
+    compress one zip member into a raw deflate stream
+    :return: compressed data, CRC32 and size of the uncompressed data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+
+def _read_and_deflate(abs_path: Path, level: int):
+    return _deflate_member(Path(abs_path).read_bytes(), level)
+
+
+class _ZipWriter:
+    """
+    Adds members to a zip archive, optionally reading file contents from an
+    already opened file object instead of the file system.
+    With more than one thread, members are deflated independently on a thread
+    pool and written to the archive in the order they were added.
+    """
+
+    def __init__(
+        self,
+        output: _ArchiveOutput,
+        compression: int = zipfile.ZIP_DEFLATED,
+        compresslevel: int = None,
+        threads: int = 1,
+    ):
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.output = output
+        self.zip_ref = zipfile.ZipFile(
+            output, mode="w", compression=compression, compresslevel=compresslevel
+        )
+        self.threads = threads
+        self.pending = collections.deque()
+        self.pool = None
+        if threads > 1 and compression == zipfile.ZIP_DEFLATED:
+            self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def _zip_info(self, abs_path: Path, arcname: str) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo.from_file(abs_path, arcname=arcname)
+        if Path(arcname).suffix.lower() in STORED_SUFFIXES:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = self.compression
+        self._set_level(zinfo)
+        return zinfo
+
+    def _set_level(self, zinfo: zipfile.ZipInfo):
+        # ZipFile.open() does not apply the archive compresslevel to a given ZipInfo
+        if hasattr(zipfile.ZipInfo, "compress_level"):
+            zinfo.compress_level = self.compresslevel
+        else:
+            zinfo._compresslevel = self.compresslevel
+
+    def add_file(self, abs_path: Path, arcname: str, file_pointer=None):
+        zinfo = self._zip_info(abs_path, arcname)
+        if (
+            self.pool is not None
+            and zinfo.compress_type == zipfile.ZIP_DEFLATED
+            and zinfo.file_size <= PARALLEL_MEMBER_LIMIT
+        ):
+            _level = (
+                zlib.Z_DEFAULT_COMPRESSION
+                if self.compresslevel is None
+                else self.compresslevel
+            )
+            if file_pointer is None:
+                future = self.pool.submit(_read_and_deflate, abs_path, _level)
+            else:
+                future = self.pool.submit(_deflate_member, file_pointer.read(), _level)
+            self.pending.append((zinfo, future))
+            # bound the memory held by members waiting to be written
+            while len(self.pending) > 2 * self.threads:
+                self._write_pending()
+            return
+
+        # members written directly must come after the ones still being compressed
+        self._drain()
+        if file_pointer is None:
+            with open(abs_path, "rb") as source:
+                self._copy(zinfo, source)
+        else:
+            self._copy(zinfo, file_pointer)
+
+    def _copy(self, zinfo: zipfile.ZipInfo, file_pointer):
+        with self.zip_ref.open(zinfo, "w") as destination:
+            shutil.copyfileobj(file_pointer, destination)
+
+    def _write_pending(self):
+        zinfo, future = self.pending.popleft()
+        data, zinfo.CRC, zinfo.file_size = future.result()
+        zinfo.compress_size = len(data)
+        with self.zip_ref._lock:
+            self._write_compressed(zinfo, lambda fp: fp.write(data))
+
+    def _write_compressed(self, zinfo: zipfile.ZipInfo, write_data):
+        # the member is already compressed, write its local header and data the
+        # same way ZipFile.open(..., "w") does once it has compressed a member
+        zip_ref = self.zip_ref
+        zip_ref._writecheck(zinfo)
+        zip_ref._didModify = True
+        zinfo.header_offset = zip_ref.fp.tell()
+        zip_ref.fp.write(zinfo.FileHeader(None))
+        write_data(zip_ref.fp)
+        zip_ref.filelist.append(zinfo)
+        zip_ref.NameToInfo[zinfo.filename] = zinfo
+        zip_ref.start_dir = zip_ref.fp.tell()
+
+    def add_link(self, abs_path: Path, arcname: str, target: str):
+        """
+        add a file identical to the already archived member target. Zip has no
+        links, the compressed data of target is copied instead of compressing
+        the file again.
+        """
+        if not zip_internals_supported():
+            # copying needs the ZipFile internals, compressing the file again
+            # writes the same member
+            self.add_file(abs_path, arcname)
+            return
+        if target not in self.zip_ref.NameToInfo:
+            # the target may still be compressed on the pool
+            self._drain()
+        source = self.zip_ref.NameToInfo[target]
+        zinfo = self._zip_info(abs_path, arcname)
+        zinfo.compress_type = source.compress_type
+        zinfo.CRC = source.CRC
+        zinfo.file_size = source.file_size
+        zinfo.compress_size = source.compress_size
+
+        def _copy_data(fp):
+            _write_offset = fp.tell()
+            fp.seek(source.header_offset)
+            _header = fp.read(_ZIP_LOCAL_HEADER_SIZE)
+            _name_length, _extra_length = struct.unpack("<HH", _header[26:30])
+            _read_offset = fp.tell() + _name_length + _extra_length
+            _remaining = source.compress_size
+            while _remaining:
+                fp.seek(_read_offset)
+                _data = fp.read(min(_remaining, 1024 * 1024))
+                _read_offset += len(_data)
+                _remaining -= len(_data)
+                fp.seek(_write_offset)
+                fp.write(_data)
+                _write_offset += len(_data)
+
+        self._drain()
+        with self.zip_ref._lock:
+            self._write_compressed(zinfo, _copy_data)
+
+    def _drain(self):
+        while self.pending:
+            self._write_pending()
+
+    def add_bytes(self, arcname: str, data: bytes):
+        self.add_stream(arcname, io.BytesIO(data))
+
+    def add_stream(self, arcname: str, file_pointer):
+        """
+        add a member with the contents of a seekable file object, read from its
+        current position to its end, with the attributes ZipFile.writestr() gives
+        """
+        self._drain()
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = self.compression
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = _remaining_size(file_pointer)
+        self._set_level(zinfo)
+        self._copy(zinfo, file_pointer)
+
+    def close(self):
+        try:
+            self._drain()
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            try:
+                self.zip_ref.close()
+            finally:
+                self.output.close()
+
+    def abort(self):
+        """
+        release the archive after an error without writing its central
+        directory, a partial archive file is removed
+        """
+        self.output.abort()
+        # the error that aborted the archive is the one reported
+        with contextlib.suppress(Exception):
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _hash_lookup(
+    hashes: Union[Mapping[str, str], Iterable[Tuple[str, str]], None]
+) -> Callable[[str], Optional[str]]:
+    """
+    :param hashes: see Archive.compress()
+    :return: function giving the hash of a relative path, None when not listed.
+        Paths looked up in pairs must come in the order of the pairs.
+    """
+    if hashes is None:
+        return lambda _path: None
+    if isinstance(hashes, Mapping):
+        return hashes.get
+    _pairs = iter(hashes)
+
+    def _lookup(path: str) -> Optional[str]:
+        # pairs of files that are not archived (unchanged ones of a delta) are skipped
+        for _path, _hash in _pairs:
+            if _path == path:
+                return _hash
+        return None
+
+    return _lookup
+
+
+def archive_type_from_file_name(file_name: Path) -> str:
+    # longest suffixes first, "x.tar.gz" must not be taken for "tar"
+    for _type in sorted(ARCHIVE_TYPES, key=len, reverse=True):
+        if str(file_name).endswith("." + _type):
+            return _type
+    raise ArchiveE("could not determine the archive type of %s" % file_name)
+
+
+def member_path(out_dir: Path, name: str) -> Path:
+    """
+    :return: where an archive member is written below out_dir, refuses absolute
+        names and names escaping out_dir
+    """
+    _name = os.path.normpath(name)
+    if os.path.isabs(_name) or _name.split(os.sep)[0] == os.pardir:
+        raise ArchiveE("refusing to write %s outside of %s" % (name, out_dir))
+    return out_dir.joinpath(_name)
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ArchiveE("tar.zst archives require the 'zstandard' package")
+
+
 class Archive:
-    def __init__(self, file_name: Path, archive_type: str):
+    def __init__(
+        self,
+        file_name: Path,
+        archive_type: str,
+        compression_level: int = None,
+        threads: int = 1,
+        seekable: bool = False,
+    ):
+        """
+        :param file_name: path to the archive, or a writable binary file object a
+            tar archive is streamed to by writer()
+        :param archive_type: one of ARCHIVE_TYPES
+        :param compression_level: level passed to the compressor, None uses its default
+        :param threads: number of compression threads, 0 means one per core
+        :param seekable: write a tar.gz in which every member can be decompressed
+            on its own, see open_member_at()
+        """
         self.archive = file_name
         self.archive_type = archive_type
+        self.compression_level = compression_level
+        self.threads = threads or os.cpu_count() or 1
+        self.seekable = seekable
+
+        if seekable and archive_type != "tar.gz":
+            raise ArchiveE("only tar.gz archives can be written seekable")
+        if is_stream(file_name) and archive_type not in TAR_TYPES:
+            raise ArchiveE("only tar archives can be streamed")
+        if archive_type == "zip" and self.threads > 1 and not zip_internals_supported():
+            raise ArchiveE(
+                "zip archives are only compressed with several threads on CPython "
+                "%d.%d to %d.%d, use one compression thread"
+                % (ZIP_INTERNALS_PYTHON[0] + ZIP_INTERNALS_PYTHON[1])
+            )
+
+        if compression_level is not None and archive_type not in COMPRESSION_LEVELS:
+            raise ArchiveE(
+                "%s archives are not compressed, they take no compression level"
+                % archive_type
+            )
+        if compression_level is not None:
+            _min, _max = COMPRESSION_LEVELS[archive_type]
+            if not _min <= compression_level <= _max:
+                raise ArchiveE(
+                    "compression level for %s must be between %s and %s"
+                    % (archive_type, _min, _max)
+                )
 
     @staticmethod
     def _validate(file_path: Path):
         if not file_path.exists():
             raise ArchiveE("file: %s not found" % file_path)
-        if file_path.name.endswith("tar.gz") or file_path.name.endswith("tar"):
+        if file_path.name.endswith("tar.zst"):
+            # zstd compressed tar balls are only recognized while reading them
+            pass
+        elif any(file_path.name.endswith(_type) for _type in TAR_TYPES):
             if not tarfile.is_tarfile(file_path):
                 raise ArchiveE("file %s is not a TAR ball" % file_path)
         elif file_path.name.endswith("zip"):
             if not zipfile.is_zipfile(file_path):
                 raise ArchiveE("file %s is not a zip file" % file_path)
 
+    @contextlib.contextmanager
+    def _open_tar_stream(self):
+        """
+        open the tar ball for a single sequential read, members can only be
+        accessed in archive order
+        """
+        if self.archive_type == "tar.zst":
+            _require_zstandard()
+            with open(self.archive, "rb") as file_pointer:
+                reader = zstandard.ZstdDecompressor().stream_reader(file_pointer)
+                with tarfile.open(fileobj=reader, mode="r|") as tar_ref:
+                    yield tar_ref
+        elif self.archive_type in _STREAM_OPENERS:
+            # tarfile stream modes only decode the first gzip member / bz2 or xz
+            # stream, the parallel block writer produces several. Read in order,
+            # the decompressing reader is only ever seeked forward, and its reads
+            # skip the buffering layer of the stream modes.
+            with _STREAM_OPENERS[self.archive_type](self.archive, "rb") as reader:
+                with tarfile.open(fileobj=reader, mode="r:") as tar_ref:
+                    yield tar_ref
+        else:
+            with tarfile.open(self.archive, "r:") as tar_ref:
+                yield tar_ref
+
+    def iter_members(self):
+        """
+        Stream the regular file members of the archive in archive order without
+        extracting them to disk.
+        Yields (member name, binary file object), a file object is only valid
+        until the next member is requested.
+        """
+        with contextlib.closing(self.iter_entries()) as entries:
+            for _name, file_pointer, _link in entries:
+                if _link is None:
+                    yield _name, file_pointer
+
+    def iter_entries(self):
+        """
+        Like iter_members(), but also yields the hard links written for
+        duplicated files.
+        Yields (member name, binary file object, None) for regular files and
+        (member name, None, name of the linked member) for hard links, the
+        linked member always comes earlier in the archive.
+        """
+        Archive._validate(self.archive)
+
+        if self.archive_type in TAR_TYPES:
+            with self._open_tar_stream() as tar_ref:
+                for member in tar_ref:
+                    if member.isfile():
+                        yield member.name, tar_ref.extractfile(member), None
+                    elif member.islnk():
+                        yield member.name, None, member.linkname
+        elif self.archive_type == "zip":
+            with zipfile.ZipFile(self.archive, "r") as zip_ref:
+                for info in zip_ref.infolist():
+                    if not info.is_dir():
+                        with zip_ref.open(info) as file_pointer:
+                            yield info.filename, file_pointer, None
+        else:
+            raise ArchiveE("unsupported file format")
+
+    def seekable_manifest_offset(self):
+        """
+        :return: offset of the gzip member holding the manifest of a seekable
+            tar.gz, None if the archive was not written seekable
+        """
+        Archive._validate(self.archive)
+        if self.archive_type != "tar.gz":
+            return None
+        with open(self.archive, "rb") as file_pointer:
+            file_pointer.seek(0, os.SEEK_END)
+            if file_pointer.tell() < _SEEKABLE_TRAILER_SIZE:
+                return None
+            file_pointer.seek(-_SEEKABLE_TRAILER_SIZE, os.SEEK_END)
+            _trailer = file_pointer.read()
+        _offset = struct.unpack("<Q", _trailer[16:24])[0]
+        if _trailer != _seekable_trailer(_offset):
+            return None
+        return _offset
+
+    @contextlib.contextmanager
+    def open_member_at(self, offset: int):
+        """
+        Decompress a single member of a seekable tar.gz without reading the
+        members before it
+        :param offset: offset of the member in the archive, from the index
+            recorded while writing it
+        :return: context manager giving (TarInfo, binary file object)
+        """
+        Archive._validate(self.archive)
+        with open(self.archive, "rb") as file_pointer:
+            file_pointer.seek(offset)
+            with gzip.GzipFile(fileobj=file_pointer, mode="rb") as reader:
+                try:
+                    # only read forward, like _open_tar_stream()
+                    tar_ref = tarfile.open(fileobj=reader, mode="r:")
+                    member = tar_ref.next()
+                except (tarfile.TarError, OSError, EOFError) as exception:
+                    raise ArchiveE(
+                        "could not read member at offset %s of %s: %s"
+                        % (offset, self.archive, exception)
+                    )
+                with tar_ref:
+                    if member is None or not member.isfile():
+                        raise ArchiveE(
+                            "no file member at offset %s of %s" % (offset, self.archive)
+                        )
+                    yield member, tar_ref.extractfile(member)
+
     def extract(self, out_dir: Path):
         Archive._validate(self.archive)
 
-        if self.archive_type == "tar.gz":
-            with tarfile.open(self.archive, "r:gz") as tar_ref:
+        if self.archive_type == "tar.zst":
+            with self._open_tar_stream() as tar_ref:
                 tar_ref.extractall(out_dir)
-        elif self.archive_type == "tar":
-            with tarfile.open(self.archive, "r:") as tar_ref:
+        elif self.archive_type in TAR_TYPES:
+            _mode = "r:" + self.archive_type[len("tar.") :]
+            with tarfile.open(self.archive, _mode) as tar_ref:
                 tar_ref.extractall(out_dir)
         elif self.archive_type == "zip":
             with zipfile.ZipFile(self.archive, "r") as zip_ref:
@@ -40,34 +877,139 @@ class Archive:
         else:
             raise ArchiveE("unsupported file format")
 
-    def compress(self, dir_path: Path):
+    def writer(self):
+        """
+        Open the archive for writing, the returned writer is a context manager
+        with add_file(abs_path, arcname, file_pointer=None), add_link(abs_path,
+        arcname, target), add_bytes(arcname, data) and add_stream(arcname,
+        file_pointer) for the rest of a seekable file object. The writer of a seekable
+        archive also has an index property, mapping the names of the members
+        written so far to their offsets.
+        Archives written to a file object are tar streams, they are never seeked
+        and the file object is left open.
+        When the block of the writer is left with an exception the archive is
+        not finished, a partial archive file is removed.
+        """
+        if self.archive_type not in TAR_TYPES and self.archive_type != "zip":
+            raise ArchiveE("unsupported file format")
+        if self.archive_type == "tar.zst":
+            _require_zstandard()
+        output = _ArchiveOutput(self.archive)
+        try:
+            return self._open_writer(output)
+        except BaseException:
+            output.abort()
+            output.close()
+            raise
+
+    def _open_writer(self, output: _ArchiveOutput):
+        _level = self.compression_level
+        _mode = "w|" if output.stream else "w"
+        if self.seekable:
+            compressor = _ParallelBlockWriter(
+                output,
+                _block_compressor(self.archive_type, 9 if _level is None else _level),
+                threads=self.threads,
+                block_size=PARALLEL_BLOCK_SIZE[self.archive_type],
+            )
+            return _SeekableTarWriter(output, compressor)
+        elif self.archive_type == "tar":
+            return _TarWriter(output, _mode)
+        elif self.archive_type == "tar.zst":
+            compressor = zstandard.ZstdCompressor(
+                level=3 if _level is None else _level,
+                threads=self.threads if self.threads > 1 else 0,
+            ).stream_writer(output, closefd=False)
+            return _TarWriter(output, "w|", compressor=compressor)
+        elif self.archive_type in PARALLEL_BLOCK_SIZE and self.threads > 1:
+            if _level is None:
+                _level = 6 if self.archive_type == "tar.xz" else 9
+            compressor = _ParallelBlockWriter(
+                output,
+                _block_compressor(self.archive_type, _level),
+                threads=self.threads,
+                block_size=PARALLEL_BLOCK_SIZE[self.archive_type],
+            )
+            return _TarWriter(output, "w|", compressor=compressor)
+        elif output.stream:
+            return _TarWriter(
+                output,
+                "w|",
+                compressor=_stream_compressor(self.archive_type, output, _level),
+            )
+        elif self.archive_type in ("tar.gz", "tar.bz2"):
+            _mode = "w:" + self.archive_type[len("tar.") :]
+            if _level is None:
+                return _TarWriter(output, _mode)
+            return _TarWriter(output, _mode, compresslevel=_level)
+        elif self.archive_type == "tar.xz":
+            if _level is None:
+                return _TarWriter(output, "w:xz")
+            return _TarWriter(output, "w:xz", preset=_level)
+        return _ZipWriter(
+            output,
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=_level,
+            threads=self.threads,
+        )
+
+    def compress(
+        self,
+        dir_path: Path,
+        entries: List[ScanEntry] = None,
+        extra_members: Dict[str, Union[bytes, Callable]] = None,
+        hashes: Union[Mapping[str, str], Iterable[Tuple[str, str]]] = None,
+        stats=None,
+    ):
+        """
+        Archive all files in a directory
+        :param dir_path: directory to archive, member names are relative to it
+        :param entries: result of scan_directory() for the directory, scanned when not given
+        :param extra_members: name to contents of members added from memory after the
+            files. Contents may also be a callable, it is given the index of a
+            seekable archive (None otherwise) and returns the contents, or a
+            seekable binary file object that is read from its start and closed.
+        :param hashes: relative path to hash of the files, as listed in a manifest.
+            Either a mapping, or (path, hash) pairs in the order of entries that are
+            read along with them, so no mapping of every file is held in memory.
+            Files with the same hash as an earlier file are archived as a hard link
+            to it (tar) or reuse its compressed data (zip).
+        :param stats: optional Stats, every archived file is reported to its running stage
+        """
         if not dir_path.is_dir():
             raise ArchiveE("path: %s is not a directory" % dir_path)
 
-        files = [
-            _file
-            for _file in dir_path.glob("**/*")
-            if dir_path.joinpath(_file).is_file()
-        ]
-
-        # handles TAR, TGZ and ZIP
-        if self.archive_type == "tar.gz":
-            with tarfile.open(self.archive, "w:gz") as tar_ref:
-                for file in files:
-                    _abs_path = file.absolute()
-                    _rel_path = _abs_path.relative_to(dir_path)
-                    tar_ref.add(_abs_path, arcname=_rel_path, recursive=True)
-        elif self.archive_type == "tar":
-            with tarfile.open(self.archive, "w") as tar_ref:
-                for file in files:
-                    _abs_path = file.absolute()
-                    _rel_path = _abs_path.relative_to(dir_path)
-                    tar_ref.add(_abs_path, arcname=_rel_path, recursive=True)
-        elif self.archive_type == "zip":
-            with zipfile.ZipFile(
-                self.archive, mode="w", compression=zipfile.ZIP_DEFLATED
-            ) as zip_ref:
-                for file in files:
-                    _abs_path = file.absolute()
-                    _rel_path = _abs_path.relative_to(dir_path)
-                    zip_ref.write(_abs_path, arcname=_rel_path)
+        if entries is None:
+            try:
+                entries = scan_directory(dir_path)
+            except ScannerE as exception:
+                raise ArchiveE(exception.msg)
+
+        _lookup = _hash_lookup(hashes)
+        _archived = {}
+        with self.writer() as writer:
+            for entry in entries:
+                _start = time.perf_counter()
+                _abs_path = dir_path.absolute().joinpath(entry.relpath)
+                _hash = _lookup(str(Path(entry.relpath)))
+                if _hash is not None and entry.size and _hash in _archived:
+                    writer.add_link(
+                        _abs_path, arcname=entry.relpath, target=_archived[_hash]
+                    )
+                else:
+                    writer.add_file(_abs_path, arcname=entry.relpath)
+                    if _hash is not None:
+                        _archived[_hash] = entry.relpath
+                if stats is not None:
+                    stats.file_done(
+                        entry.relpath, entry.size, time.perf_counter() - _start
+                    )
+            for _name, _contents in (extra_members or {}).items():
+                if callable(_contents):
+                    _contents = _contents(getattr(writer, "index", None))
+                if isinstance(_contents, bytes):
+                    writer.add_bytes(_name, _contents)
+                    continue
+                with _contents:
+                    _contents.seek(0)
+                    writer.add_stream(_name, _contents)
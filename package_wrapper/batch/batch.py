@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import json
+import os
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover - optional dependency
+    yaml = None
+
+from package_wrapper.archiver.archiver import (
+    ArchiveE,
+    archive_type_from_file_name,
+)
+from package_wrapper.manifest.filehash import FileHashE, hash_methods, new_hasher
+from package_wrapper.manifest.hashcache import HashCache
+from package_wrapper.manifest.manifest import ManifestE
+from package_wrapper.package import PackageE, ProgressEvent, package_async
+
+# keys of a job in a job file and the create_package() arguments they set
+JOB_KEYS = {
+    "directory": "directory",
+    "meta-data": "meta_data",
+    "output": "output",
+    "hash-type": "hash_type",
+    "archive-type": "archive_type",
+    "compression-level": "compression_level",
+    "include": "include",
+    "exclude": "exclude",
+    "base": "base",
+    "seekable": "seekable",
+    "dedup": "dedup",
+    "compact-manifest": "compact_manifest",
+    "stream-manifest": "stream_manifest",
+    "binary-manifest": "binary_manifest",
+}
+_PATH_KEYS = ("directory", "meta-data", "output", "base")
+# type of the value of every job key, a key other than directory may also be null
+_JOB_TYPES = {
+    "directory": str,
+    "meta-data": str,
+    "output": str,
+    "hash-type": str,
+    "archive-type": str,
+    "compression-level": int,
+    "include": (str, list),
+    "exclude": (str, list),
+    "base": str,
+    "seekable": bool,
+    "dedup": bool,
+    "compact-manifest": bool,
+    "stream-manifest": bool,
+    "binary-manifest": bool,
+}
+# failures of a single job, reported in the summary instead of stopping the batch
+_JOB_ERRORS = (PackageE, ManifestE, ArchiveE, FileHashE, OSError, ValueError)
+
+
+class BatchE(BaseException):
+    def __init__(self, msg: str):
+        super(BatchE, self).__init__()
+        self.msg = msg
+
+
+def _read_job_file(path: Path):
+    if path.suffix.lower() in (".yaml", ".yml"):
+        if yaml is None:
+            raise BatchE("YAML job files require the 'PyYAML' package")
+        try:
+            return yaml.safe_load(path.read_text())
+        except yaml.YAMLError as exception:
+            raise BatchE("invalid job file %s: %s" % (path, exception))
+    try:
+        return json.loads(path.read_bytes())
+    except ValueError as exception:
+        raise BatchE("invalid job file %s: %s" % (path, exception))
+
+
+def job_options(job: Dict, base_dir: Path, name: str = "job") -> Dict:
+    """
+    :param job: a job as written in a job file, with the keys of JOB_KEYS
+    :param base_dir: directory the relative paths of the job are relative to
+    :param name: the job in error messages
+    :return: create_package() keyword arguments of the job
+    """
+    _unknown = sorted(set(job) - set(JOB_KEYS))
+    if _unknown:
+        raise BatchE("%s has unknown keys: %s" % (name, ", ".join(_unknown)))
+    if "directory" not in job:
+        raise BatchE("%s has no directory" % name)
+    for _key, _value in job.items():
+        if _value is None and _key != "directory":
+            continue
+        _valid = isinstance(_value, _JOB_TYPES[_key])
+        if isinstance(_value, bool) and _JOB_TYPES[_key] is not bool:
+            _valid = False
+        if isinstance(_value, list):
+            _valid = all(isinstance(_item, str) for _item in _value)
+        if not _valid:
+            raise BatchE("%s has an invalid %s: %r" % (name, _key, _value))
+    job = dict(job)
+    if job.get("hash-type") is not None:
+        # normalized and checked like --hash-type, before anything is packaged
+        try:
+            new_hasher(job["hash-type"])
+            job["hash-type"] = ",".join(hash_methods(job["hash-type"]))
+        except FileHashE as exception:
+            raise BatchE("%s has an invalid hash-type: %s" % (name, exception.msg))
+    for _key in _PATH_KEYS:
+        if job.get(_key) is not None:
+            job[_key] = base_dir.joinpath(job[_key]).absolute()
+    for _key in ("include", "exclude"):
+        if isinstance(job.get(_key), str):
+            job[_key] = [job[_key]]
+    options = {JOB_KEYS[_key]: _value for _key, _value in job.items()}
+
+    if options.get("output") is None:
+        _type = options.get("archive_type") or "tar.gz"
+        _directory = options["directory"]
+        options["output"] = _directory.parent.joinpath(f"{_directory.name}.{_type}")
+    elif options.get("archive_type") is None:
+        try:
+            options["archive_type"] = archive_type_from_file_name(options["output"])
+        except ArchiveE as exception:
+            raise BatchE(exception.msg)
+    return options
+
+
+def load_jobs(path: Path) -> List[Dict]:
+    """
+    Read a job file, a JSON (or YAML) list of jobs or an object with a "jobs"
+    list and "defaults" applied to every job. Each job needs a "directory", the
+    other keys are those of JOB_KEYS. Relative paths are relative to the job
+    file, a job without an output is written next to its directory and named
+    after it.
+    :return: create_package() keyword arguments of every job
+    """
+    contents = _read_job_file(path)
+    defaults = {}
+    if isinstance(contents, dict):
+        defaults = contents.get("defaults", {})
+        contents = contents.get("jobs")
+    if not isinstance(contents, list) or not isinstance(defaults, dict):
+        raise BatchE("job file %s does not contain a list of jobs" % path)
+
+    jobs = []
+    for _number, _job in enumerate(contents, start=1):
+        if not isinstance(_job, dict):
+            raise BatchE("job %d of %s is not an object" % (_number, path))
+        jobs.append(
+            job_options(dict(defaults, **_job), path.parent, name="job %d" % _number)
+        )
+
+    _outputs = collections.Counter(_job["output"] for _job in jobs)
+    _duplicated = sorted(
+        str(_output) for _output, _count in _outputs.items() if _count > 1
+    )
+    if _duplicated:
+        raise BatchE("jobs share their output: %s" % ", ".join(_duplicated))
+    return jobs
+
+
+async def run_job(
+    job: Dict, executor: Executor = None, hash_cache: HashCache = None
+) -> Dict:
+    """
+    Create the package of a job, a failure is reported in the result
+    :param job: create_package() keyword arguments, see job_options()
+    :param executor: executor running the packaging, the loop's default
+        executor when not given
+    :param hash_cache: optional hash cache
+    :return: directory, output, error (None on success), wall time and the
+        number of files and bytes packaged
+    """
+    _scanned = []
+
+    def _on_progress(event: ProgressEvent):
+        if event.event == "finished" and event.stage == "scan":
+            _scanned.append(event)
+
+    _start = time.perf_counter()
+    _result = {"directory": str(job["directory"]), "output": str(job["output"])}
+    try:
+        await package_async(
+            executor=executor,
+            progress=_on_progress,
+            hash_cache=hash_cache,
+            **job,
+        )
+        _result["error"] = None
+    except _JOB_ERRORS as exception:
+        _result["error"] = getattr(exception, "msg", None) or str(exception)
+    _result["wall"] = time.perf_counter() - _start
+    _result["files"] = _scanned[0].files if _scanned else 0
+    _result["bytes"] = _scanned[0].bytes if _scanned else 0
+    return _result
+
+
+async def run_batch_async(
+    jobs: List[Dict],
+    workers: int = 0,
+    hash_cache: HashCache = None,
+    progress: Callable[[Dict], None] = None,
+) -> Dict:
+    """
+    Create the packages of a batch in one process, up to workers packages are
+    created at the same time in a shared thread pool and all of them use the same
+    hash cache. A failing job does not stop the others.
+    :param jobs: create_package() keyword arguments of every job, see load_jobs()
+    :param workers: number of packages created in parallel, 0 means one per core
+    :param hash_cache: optional persistent hash cache shared by all jobs
+    :param progress: called with the summary of every job once it is done
+    :return: summary of the batch, with the result of every job in job order
+    """
+    if workers < 0:
+        raise BatchE(f"invalid number of workers: {workers}")
+    workers = workers or os.cpu_count() or 1
+
+    async def _run(job: Dict, executor: ThreadPoolExecutor) -> Dict:
+        _result = await run_job(job, executor=executor, hash_cache=hash_cache)
+        if progress is not None:
+            progress(_result)
+        return _result
+
+    _start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = await asyncio.gather(*[_run(_job, executor) for _job in jobs])
+    _wall = time.perf_counter() - _start
+    _bytes = sum(_result["bytes"] for _result in results)
+    return {
+        "packages": len(results),
+        "failed": sum(1 for _result in results if _result["error"] is not None),
+        "files": sum(_result["files"] for _result in results),
+        "bytes": _bytes,
+        "wall": _wall,
+        "bytes per second": _bytes / _wall if _wall else 0.0,
+        "jobs": list(results),
+    }
+
+
+def run_batch(
+    jobs: List[Dict],
+    workers: int = 0,
+    hash_cache: HashCache = None,
+    progress: Callable[[Dict], None] = None,
+) -> Dict:
+    """
+    Blocking run_batch_async()
+    """
+    return asyncio.run(
+        run_batch_async(jobs, workers=workers, hash_cache=hash_cache, progress=progress)
+    )
@@ -0,0 +1,356 @@
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from package_wrapper.archiver import archiver
+from package_wrapper.archiver.archiver import ARCHIVE_TYPES, Archive
+from package_wrapper.extract.extract import extract_package
+from package_wrapper.manifest.filehash import available_hash_methods, file_hash_create
+from package_wrapper.manifest.manifest import MANIFEST_NAME, ManifestFile
+from package_wrapper.scanner.scanner import scan_directory
+from package_wrapper.verify.verify import verify_archive, verify_directory
+from package_wrapper.version import __version__
+
+# version of the layout of the results, bumped when it changes incompatibly
+RESULTS_FORMAT = 1
+# synthetic trees at scale 1.0: number of files, size of each file, nesting depth
+# and number of distinct file contents (None: every file differs)
+TREES = {
+    "tiny-files": {"files": 5000, "size": 512, "depth": 2, "distinct": None},
+    "huge-files": {"files": 3, "size": 64 << 20, "depth": 0, "distinct": None},
+    "deep-nesting": {"files": 500, "size": 8 * 1024, "depth": 40, "distinct": None},
+    "duplicates": {"files": 1000, "size": 64 * 1024, "depth": 3, "distinct": 10},
+}
+BENCHMARKS = ["hash", "scan", "manifest", "compress", "extract", "verify"]
+
+
+class BenchE(BaseException):
+    def __init__(self, msg: str):
+        super(BenchE, self).__init__()
+        self.msg = msg
+
+
+def _compressible(rand: random.Random, size: int) -> bytes:
+    """
+    data compressing roughly like text, random bytes would make every
+    compressor look the same
+    """
+    _words = [rand.getrandbits(48).to_bytes(6, "little").hex() for _ in range(256)]
+    _data = bytearray()
+    while len(_data) < size:
+        _data += " ".join(rand.choices(_words, k=64)).encode() + b"\n"
+    return bytes(_data[:size])
+
+
+def _scaled(tree: str, scale: float) -> Tuple[int, int]:
+    """
+    :return: number of files and size of each file of the tree at the scale
+    """
+    if tree not in TREES:
+        raise BenchE("unknown tree %s, choose from %s" % (tree, ", ".join(TREES)))
+    _files = TREES[tree]["files"]
+    _size = TREES[tree]["size"]
+    if _files < 10:
+        _size = max(int(_size * scale), 1)
+    else:
+        _files = max(int(_files * scale), 1)
+    return _files, _size
+
+
+def tree_bytes(tree: str, scale: float = 1.0) -> int:
+    """
+    :return: number of bytes generate_tree writes for the tree at the scale
+    """
+    _files, _size = _scaled(tree, scale)
+    return _files * _size
+
+
+def generate_tree(
+    directory: Path, tree: str, scale: float = 1.0, seed: int = 0
+) -> Dict[str, int]:
+    """
+    Write one of the synthetic TREES, the same seed always gives the same files
+    :param directory: created, must not exist yet
+    :param scale: factor applied to the number of files, or to the file size for
+        trees of a few files
+    :return: number of files and bytes written
+    """
+    _files, _size = _scaled(tree, scale)
+    _spec = TREES[tree]
+
+    rand = random.Random("%s-%s" % (tree, seed))
+    _contents = None
+    if _spec["distinct"]:
+        _contents = [
+            _compressible(rand, _size) for _ in range(min(_spec["distinct"], _files))
+        ]
+
+    directory.mkdir(parents=True)
+    _total = 0
+    for _index in range(_files):
+        _parts = ["d%02d" % rand.randrange(4) for _ in range(_spec["depth"])]
+        _path = directory.joinpath(*_parts, "file%06d.dat" % _index)
+        _path.parent.mkdir(parents=True, exist_ok=True)
+        if _contents is None:
+            _data = _compressible(rand, _size)
+        else:
+            _data = rand.choice(_contents)
+        _path.write_bytes(_data)
+        _total += len(_data)
+    return {"files": _files, "bytes": _total}
+
+
+def _measure(function: Callable, repeat: int, setup: Callable = None) -> Dict:
+    """
+    :return: wall and CPU seconds of the fastest run and the median wall time
+    """
+    _wall = []
+    _cpu = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        _start_wall = time.perf_counter()
+        _start_cpu = time.process_time()
+        function()
+        _cpu.append(time.process_time() - _start_cpu)
+        _wall.append(time.perf_counter() - _start_wall)
+    return {
+        "wall": min(_wall),
+        "wall median": statistics.median(_wall),
+        "cpu": _cpu[_wall.index(min(_wall))],
+    }
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _archive_types() -> List[str]:
+    # tar.zst only when the optional zstandard package is installed
+    return [
+        _type
+        for _type in ARCHIVE_TYPES
+        if _type != "tar.zst" or archiver.zstandard is not None
+    ]
+
+
+def _tree_benchmarks(
+    tree_dir: Path,
+    work_dir: Path,
+    benchmarks: Sequence[str],
+    hash_methods: Sequence[str],
+    archive_types: Sequence[str],
+    jobs: int,
+    repeat: int,
+):
+    """
+    yields (benchmark, parameters, measurement) for one generated tree
+    """
+    entries = scan_directory(tree_dir)
+    files = [tree_dir.joinpath(entry.relpath) for entry in entries]
+
+    if "hash" in benchmarks:
+        for _method in hash_methods:
+            yield "hash", {"algorithm": _method}, _measure(
+                lambda: [file_hash_create(_file, _method) for _file in files], repeat
+            )
+
+    if "scan" in benchmarks:
+        yield "scan", {}, _measure(lambda: scan_directory(tree_dir), repeat)
+
+    if "manifest" in benchmarks:
+        for _jobs in sorted({1, jobs}):
+            yield "manifest", {"jobs": _jobs}, _measure(
+                lambda: ManifestFile(jobs=_jobs).add_folder(tree_dir, entries), repeat
+            )
+
+    _manifest = ManifestFile(jobs=jobs)
+    _manifest.add_folder(tree_dir, entries)
+    _manifest_contents = json.dumps(_manifest.retrive_contents()).encode()
+    for _type in archive_types:
+        _archive_path = work_dir.joinpath("bench.%s" % _type)
+        _out_dir = work_dir.joinpath("extracted")
+        archive = Archive(_archive_path, archive_type=_type, threads=jobs)
+
+        def _compress():
+            archive.compress(
+                tree_dir,
+                entries=entries,
+                extra_members={MANIFEST_NAME: _manifest_contents},
+                hashes=_manifest.file_digests(),
+            )
+
+        if "compress" in benchmarks:
+            _result = _measure(_compress, repeat, setup=lambda: _remove(_archive_path))
+            _result["archive bytes"] = _archive_path.stat().st_size
+            yield "compress", {"archive type": _type, "threads": jobs}, _result
+        if not _archive_path.exists():
+            _compress()
+
+        if "extract" in benchmarks:
+            yield "extract", {"archive type": _type, "verify": False}, _measure(
+                lambda: archive.extract(_out_dir),
+                repeat,
+                setup=lambda: _remove(_out_dir),
+            )
+            yield "extract", {"archive type": _type, "verify": True}, _measure(
+                lambda: extract_package(_archive_path, _out_dir, jobs=jobs),
+                repeat,
+                setup=lambda: _remove(_out_dir),
+            )
+        if "verify" in benchmarks:
+            yield "verify", {"archive type": _type}, _measure(
+                lambda: verify_archive(_archive_path), repeat
+            )
+        _remove(_archive_path)
+        _remove(_out_dir)
+
+    if "verify" in benchmarks:
+        tree_dir.joinpath(MANIFEST_NAME).write_bytes(_manifest_contents)
+        yield "verify", {"directory": True, "jobs": jobs}, _measure(
+            lambda: verify_directory(tree_dir, jobs=jobs), repeat
+        )
+        tree_dir.joinpath(MANIFEST_NAME).unlink()
+
+
+def run_benchmarks(
+    trees: Sequence[str] = None,
+    benchmarks: Sequence[str] = None,
+    hash_methods: Sequence[str] = None,
+    archive_types: Sequence[str] = None,
+    scale: float = 1.0,
+    repeat: int = 3,
+    jobs: int = 1,
+    seed: int = 0,
+    work_dir: Path = None,
+    progress: Callable[[str], None] = None,
+) -> Dict:
+    """
+    Generate the synthetic trees and time the hot paths on each of them
+    :param trees: names of TREES, all when not given
+    :param benchmarks: names of BENCHMARKS, all when not given
+    :param hash_methods: algorithms timed by the hash benchmark, all available when
+        not given
+    :param archive_types: archive types compressed, extracted and verified, all
+        available when not given
+    :param scale: size of the trees relative to TREES
+    :param repeat: runs of every benchmark, the fastest one is reported
+    :param jobs: workers used by the parallel code paths
+    :param seed: seed of the generated contents
+    :param work_dir: parent of the temporary directory the trees are written to
+    :param progress: called with the name of every benchmark before it runs
+    :return: JSON serializable results
+    """
+    trees = list(trees or TREES)
+    benchmarks = list(benchmarks or BENCHMARKS)
+    hash_methods = list(hash_methods or available_hash_methods())
+    archive_types = list(archive_types or _archive_types())
+    for _name, _known in (
+        (trees, TREES),
+        (benchmarks, BENCHMARKS),
+        (hash_methods, available_hash_methods()),
+        (archive_types, ARCHIVE_TYPES),
+    ):
+        _unknown = sorted(set(_name) - set(_known))
+        if _unknown:
+            raise BenchE("unknown benchmark option: %s" % ", ".join(_unknown))
+    if repeat < 1:
+        raise BenchE("repeat must be at least 1")
+
+    results = {
+        "format": RESULTS_FORMAT,
+        "version of package-wrapper": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu count": os.cpu_count(),
+        "parameters": {
+            "scale": scale,
+            "repeat": repeat,
+            "jobs": jobs,
+            "seed": seed,
+        },
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory(dir=work_dir, prefix="pkgwrap-bench-") as _tmp:
+        for tree in trees:
+            tree_dir = Path(_tmp).joinpath(tree)
+            if progress:
+                progress("generating %s" % tree)
+            _size = generate_tree(tree_dir, tree, scale=scale, seed=seed)
+            for _benchmark, _parameters, _result in _tree_benchmarks(
+                tree_dir,
+                Path(_tmp),
+                benchmarks,
+                hash_methods,
+                archive_types,
+                jobs,
+                repeat,
+            ):
+                _wall = max(_result["wall"], 1e-9)
+                _result.update(_size)
+                _result["bytes per second"] = _size["bytes"] / _wall
+                _result["files per second"] = _size["files"] / _wall
+                results["results"].append(
+                    dict(
+                        tree=tree,
+                        benchmark=_benchmark,
+                        parameters=_parameters,
+                        **_result,
+                    )
+                )
+                if progress:
+                    progress(result_key(results["results"][-1]))
+            shutil.rmtree(tree_dir)
+
+    return results
+
+
+def result_key(result: Dict) -> str:
+    """
+    :return: name identifying a benchmark across runs
+    """
+    _parameters = ",".join(
+        "%s=%s" % _item for _item in sorted(result["parameters"].items())
+    )
+    return "%s/%s[%s]" % (result["tree"], result["benchmark"], _parameters)
+
+
+def compare_results(
+    baseline: Dict, current: Dict, threshold: float = 0.1
+) -> List[Dict]:
+    """
+    Compare the wall times of two runs
+    :param threshold: relative slowdown reported as a regression, 0.1 is 10 %
+    :return: one entry per benchmark found in both runs, sorted by key, with the
+        ratio of the current to the baseline wall time
+    """
+    if baseline.get("format") != current.get("format"):
+        raise BenchE("the results were written by incompatible versions")
+    _baseline = {result_key(_result): _result for _result in baseline["results"]}
+    comparison = []
+    for _result in current["results"]:
+        _key = result_key(_result)
+        if _key not in _baseline:
+            continue
+        _ratio = _result["wall"] / max(_baseline[_key]["wall"], 1e-9)
+        comparison.append(
+            {
+                "benchmark": _key,
+                "baseline wall": _baseline[_key]["wall"],
+                "wall": _result["wall"],
+                "ratio": _ratio,
+                "regression": _ratio > 1 + threshold,
+            }
+        )
+    return sorted(comparison, key=lambda _entry: _entry["benchmark"])
@@ -0,0 +1,114 @@
+/*
+ * FastCDC cut point search of the chunk store in C, the same algorithm as
+ * _cut_point() in chunkstore.py which is used when this module is not built.
+ * Both must find the same boundaries, chunks written by either are shared.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#define GEAR_SIZE 256
+
+static int
+mask(Py_ssize_t bits, uint64_t *result)
+{
+    /* the high bits of the gear hash depend on the most recent bytes */
+    if (bits < 0 || bits > 64) {
+        PyErr_SetString(PyExc_ValueError, "invalid average chunk size");
+        return -1;
+    }
+    *result = bits == 0 ? 0 : (UINT64_MAX >> (64 - bits)) << (64 - bits);
+    return 0;
+}
+
+static Py_ssize_t
+scan(const unsigned char *data, Py_ssize_t length, Py_ssize_t min_size,
+     Py_ssize_t normal, const uint64_t *gear, uint64_t mask_small,
+     uint64_t mask_large)
+{
+    uint64_t hash = 0;
+    Py_ssize_t index;
+
+    for (index = min_size; index < normal; index++) {
+        hash = (hash << 1) + gear[data[index]];
+        if (!(hash & mask_small))
+            return index + 1;
+    }
+    for (; index < length; index++) {
+        hash = (hash << 1) + gear[data[index]];
+        if (!(hash & mask_large))
+            return index + 1;
+    }
+    return length;
+}
+
+static PyObject *
+cut_point(PyObject *self, PyObject *args)
+{
+    Py_buffer data, gear_bytes;
+    Py_ssize_t start, end, min_size, avg_size, max_size;
+    Py_ssize_t length, normal, bits, result;
+    uint64_t gear[GEAR_SIZE], mask_small, mask_large;
+    int index, byte;
+
+    if (!PyArg_ParseTuple(args, "y*nnnnny*", &data, &start, &end, &min_size,
+                          &avg_size, &max_size, &gear_bytes))
+        return NULL;
+    if (gear_bytes.len != GEAR_SIZE * 8 || start < 0 || start > end ||
+        end > data.len || min_size < 0 || avg_size < 1) {
+        PyErr_SetString(PyExc_ValueError, "invalid chunk boundaries");
+        goto error;
+    }
+
+    length = end - start;
+    if (length <= min_size) {
+        result = length;
+        goto done;
+    }
+    if (length > max_size)
+        length = max_size;
+    normal = avg_size < length ? avg_size : length;
+    for (bits = -1; avg_size >> (bits + 1); bits++)
+        ;
+    if (mask(bits + 2, &mask_small) < 0 || mask(bits - 2, &mask_large) < 0)
+        goto error;
+    /* packed little endian, independent of the byte order of the machine */
+    for (index = 0; index < GEAR_SIZE; index++) {
+        gear[index] = 0;
+        for (byte = 7; byte >= 0; byte--)
+            gear[index] = (gear[index] << 8) |
+                          ((const unsigned char *)gear_bytes.buf)[index * 8 + byte];
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    result = scan((const unsigned char *)data.buf + start, length, min_size,
+                  normal, gear, mask_small, mask_large);
+    Py_END_ALLOW_THREADS
+
+done:
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&gear_bytes);
+    return PyLong_FromSsize_t(result);
+
+error:
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&gear_bytes);
+    return NULL;
+}
+
+static PyMethodDef gear_methods[] = {
+    {"cut_point", cut_point, METH_VARARGS,
+     "cut_point(data, start, end, min_size, avg_size, max_size, gear)\n"
+     "length of the chunk starting at start, gear is the packed gear table"},
+    {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef gear_module = {
+    PyModuleDef_HEAD_INIT, "_gear", NULL, -1, gear_methods,
+};
+
+PyMODINIT_FUNC
+PyInit__gear(void)
+{
+    return PyModule_Create(&gear_module);
+}
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from package_wrapper.archiver.archiver import ArchiveE, member_path
+from package_wrapper.manifest.filehash import FileHashE, HashingReader, new_hasher
+from package_wrapper.verify.verify import VerifyE, VerifyResult, manifest_index
+
+try:
+    from package_wrapper.chunkstore import _gear
+except ImportError:  # pragma: no cover - C extension not built
+    _gear = None
+
+# archive type recorded in the manifest of packages kept in a chunk store
+CHUNK_STORE_TYPE = "chunks"
+# FastCDC chunk sizes in bytes, boundaries depend only on the content so an
+# insertion or deletion only changes the chunks around it
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# chunks are identified by this hash of their uncompressed contents
+CHUNK_HASH_METHOD = "sha256"
+
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+# fixed pseudo random gear table, chunk boundaries must never change between versions
+_GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([_index])).digest()[:8], "big")
+    for _index in range(256)
+]
+# the gear table as passed to the C extension
+_GEAR_BYTES = b"".join(_value.to_bytes(8, "little") for _value in _GEAR)
+
+
+class ChunkStoreE(BaseException):
+    def __init__(self, msg: str):
+        super(ChunkStoreE, self).__init__()
+        self.msg = msg
+
+
+def _mask(bits: int) -> int:
+    # the high bits of the gear hash depend on the most recent bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def _cut_point(data, start: int, end: int, min_size: int, avg_size: int, max_size: int):
+    """
+    FastCDC with normalized chunking: a stricter mask before the average size
+    and a looser one after it keeps chunk sizes close to the average.
+    Runs in the C extension when it is built, this loop finds the same cut
+    points about 200 times slower.
+    :return: length of the chunk starting at start
+    """
+    if _gear is not None:
+        return _gear.cut_point(
+            data, start, end, min_size, avg_size, max_size, _GEAR_BYTES
+        )
+    return _cut_point_python(data, start, end, min_size, avg_size, max_size)
+
+
+def _cut_point_python(
+    data, start: int, end: int, min_size: int, avg_size: int, max_size: int
+):
+    _length = end - start
+    if _length <= min_size:
+        return _length
+    if _length > max_size:
+        _length = max_size
+    _normal = min(avg_size, _length)
+    _bits = avg_size.bit_length() - 1
+    _mask_small = _mask(_bits + 2)
+    _mask_large = _mask(_bits - 2)
+    _gear = _GEAR
+
+    _hash = 0
+    _index = min_size
+    for _byte in data[start + min_size : start + _normal]:
+        _hash = ((_hash << 1) + _gear[_byte]) & _MASK_64
+        _index += 1
+        if not _hash & _mask_small:
+            return _index
+    for _byte in data[start + _normal : start + _length]:
+        _hash = ((_hash << 1) + _gear[_byte]) & _MASK_64
+        _index += 1
+        if not _hash & _mask_large:
+            return _index
+    return _length
+
+
+def iter_chunks(
+    file_pointer,
+    min_size: int = MIN_CHUNK_SIZE,
+    avg_size: int = AVG_CHUNK_SIZE,
+    max_size: int = MAX_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """
+    Split everything read from a binary file object into content defined chunks
+    """
+    if not 0 < min_size < avg_size < max_size:
+        raise ChunkStoreE("chunk sizes must satisfy 0 < min < avg < max")
+
+    _buffer = b""
+    _offset = 0
+    _eof = False
+    while True:
+        if not _eof and len(_buffer) - _offset < max_size:
+            _data = file_pointer.read(4 * max_size)
+            _eof = not _data
+            _buffer = _buffer[_offset:] + _data
+            _offset = 0
+            continue
+        if _offset >= len(_buffer):
+            return
+        _cut = _cut_point(_buffer, _offset, len(_buffer), min_size, avg_size, max_size)
+        yield _buffer[_offset : _offset + _cut]
+        _offset += _cut
+
+
+class ChunkStore:
+    """
+    Local content addressed store of zlib compressed chunks. Every chunk is
+    stored once, no matter how many files or packages reference it. The store
+    also remembers the chunk list of every file hash it has seen, so files that
+    are known to be identical are not chunked again.
+    """
+
+    def __init__(self, store_dir: Path):
+        self.store_dir = Path(store_dir)
+        self.store_dir.joinpath("chunks").mkdir(parents=True, exist_ok=True)
+        self.store_dir.joinpath("files").mkdir(parents=True, exist_ok=True)
+
+    def _chunk_path(self, chunk_id: str) -> Path:
+        return self.store_dir.joinpath("chunks", chunk_id[:2], chunk_id)
+
+    def _file_path(self, hash_string: str) -> Path:
+        _method, _hash = hash_string.split(":", 1)
+        return self.store_dir.joinpath("files", _method.lower(), _hash)
+
+    def _write(self, path: Path, data: bytes):
+        # written to a temporary file first, readers never see a partial entry
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _fd, _temp = tempfile.mkstemp(dir=path.parent)
+        try:
+            with os.fdopen(_fd, "wb") as file_pointer:
+                file_pointer.write(data)
+            os.replace(_temp, path)
+        except BaseException:
+            os.unlink(_temp)
+            raise
+
+    def has_chunk(self, chunk_id: str) -> bool:
+        return self._chunk_path(chunk_id).exists()
+
+    def put_chunk(self, chunk: bytes) -> str:
+        """
+        :return: id of the chunk, the chunk is only written if it is not stored yet
+        """
+        _hasher = new_hasher(CHUNK_HASH_METHOD)
+        _hasher.update(chunk)
+        chunk_id = _hasher.hexdigest()
+        if not self.has_chunk(chunk_id):
+            self._write(self._chunk_path(chunk_id), zlib.compress(chunk))
+        return chunk_id
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        try:
+            return zlib.decompress(self._chunk_path(chunk_id).read_bytes())
+        except FileNotFoundError:
+            raise ChunkStoreE("chunk %s is missing from the store" % chunk_id)
+
+    def file_chunks(self, hash_string: str):
+        """
+        :return: chunk ids of a file with the given "method:hash", None if unknown
+        """
+        try:
+            _chunks = json.loads(self._file_path(hash_string).read_bytes())
+        except FileNotFoundError:
+            return None
+        if not all(self.has_chunk(_chunk) for _chunk in _chunks):
+            return None
+        return _chunks
+
+    def put_file_chunks(self, hash_string: str, chunk_ids: List[str]):
+        self._write(self._file_path(hash_string), json.dumps(chunk_ids).encode())
+
+
+def store_file(store_dir: Path, path_to_file: Path, hash_string: str):
+    """
+    Chunk a file into the store and remember its chunk list, runs in worker
+    processes so the result is (chunk ids, None) or (None, error message)
+    :param hash_string: "method:hash" the file had when it was hashed, a file
+        changed since then is rejected
+    """
+    store = ChunkStore(store_dir)
+    _method = hash_string.split(":", 1)[0]
+    try:
+        with open(path_to_file, "rb") as file_pointer:
+            reader = HashingReader(file_pointer, _method)
+            _chunks = [store.put_chunk(_chunk) for _chunk in iter_chunks(reader)]
+    except (OSError, FileHashE) as exception:
+        return None, getattr(exception, "msg", str(exception))
+    if _method + ":" + reader.hexdigest() != hash_string:
+        return None, "file %s changed while it was packaged" % path_to_file
+    store.put_file_chunks(hash_string, _chunks)
+    return _chunks, None
+
+
+def store_files(
+    store_dir: Path, files: Dict[str, str], directory: Path, jobs: int = 1
+) -> Dict[str, List[str]]:
+    """
+    Put the files of a package into the chunk store, chunking happens in worker
+    processes and only for contents the store has not seen before
+    :param files: relative path to "method:hash" as listed in the manifest
+    :param directory: root of the package
+    :return: relative path to the ids of the chunks making up the file
+    """
+    store = ChunkStore(store_dir)
+    _known = {}
+    for _hash in set(files.values()):
+        _chunks = store.file_chunks(_hash)
+        if _chunks is not None:
+            _known[_hash] = _chunks
+    # identical files are chunked once
+    _pending = {}
+    for _path, _hash in files.items():
+        if _hash not in _known and _hash not in _pending:
+            _pending[_hash] = directory.joinpath(_path)
+
+    _hashes = list(_pending)
+    _arguments = (
+        [store_dir] * len(_hashes),
+        [_pending[_hash] for _hash in _hashes],
+        _hashes,
+    )
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(store_file, *_arguments))
+    else:
+        results = list(map(store_file, *_arguments))
+    for _hash, (_chunks, _error) in zip(_hashes, results):
+        if _error is not None:
+            raise ChunkStoreE(_error)
+        _known[_hash] = _chunks
+
+    return {_path: _known[_hash] for _path, _hash in files.items()}
+
+
+def restore_files(store_dir: Path, manifest: Dict, out_dir: Path) -> VerifyResult:
+    """
+    Rebuild the files of a chunk store package, each file is hashed while it is
+    written and compared with the manifest
+    :param manifest: contents of the package manifest
+    :param out_dir: directory receiving the files
+    """
+    if "chunks" not in manifest:
+        raise ChunkStoreE("manifest does not reference a chunk store")
+    try:
+        index = manifest_index(manifest)
+    except VerifyE as exception:
+        raise ChunkStoreE(exception.msg)
+    store = ChunkStore(store_dir)
+
+    result = VerifyResult()
+    for _path, _chunks in sorted(manifest["chunks"].items()):
+        _posix = Path(_path).as_posix()
+        if _posix not in index:
+            result.extra.append(_posix)
+            continue
+        _method, _expected = index[_posix].split(":", 1)
+        try:
+            _target = member_path(out_dir, _path)
+        except ArchiveE as exception:
+            raise ChunkStoreE(exception.msg)
+        try:
+            # composite and registered methods, like the manifest was hashed with
+            _hasher = new_hasher(_method)
+        except FileHashE as exception:
+            raise ChunkStoreE(exception.msg)
+        _target.parent.mkdir(parents=True, exist_ok=True)
+        with open(_target, "wb") as file_pointer:
+            for _chunk_id in _chunks:
+                _chunk = store.get_chunk(_chunk_id)
+                _hasher.update(_chunk)
+                file_pointer.write(_chunk)
+        _matches = _hasher.hexdigest() == _expected
+        (result.matched if _matches else result.mismatched).append(_posix)
+    result.missing = sorted(
+        set(index) - set(Path(_path).as_posix() for _path in manifest["chunks"])
+    )
+    return result
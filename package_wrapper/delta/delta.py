@@ -0,0 +1,176 @@
+import json
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from package_wrapper.archiver.archiver import (
+    Archive,
+    ArchiveE,
+    archive_type_from_file_name,
+    member_path,
+)
+from package_wrapper.manifest.filehash import new_hasher
+from package_wrapper.manifest.manifest import MANIFEST_NAME
+from package_wrapper.verify.verify import (
+    VerifyE,
+    VerifyResult,
+    delta_info,
+    load_manifest_bytes,
+    manifest_index,
+    verify_directory,
+)
+
+# the base manifest is identified by this hash, independent of the package hash method
+BASE_HASH_METHOD = "sha256"
+
+
+class DeltaE(BaseException):
+    """
+    Basic exception for delta package related tasks
+    """
+
+    def __init__(self, msg: str):
+        super(DeltaE, self).__init__()
+        self.msg = msg
+
+
+def manifest_digest(manifest_contents: bytes) -> str:
+    _hasher = new_hasher(BASE_HASH_METHOD)
+    _hasher.update(manifest_contents)
+    return BASE_HASH_METHOD + ":" + _hasher.hexdigest()
+
+
+def compute_delta(base_manifest: Dict, files: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    Compare the files of a package with the manifest of its base package
+    :param base_manifest: contents of the base package manifest
+    :param files: relative path to "method:hash" of the files being packaged
+    :return: sorted lists of "added", "changed" and "removed" relative paths
+    """
+    try:
+        base_files = manifest_index(base_manifest)
+    except VerifyE as exception:
+        raise DeltaE(exception.msg)
+    current = {Path(_path).as_posix(): _hash for _path, _hash in files.items()}
+    return compare_files(base_files, current)
+
+
+def mismatched_methods(
+    base_files: Dict[str, str], current: Dict[str, str]
+) -> Optional[Tuple[str, str]]:
+    """
+    :param base_files: posix path to "method:hash" of the files of the base
+    :param current: posix path to "method:hash" of the files compared with it
+    :return: hash methods of the base and of current for a file both list with
+        different methods, None if they agree
+    """
+    for _path in set(base_files).intersection(current):
+        _base_method = base_files[_path].split(":", 1)[0]
+        _method = current[_path].split(":", 1)[0]
+        if _base_method.lower() != _method.lower():
+            return _base_method, _method
+    return None
+
+
+def compare_files(
+    base_files: Dict[str, str], current: Dict[str, str]
+) -> Dict[str, List[str]]:
+    """
+    :param base_files: posix path to "method:hash" of the files of the base
+    :param current: posix path to "method:hash" of the files compared with it
+    :return: sorted lists of "added", "changed" and "removed" relative paths
+    """
+    _methods = mismatched_methods(base_files, current)
+    if _methods is not None:
+        raise DeltaE(
+            "the base package uses %s hashes, package with the same hash type"
+            % _methods[0]
+        )
+
+    return {
+        "added": sorted(set(current) - set(base_files)),
+        "changed": sorted(
+            _path
+            for _path in set(current).intersection(base_files)
+            if current[_path] != base_files[_path]
+        ),
+        "removed": sorted(set(base_files) - set(current)),
+    }
+
+
+def _target(out_dir: Path, name: str) -> Path:
+    try:
+        return member_path(out_dir, name)
+    except ArchiveE as exception:
+        raise DeltaE(exception.msg)
+
+
+def _prepare_base(base: Path, out_dir: Path):
+    if base.is_dir():
+        if out_dir.exists() and out_dir.resolve() == base.resolve():
+            # applied in place
+            return
+        if out_dir.exists():
+            if any(out_dir.iterdir()):
+                raise DeltaE("output directory %s is not empty" % out_dir)
+            out_dir.rmdir()
+        shutil.copytree(base, out_dir)
+        return
+
+    try:
+        Archive(base, archive_type=archive_type_from_file_name(base)).extract(out_dir)
+    except ArchiveE as exception:
+        raise DeltaE(exception.msg)
+
+
+def apply_delta(base: Path, delta: Path, out_dir: Path, jobs: int = 1) -> VerifyResult:
+    """
+    Rebuild the full package tree from a base package and a delta package
+    :param base: base package archive or directory
+    :param delta: delta package archive
+    :param out_dir: directory receiving the full tree, the base directory itself applies the delta in place
+    :param jobs: number of files hashed in parallel when verifying the result
+    :return: result of verifying the rebuilt tree against the delta manifest
+    """
+    try:
+        delta_contents = load_manifest_bytes(delta)
+        delta_manifest = json.loads(delta_contents)
+        info = delta_info(delta_manifest)
+        if info is None:
+            raise DeltaE("%s is not a delta package" % delta)
+        if manifest_digest(load_manifest_bytes(base)) != info["base manifest"]:
+            raise DeltaE("%s is not the base package of %s" % (base, delta))
+    except VerifyE as exception:
+        raise DeltaE(exception.msg)
+
+    _prepare_base(base, out_dir)
+
+    try:
+        archive = Archive(delta, archive_type=archive_type_from_file_name(delta))
+        for _name, file_pointer, _link in archive.iter_entries():
+            if Path(_name).as_posix() == MANIFEST_NAME:
+                continue
+            _path = _target(out_dir, _name)
+            _path.parent.mkdir(parents=True, exist_ok=True)
+            if _path.is_file():
+                # may be hard linked in the base, never write through the link
+                _path.unlink()
+            if _link is not None:
+                # duplicated file, its contents were written with the linked member
+                shutil.copyfile(_target(out_dir, _link), _path)
+                continue
+            with open(_path, "wb") as destination:
+                shutil.copyfileobj(file_pointer, destination)
+    except ArchiveE as exception:
+        raise DeltaE(exception.msg)
+
+    for _name in info["removed"]:
+        _path = _target(out_dir, _name)
+        if _path.is_file():
+            _path.unlink()
+    out_dir.joinpath(MANIFEST_NAME).write_bytes(delta_contents)
+
+    try:
+        return verify_directory(out_dir, manifest=delta_manifest, jobs=jobs)
+    except VerifyE as exception:
+        raise DeltaE(exception.msg)
@@ -0,0 +1,175 @@
+import contextlib
+import os
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from package_wrapper.delta.delta import compare_files, mismatched_methods
+from package_wrapper.manifest.binary import (
+    BINARY_MANIFEST_NAME,
+    BinaryManifest,
+    is_binary_manifest,
+)
+from package_wrapper.manifest.manifest import ManifestE
+from package_wrapper.verify.verify import VerifyE, load_manifest, manifest_index
+
+
+class DiffE(BaseException):
+    """
+    Basic exception for comparing packages
+    """
+
+    def __init__(self, msg: str):
+        super(DiffE, self).__init__()
+        self.msg = msg
+
+
+class _Manifest:
+    """
+    Manifest loaded as a whole, its files are grouped by directory when first needed
+    """
+
+    def __init__(self, contents: Dict):
+        self.contents = contents
+        self._directories = None
+
+    def meta_data(self) -> Dict:
+        return self.contents
+
+    def files(self) -> Dict[str, str]:
+        return manifest_index(self.contents)
+
+    def directory_files(self, directory: str) -> Dict[str, str]:
+        if self._directories is None:
+            self._directories = defaultdict(list)
+            for _path in self.contents.get("files", {}):
+                _directory = _path.replace(os.sep, "/").rpartition("/")[0]
+                self._directories[_directory].append(_path)
+        return manifest_index(
+            {
+                "files": {
+                    _path: self.contents["files"][_path]
+                    for _path in self._directories.get(directory, [])
+                }
+            }
+        )
+
+    def close(self):
+        pass
+
+
+class _BinaryManifest:
+    """
+    Memory mapped binary manifest, files are looked up without reading the others
+    """
+
+    def __init__(self, path: Path):
+        self.binary = BinaryManifest(path)
+
+    def meta_data(self) -> Dict:
+        return self.binary.meta_data()
+
+    def files(self) -> Dict[str, str]:
+        return dict(self.binary)
+
+    def directory_files(self, directory: str) -> Dict[str, str]:
+        return dict(self.binary.directory_files(directory))
+
+    def close(self):
+        self.binary.close()
+
+
+def _open(path: Path):
+    _binary = path.joinpath(BINARY_MANIFEST_NAME) if path.is_dir() else path
+    try:
+        if _binary.name == BINARY_MANIFEST_NAME and is_binary_manifest(_binary):
+            return _BinaryManifest(_binary)
+        return _Manifest(load_manifest(path))
+    except (ManifestE, VerifyE) as exception:
+        raise DiffE(exception.msg)
+
+
+def _tree(manifest) -> Optional[Dict]:
+    """
+    :return: the Merkle tree recorded in the manifest, None for manifests
+        written without one
+    """
+    return manifest.meta_data().get("package-wrapper", {}).get("tree")
+
+
+def _directories(tree: Dict) -> Dict[str, str]:
+    """
+    :return: digest of every directory by its posix path, "" for the root
+    """
+    _digests = dict(tree["directories"])
+    _digests[""] = tree["root"]
+    return _digests
+
+
+def _subdirectories(*directories: Dict[str, str]) -> Dict[str, List[str]]:
+    _children = defaultdict(list)
+    for _directory in set().union(*directories):
+        if _directory:
+            _children[_directory.rpartition("/")[0]].append(_directory)
+    return _children
+
+
+def _compare_files(
+    old_files: Dict[str, str], new_files: Dict[str, str]
+) -> Dict[str, List[str]]:
+    _methods = mismatched_methods(old_files, new_files)
+    if _methods is not None:
+        raise DiffE("manifests use different hash methods: %s vs %s" % _methods)
+    return compare_files(old_files, new_files)
+
+
+def _compare(old, new) -> Dict[str, List[str]]:
+    _old_tree = _tree(old)
+    _new_tree = _tree(new)
+    if (
+        _old_tree is None
+        or _new_tree is None
+        or _old_tree["hash method"] != _new_tree["hash method"]
+    ):
+        return _compare_files(old.files(), new.files())
+
+    _old = _directories(_old_tree)
+    _new = _directories(_new_tree)
+    result = {"added": [], "changed": [], "removed": []}
+    _children = _subdirectories(_old, _new)
+    _pending = [""]
+    while _pending:
+        _directory = _pending.pop()
+        if _old.get(_directory) == _new.get(_directory):
+            continue
+        _files = _compare_files(
+            old.directory_files(_directory), new.directory_files(_directory)
+        )
+        for _key, _paths in _files.items():
+            result[_key].extend(_paths)
+        _pending.extend(_children.get(_directory, []))
+    return {_key: sorted(_paths) for _key, _paths in result.items()}
+
+
+def diff_packages(old: Path, new: Path) -> Dict[str, List[str]]:
+    """
+    Compare the files of two packages. The Merkle trees recorded in their
+    manifests are walked from the root, directories with the same digest in
+    both are skipped, so the comparison takes time in proportion to the
+    directories that differ. Packages without a tree, or with trees using
+    different hash methods, are compared file by file.
+    :param old: package directory, archive or manifest compared against
+    :param new: package directory, archive or manifest compared with old
+    :return: sorted lists of the "added", "changed" and "removed" relative paths
+    """
+    with contextlib.ExitStack() as stack:
+        _old = _open(old)
+        stack.callback(_old.close)
+        _new = _open(new)
+        stack.callback(_new.close)
+        try:
+            return _compare(_old, _new)
+        except VerifyE as exception:
+            raise DiffE(exception.msg)
+        except (KeyError, TypeError, AttributeError):
+            raise DiffE("manifest records an invalid tree")
@@ -0,0 +1,515 @@
+import contextlib
+import json
+import queue
+import shutil
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from package_wrapper.archiver.archiver import (
+    TAR_TYPES,
+    Archive,
+    ArchiveE,
+    archive_type_from_file_name,
+    member_path,
+)
+from package_wrapper.manifest.filehash import (
+    DEFAULT_CHUNK_SIZE,
+    SHA256,
+    FileHashE,
+    file_hash_create,
+    new_hasher,
+)
+from package_wrapper.manifest.manifest import MANIFEST_NAME
+from package_wrapper.verify.verify import (
+    VerifyE,
+    VerifyResult,
+    compare_digests,
+    load_manifest_bytes,
+    manifest_index,
+)
+
+# chunks of member data the write-behind thread may fall behind the reader
+WRITE_BEHIND_DEPTH = 16
+
+
+class ExtractE(BaseException):
+    """
+    Basic exception for extraction related tasks
+    """
+
+    def __init__(self, msg: str):
+        super(ExtractE, self).__init__()
+        self.msg = msg
+
+
+def _open_destination(destination: Path):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    if destination.is_symlink() or destination.is_file():
+        # never write through a link left in the output directory
+        destination.unlink()
+    return open(destination, "wb")
+
+
+def _write_member(file_pointer, destination: Path, hash_method: str, chunk_size: int):
+    """
+    write a member to destination, hashing it on the way
+    :return: "method:hash" of the written contents
+    """
+    hasher = new_hasher(hash_method)
+    with _open_destination(destination) as target:
+        while True:
+            _data = file_pointer.read(chunk_size)
+            if not _data:
+                break
+            hasher.update(_data)
+            target.write(_data)
+    return hash_method.lower() + ":" + hasher.hexdigest()
+
+
+def _copy_member(out_dir: Path, source: str, name: str, hash_method: str, chunk_size):
+    with open(member_path(out_dir, source), "rb") as file_pointer:
+        return _write_member(
+            file_pointer, member_path(out_dir, name), hash_method, chunk_size
+        )
+
+
+def _method(index: Dict[str, str], name: str) -> str:
+    if index is None or name not in index:
+        return SHA256.lower()
+    return index[name].split(":", 1)[0].lower()
+
+
+class _WriteBehind:
+    """
+    Writes and hashes member data on a separate thread, so reading and
+    decompressing the archive overlaps with writing the files. At most depth
+    chunks wait in the queue, a reader faster than the disk is held back.
+    """
+
+    def __init__(self, depth: int = WRITE_BEHIND_DEPTH):
+        self.queue = queue.Queue(maxsize=depth)
+        self.digests = {}
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        if self.error is not None:
+            raise ExtractE(self.error)
+        self.queue.put(item)
+
+    def write_member(
+        self, name: str, file_pointer, destination: Path, hash_method: str, chunk_size
+    ):
+        self._put(("open", name, destination, hash_method))
+        while True:
+            _data = file_pointer.read(chunk_size)
+            if not _data:
+                break
+            self._put(("data", _data))
+        self._put(("close",))
+
+    def _run(self):
+        target = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # the reader may have stopped in the middle of a member
+                _close_quietly(target)
+                break
+            if self.error is not None or self.aborted:
+                # keep draining, the reader stops at its next put
+                continue
+            try:
+                if item[0] == "open":
+                    _, _name, destination, _method = item
+                    hasher = new_hasher(_method)
+                    target = _open_destination(destination)
+                elif item[0] == "data":
+                    hasher.update(item[1])
+                    target.write(item[1])
+                else:
+                    target.close()
+                    target = None
+                    self.digests[_name] = _method.lower() + ":" + hasher.hexdigest()
+            except (Exception, FileHashE) as exception:
+                # any failure, the thread must live on to drain the queue or
+                # the reader blocks once it is full
+                self.error = getattr(exception, "msg", None) or str(exception)
+                _close_quietly(target)
+                target = None
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise ExtractE(self.error)
+
+    def abort(self):
+        """
+        Stop after the reader failed: the queued chunks are dropped and the open
+        file is closed. Never raises, the error of the reader is the one reported.
+        """
+        self.aborted = True
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _close_quietly(target):
+    if target is not None:
+        try:
+            target.close()
+        except OSError:
+            pass
+
+
+def _load_manifest(archive: Archive):
+    """
+    :return: manifest contents and the member offsets of a seekable tar.gz, None
+        when the archive is not seekable
+    """
+    _offset = archive.seekable_manifest_offset()
+    if _offset is None:
+        _contents = load_manifest_bytes(archive.archive)
+        return _contents, None
+    with archive.open_member_at(_offset) as (member, file_pointer):
+        if member.name != MANIFEST_NAME:
+            raise ExtractE(
+                "the trailer of %s does not point to its manifest" % archive.archive
+            )
+        _contents = file_pointer.read()
+    return _contents, json.loads(_contents).get("package-wrapper", {}).get("index")
+
+
+def _extract_at(
+    archive: Archive,
+    offset: int,
+    names: List[str],
+    index: Dict[str, str],
+    out_dir: Path,
+    chunk_size: int,
+) -> Dict[str, str]:
+    """
+    extract the member starting at offset of a seekable tar.gz to every name
+    sharing it (the file and the hard links to it)
+    :return: name to "method:hash" of the written files
+    """
+    digests = {}
+    with archive.open_member_at(offset) as (member, file_pointer):
+        _first, *_others = names
+        digests[_first] = _write_member(
+            file_pointer,
+            member_path(out_dir, _first),
+            _method(index, _first),
+            chunk_size,
+        )
+    for _other in _others:
+        digests[_other] = _copy_member(
+            out_dir, _first, _other, _method(index, _other), chunk_size
+        )
+    return digests
+
+
+def _extract_seeking(
+    archive: Archive,
+    names: List[str],
+    offsets: Dict[str, int],
+    index: Dict[str, str],
+    out_dir: Path,
+    jobs: int,
+    chunk_size: int,
+) -> Dict[str, str]:
+    # hard links share the offset of the file they link to, it is read once
+    _by_offset = {}
+    for _name in names:
+        if _name not in offsets:
+            raise ExtractE(
+                "%s is missing from the index of %s" % (_name, archive.archive)
+            )
+        _by_offset.setdefault(offsets[_name], []).append(_name)
+
+    digests = {}
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        for _digests in executor.map(
+            lambda _item: _extract_at(
+                archive, _item[0], _item[1], index, out_dir, chunk_size
+            ),
+            sorted(_by_offset.items()),
+        ):
+            digests.update(_digests)
+    return digests
+
+
+def _stream_members(
+    archive: Archive,
+    wanted: Dict[str, List[str]],
+    index: Dict[str, str],
+    out_dir: Path,
+    chunk_size: int,
+    digests: Dict[str, str],
+) -> Dict[str, str]:
+    """
+    one pass over the archive writing every wanted member to the names it maps to
+    :return: wanted members that are hard links, mapped to the member they link to
+    """
+    links = {}
+    with contextlib.closing(archive.iter_entries()) as entries:
+        for _name, file_pointer, _link in entries:
+            _name = Path(_name).as_posix()
+            if _name not in wanted:
+                continue
+            if _link is not None:
+                links[_name] = Path(_link).as_posix()
+                continue
+            _first, *_others = wanted[_name]
+            digests[_first] = _write_member(
+                file_pointer,
+                member_path(out_dir, _first),
+                _method(index, _first),
+                chunk_size,
+            )
+            for _other in _others:
+                digests[_other] = _copy_member(
+                    out_dir, _first, _other, _method(index, _other), chunk_size
+                )
+    return links
+
+
+def _extract_streaming(
+    archive: Archive,
+    names: List[str],
+    index: Dict[str, str],
+    out_dir: Path,
+    chunk_size: int,
+) -> Dict[str, str]:
+    digests = {}
+    _wanted = {_name: [_name] for _name in names}
+    links = _stream_members(archive, _wanted, index, out_dir, chunk_size, digests)
+    # a hard link points to an earlier member, which is read again unless it was
+    # extracted as well
+    _targets = {}
+    for _name, _target in links.items():
+        if _target in digests:
+            digests[_name] = _copy_member(
+                out_dir, _target, _name, _method(index, _name), chunk_size
+            )
+        else:
+            _targets.setdefault(_target, []).append(_name)
+    if _targets:
+        _stream_members(archive, _targets, index, out_dir, chunk_size, digests)
+    return digests
+
+
+def _extract_zip(
+    archive: Archive,
+    index: Dict[str, str],
+    out_dir: Path,
+    jobs: int,
+    chunk_size: int,
+) -> Dict[str, str]:
+    """
+    decompress the members of a zip archive on a thread pool, each worker reads
+    through its own handle of the archive
+    """
+    _local = threading.local()
+    _handles = []
+
+    def _extract_one(name: str):
+        zip_ref = getattr(_local, "zip_ref", None)
+        if zip_ref is None:
+            zip_ref = _local.zip_ref = zipfile.ZipFile(archive.archive)
+            _handles.append(zip_ref)
+        with zip_ref.open(name) as file_pointer:
+            return _write_member(
+                file_pointer,
+                member_path(out_dir, name),
+                _method(index, Path(name).as_posix()),
+                chunk_size,
+            )
+
+    with zipfile.ZipFile(archive.archive) as zip_ref:
+        names = [
+            info.filename
+            for info in zip_ref.infolist()
+            if not info.is_dir() and Path(info.filename).as_posix() != MANIFEST_NAME
+        ]
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            _digests = list(executor.map(_extract_one, names))
+    finally:
+        for zip_ref in _handles:
+            zip_ref.close()
+    return {Path(_name).as_posix(): _digest for _name, _digest in zip(names, _digests)}
+
+
+def _extract_tar(
+    archive: Archive, index: Dict[str, str], out_dir: Path, chunk_size: int
+):
+    """
+    stream the members of a tar ball once, writing and hashing them behind the
+    reader
+    :return: digests of the files and the manifest contents
+    """
+    manifest_contents = None
+    links = {}
+    writer = _WriteBehind()
+    try:
+        with contextlib.closing(archive.iter_entries()) as entries:
+            for _name, file_pointer, _link in entries:
+                _name = Path(_name).as_posix()
+                if _link is not None:
+                    links[_name] = Path(_link).as_posix()
+                elif _name == MANIFEST_NAME:
+                    manifest_contents = file_pointer.read()
+                else:
+                    writer.write_member(
+                        _name,
+                        file_pointer,
+                        member_path(out_dir, _name),
+                        _method(index, _name),
+                        chunk_size,
+                    )
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+    digests = writer.digests
+    # the linked member always comes first and is written by now
+    for _name, _target in links.items():
+        with open(member_path(out_dir, _target), "rb") as source:
+            with _open_destination(member_path(out_dir, _name)) as target:
+                shutil.copyfileobj(source, target, chunk_size)
+        digests[_name] = digests.get(_target)
+    return digests, manifest_contents
+
+
+def extract_package(
+    path: Path, out_dir: Path, jobs: int = 1, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> VerifyResult:
+    """
+    Extract a package archive and verify every file against its manifest in the
+    same pass, files are hashed while they are written.
+    Zip members and the members of a seekable tar.gz are decompressed on jobs
+    worker threads. Other tar balls are read sequentially, writing and hashing
+    happens on a separate thread behind a bounded queue. Their manifest is the
+    last member, files hashed with another method than assumed are hashed again
+    from disk.
+    :param path: package archive
+    :param out_dir: directory the package is extracted to
+    :param jobs: number of worker threads
+    :param chunk_size: size in bytes of each read while extracting
+    """
+    try:
+        archive = Archive(path, archive_type=archive_type_from_file_name(path))
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        manifest_contents = None
+        offsets = None
+        if archive.archive_type == "zip":
+            manifest_contents = load_manifest_bytes(path)
+        elif archive.archive_type == "tar.gz":
+            if archive.seekable_manifest_offset() is not None:
+                manifest_contents, offsets = _load_manifest(archive)
+        index = None
+        if manifest_contents is not None:
+            index = manifest_index(json.loads(manifest_contents))
+
+        if archive.archive_type == "zip":
+            digests = _extract_zip(archive, index, out_dir, jobs, chunk_size)
+        elif offsets is not None:
+            digests = _extract_seeking(
+                archive, sorted(offsets), offsets, index, out_dir, jobs, chunk_size
+            )
+        elif archive.archive_type in TAR_TYPES:
+            digests, manifest_contents = _extract_tar(
+                archive, index, out_dir, chunk_size
+            )
+        else:
+            raise ExtractE("unsupported file format")
+
+        if manifest_contents is None:
+            raise ExtractE("archive %s does not contain a manifest" % path)
+        out_dir.joinpath(MANIFEST_NAME).write_bytes(manifest_contents)
+        manifest = json.loads(manifest_contents)
+        index = manifest_index(manifest)
+
+        # tar members before the manifest were hashed with the default method
+        _rehash = [
+            _name
+            for _name, _digest in digests.items()
+            if _name in index
+            and _digest is not None
+            and _digest.split(":", 1)[0] != _method(index, _name)
+        ]
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            _hashes = executor.map(
+                lambda _name: file_hash_create(
+                    member_path(out_dir, _name), _method(index, _name), chunk_size
+                ),
+                _rehash,
+            )
+            for _name, _hash in zip(_rehash, _hashes):
+                digests[_name] = _method(index, _name) + ":" + _hash
+    except (ArchiveE, VerifyE, FileHashE) as exception:
+        raise ExtractE(exception.msg)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile, ValueError) as exception:
+        raise ExtractE(str(exception))
+
+    return compare_digests(manifest, digests)
+
+
+def extract_members(
+    path: Path,
+    members: List[str],
+    out_dir: Path,
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> VerifyResult:
+    """
+    Extract single files of a package and verify them against its manifest.
+    Members of a seekable tar.gz are decompressed on their own, starting at
+    the offset recorded in the manifest. Other archives are streamed until the
+    members are found.
+    :param path: package archive
+    :param members: paths of the files relative to the package root
+    :param out_dir: directory the files are written to, below their relative path
+    :param jobs: number of members of a seekable tar.gz decompressed in parallel
+    :param chunk_size: size in bytes of each read while extracting
+    :return: extracted files that match or mismatch their hash, and the
+        requested files the manifest does not list
+    """
+    try:
+        archive = Archive(path, archive_type=archive_type_from_file_name(path))
+        manifest_contents, offsets = _load_manifest(archive)
+        index = manifest_index(json.loads(manifest_contents))
+
+        _names = sorted(set(Path(_member).as_posix() for _member in members))
+        result = VerifyResult()
+        result.missing = [_name for _name in _names if _name not in index]
+        _names = [_name for _name in _names if _name in index]
+        if offsets is not None:
+            digests = _extract_seeking(
+                archive, _names, offsets, index, out_dir, jobs, chunk_size
+            )
+        else:
+            digests = _extract_streaming(archive, _names, index, out_dir, chunk_size)
+    except (ArchiveE, VerifyE, FileHashE) as exception:
+        raise ExtractE(exception.msg)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile, ValueError) as exception:
+        raise ExtractE(str(exception))
+
+    for _name in _names:
+        if _name not in digests:
+            result.missing.append(_name)
+        elif digests[_name].lower() == index[_name].lower():
+            result.matched.append(_name)
+        else:
+            result.mismatched.append(_name)
+    result.missing.sort()
+    return result
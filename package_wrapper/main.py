@@ -1,16 +1,63 @@
+import asyncio
 import click
 from pathlib import Path
 import json
+import os
+import signal
+import subprocess
+import threading
 from datetime import datetime
 
 from .version import __version__
 from .package import package as package_api
-from package_wrapper.archiver.archiver import Archive
-from package_wrapper.manifest.manifest import ManifestFile
-from package_wrapper.manifest.filehash import HASH_ALGORITHMS
+from package_wrapper.archiver.archiver import ARCHIVE_TYPES, Archive
+from package_wrapper.manifest.manifest import MANIFEST_NAME, ManifestFile
+from package_wrapper.manifest.filehash import (
+    HASH_ALGORITHMS,
+    FileHashE,
+    hash_methods,
+    new_hasher,
+)
+from package_wrapper.manifest.hashcache import (
+    DEFAULT_MAX_ENTRIES,
+    HashCache,
+    MemoryHashCache,
+)
+from package_wrapper.verify.verify import VerifyE, verify_package
+from package_wrapper.delta.delta import DeltaE, apply_delta
+from package_wrapper.diff.diff import DiffE, diff_packages
+from package_wrapper.batch.batch import BatchE, load_jobs, run_batch
+from package_wrapper.serve.client import ServeE
+from package_wrapper.serve.serve import PackageServer
+from package_wrapper.bench.bench import (
+    BENCHMARKS,
+    TREES,
+    BenchE,
+    compare_results,
+    result_key,
+    run_benchmarks,
+    tree_bytes,
+)
+from package_wrapper.chunkstore.chunkstore import ChunkStoreE, restore_files
+from package_wrapper.stats.stats import JsonSink, ProgressSink, Stats
+from package_wrapper.watch.watch import DirectoryWatcher, WatchE
+from package_wrapper.extract.extract import (
+    ExtractE,
+    extract_members,
+    extract_package,
+)
 
 
-@click.command()
+def _hash_type(ctx, param, value):
+    try:
+        # fails early when an optional hash package is missing
+        new_hasher(value)
+        return ",".join(hash_methods(value))
+    except FileHashE as exception:
+        raise click.BadParameter(exception.msg)
+
+
+@click.group(invoke_without_command=True)
 @click.option(
     "--directory",
     "-D",
@@ -21,8 +68,7 @@ from package_wrapper.manifest.filehash import HASH_ALGORITHMS
         resolve_path=True,
         path_type=Path,
     ),
-    required=True,
-    help="path to directory to package",
+    help="path to directory to package  [required unless a command is given]",
 )
 @click.option(
     "--meta-data",
@@ -42,30 +88,801 @@ from package_wrapper.manifest.filehash import HASH_ALGORITHMS
     "-o",
     type=click.Path(
         resolve_path=False,
+        allow_dash=True,
         path_type=Path,
     ),
-    help="path to wanted output file (example.tar.gz).\n Always overwrites files if exists",
+    help="path to wanted output file (example.tar.gz).\n Always overwrites files if exists. - streams a tar archive to stdout",
 )
 @click.option(
     "--hash-type",
     "-#",
-    type=click.Choice(HASH_ALGORITHMS, case_sensitive=False),
     default="sha256",
-    help="hash algorithm to use",
+    callback=_hash_type,
+    metavar="METHOD[,METHOD...]",
+    help=f"hash algorithm to use: {', '.join(HASH_ALGORITHMS)}. A comma separated list (sha256,blake2b,md5) records every digest of each file, all computed in the same read",
 )
 @click.option(
     "--archive-type",
     "-a",
-    type=click.Choice(["tar", "tar.gz", "zip"], case_sensitive=False),
+    type=click.Choice(ARCHIVE_TYPES, case_sensitive=False),
     help="compression algorithm to use. This overrides the -o /--output file name suffix",
 )
-def package(directory, meta_data, output, hash_type, archive_type):
+@click.option(
+    "--compression-level",
+    "-l",
+    type=int,
+    help="compression level for the archive type (gz, bz2, xz, zip: 0-9, zst: 1-22)",
+)
+@click.option(
+    "--compression-threads",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="number of compression threads, 0 uses one per CPU core. gz, bz2 and xz are then written as independently compressed blocks and zip members are deflated in parallel (zip on CPython 3.7 to 3.13 only)",
+)
+@click.option(
+    "--include",
+    multiple=True,
+    metavar="PATTERN",
+    help="only package files whose path relative to the directory matches the glob pattern, may be repeated",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    metavar="PATTERN",
+    help="leave out files and directories whose relative path matches the glob pattern, may be repeated",
+)
+@click.option(
+    "--base",
+    type=click.Path(exists=True, readable=True, resolve_path=True, path_type=Path),
+    help="previous package or its manifest.json. Creates a delta package holding only files added or changed since",
+)
+@click.option(
+    "--chunk-store",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help="store file contents as deduplicated content defined chunks in this directory instead of creating an archive, the output file is the manifest referencing them",
+)
+@click.option(
+    "--seekable",
+    is_flag=True,
+    help="write a tar.gz in which every file is compressed on its own and record the offsets in the manifest, so single files can be extracted without decompressing the files before them",
+)
+@click.option(
+    "--dedup/--no-dedup",
+    default=False,
+    show_default=True,
+    help="archive files identical to an earlier file as a hard link to it (tar), or reuse its compressed data (zip). Without --two-pass, files sharing their size with another file are then read twice",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="number of parallel hashing workers, 0 uses one per CPU core. Without --two-pass they read and hash files ahead of the archive writer",
+)
+@click.option(
+    "--processes",
+    "use_processes",
+    is_flag=True,
+    help="hash in worker processes instead of threads when files are hashed before archiving (--two-pass, --dedup)",
+)
+@click.option(
+    "--single-pass/--two-pass",
+    default=True,
+    show_default=True,
+    help="hash files while archiving them (one read per file), or hash all files first and archive them afterwards",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=False,
+    show_default=True,
+    help="reuse hashes of files unchanged since an earlier run (same path, size, mtime and inode)",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help="directory holding the hash cache, defaults to $XDG_CACHE_HOME/package-wrapper",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="number of file hashes kept in the cache before the least recently used are evicted",
+)
+@click.option(
+    "--rehash",
+    is_flag=True,
+    help="with --cache, ignore cached hashes, hash every file again and refresh the cache",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    help="show the progress of scanning, hashing and archiving and the time each stage took",
+)
+@click.option(
+    "--stats-out",
+    type=click.Path(dir_okay=False, resolve_path=True, path_type=Path),
+    help="write per stage wall and CPU time, throughput and the slowest files as JSON to this file",
+)
+@click.option(
+    "--record-stats",
+    is_flag=True,
+    help="record the per stage statistics in the package-wrapper block of the manifest",
+)
+@click.option(
+    "--compact-manifest",
+    is_flag=True,
+    help="write the manifest without indentation or whitespace",
+)
+@click.option(
+    "--stream-manifest",
+    is_flag=True,
+    help="keep the manifest entries serialized in a temporary file while hashing instead of in memory, for trees with millions of files",
+)
+@click.option(
+    "--binary-manifest",
+    is_flag=True,
+    help="also write manifest.bin into the directory, a sorted binary manifest that verify looks files up in without parsing it",
+)
+@click.option(
+    "--write-manifest/--no-write-manifest",
+    default=None,
+    help="write the manifest into the directory as well as into the package  [default: unless streaming to stdout]",
+)
+@click.pass_context
+def package(
+    ctx,
+    directory,
+    meta_data,
+    output,
+    hash_type,
+    archive_type,
+    compression_level,
+    compression_threads,
+    include,
+    exclude,
+    base,
+    chunk_store,
+    seekable,
+    dedup,
+    jobs,
+    use_processes,
+    single_pass,
+    use_cache,
+    cache_dir,
+    cache_size,
+    rehash,
+    progress,
+    stats_out,
+    record_stats,
+    compact_manifest,
+    stream_manifest,
+    binary_manifest,
+    write_manifest,
+):
     """
     Given a directory path and optional meta-information in a JSON formatted file.
     Creates a deliverable archive file containing both the files and a manifest
     with meta-data as well as file hashes for each file.
     """
-    package_api(directory, meta_data, output, hash_type, archive_type)
+    if ctx.invoked_subcommand is not None:
+        return
+    if directory is None:
+        raise click.UsageError("Missing option '--directory' / '-D'.")
+    if output is not None and str(output) == "-":
+        output = click.get_binary_stream("stdout")
+        if output.isatty():
+            raise click.UsageError("refusing to write an archive to a terminal")
+
+    hash_cache = None
+    if use_cache:
+        hash_cache = HashCache(cache_dir=cache_dir, max_entries=cache_size, rehash=rehash)
+    stats = None
+    if progress or stats_out or record_stats:
+        sinks = []
+        if progress:
+            sinks.append(ProgressSink())
+        if stats_out:
+            sinks.append(JsonSink(stats_out))
+        stats = Stats(sinks=sinks)
+    try:
+        package_api(
+            directory,
+            meta_data,
+            output,
+            hash_type,
+            archive_type,
+            jobs=jobs,
+            use_processes=use_processes,
+            single_pass=single_pass,
+            hash_cache=hash_cache,
+            compression_level=compression_level,
+            compression_threads=compression_threads,
+            include=include,
+            exclude=exclude,
+            base=base,
+            chunk_store=chunk_store,
+            dedup=dedup,
+            seekable=seekable,
+            stats=stats,
+            record_stats=record_stats,
+            compact_manifest=compact_manifest,
+            stream_manifest=stream_manifest,
+            binary_manifest=binary_manifest,
+            write_manifest=write_manifest,
+        )
+    finally:
+        # the timings of a failed run are written too
+        if stats is not None:
+            stats.close()
+        if hash_cache:
+            hash_cache.close()
+
+
+@package.command()
+@click.argument(
+    "path",
+    type=click.Path(exists=True, readable=True, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of files hashed in parallel, 0 uses one per CPU core",
+)
+def verify(path, jobs):
+    """
+    Verify a package against its manifest.
+
+    PATH is a package directory or archive containing a manifest. Missing,
+    extra and mismatching files are reported.
+    """
+    try:
+        result = verify_package(path, jobs=jobs or os.cpu_count() or 1)
+    except VerifyE as exception:
+        raise click.ClickException(exception.msg)
+
+    _report(result)
+
+
+def _report(result):
+    for _label, _files in (
+        ("missing", result.missing),
+        ("extra", result.extra),
+        ("mismatch", result.mismatched),
+    ):
+        for _file in _files:
+            click.echo(f"{_label}: {_file}")
+    click.echo(
+        f"{len(result.matched)} matched, {len(result.mismatched)} mismatched, "
+        f"{len(result.missing)} missing, {len(result.extra)} extra"
+    )
+    if not result.ok:
+        raise click.ClickException("verification failed")
+
+
+@package.command()
+@click.argument(
+    "base",
+    type=click.Path(exists=True, readable=True, resolve_path=True, path_type=Path),
+)
+@click.argument(
+    "delta",
+    type=click.Path(
+        exists=True, dir_okay=False, readable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.argument(
+    "output",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of files hashed in parallel, 0 uses one per CPU core",
+)
+def apply(base, delta, output, jobs):
+    """
+    Rebuild a full package from a delta package.
+
+    BASE is the package (archive or directory) the DELTA package was created
+    against, the full tree is written to the OUTPUT directory and verified.
+    Passing the same directory as BASE and OUTPUT applies the delta in place.
+    """
+    try:
+        result = apply_delta(base, delta, output, jobs=jobs or os.cpu_count() or 1)
+    except DeltaE as exception:
+        raise click.ClickException(exception.msg)
+    _report(result)
+
+
+@package.command()
+@click.argument(
+    "old",
+    type=click.Path(exists=True, readable=True, resolve_path=True, path_type=Path),
+)
+@click.argument(
+    "new",
+    type=click.Path(exists=True, readable=True, resolve_path=True, path_type=Path),
+)
+@click.pass_context
+def diff(ctx, old, new):
+    """
+    Compare the files of two packages.
+
+    OLD and NEW are package directories, archives or manifests. Files added,
+    removed and changed in NEW are listed, only the directories whose digests
+    differ in the two manifests are compared. Exits with status 1 if the
+    packages differ.
+    """
+    try:
+        result = diff_packages(old, new)
+    except DiffE as exception:
+        raise click.ClickException(exception.msg)
+
+    for _label in ("added", "removed", "changed"):
+        for _file in result[_label]:
+            click.echo(f"{_label}: {_file}")
+    click.echo(
+        f"{len(result['added'])} added, {len(result['removed'])} removed, "
+        f"{len(result['changed'])} changed"
+    )
+    if any(result.values()):
+        ctx.exit(1)
+
+
+@package.command()
+@click.argument(
+    "manifest",
+    type=click.Path(
+        exists=True, dir_okay=False, readable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.argument(
+    "output",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--chunk-store",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    required=True,
+    help="chunk store the package was written to",
+)
+def restore(manifest, output, chunk_store):
+    """
+    Rebuild a package kept in a chunk store.
+
+    MANIFEST is the output of packaging with --chunk-store, the files are
+    written to the OUTPUT directory and verified while they are written.
+    """
+    try:
+        result = restore_files(chunk_store, json.loads(manifest.read_bytes()), output)
+    except ChunkStoreE as exception:
+        raise click.ClickException(exception.msg)
+    output.joinpath(MANIFEST_NAME).write_bytes(manifest.read_bytes())
+    _report(result)
+
+
+@package.command()
+@click.argument(
+    "archive",
+    type=click.Path(
+        exists=True, dir_okay=False, readable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.argument(
+    "output",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+)
+@click.option(
+    "--member",
+    "members",
+    multiple=True,
+    metavar="PATH",
+    help="path of a file in the package to extract, may be repeated. Extracts the whole package when not given",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of zip and seekable tar.gz members decompressed in parallel, 0 uses one per CPU core",
+)
+def extract(archive, output, members, jobs):
+    """
+    Extract a package archive and verify it.
+
+    Every file is written below the OUTPUT directory and checked against the
+    manifest hash while it is written. With --member only the given files are
+    extracted, archives created with --seekable are then read only where the
+    files are stored.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    try:
+        if members:
+            result = extract_members(archive, members, output, jobs=jobs)
+        else:
+            result = extract_package(archive, output, jobs=jobs)
+    except ExtractE as exception:
+        raise click.ClickException(exception.msg)
+    _report(result)
+
+
+@package.command()
+@click.argument(
+    "job_file",
+    type=click.Path(
+        exists=True, dir_okay=False, readable=True, resolve_path=True, path_type=Path
+    ),
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of packages created in parallel, 0 uses one per CPU core",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=False,
+    show_default=True,
+    help="share a hash cache between all jobs and reuse hashes of files unchanged since an earlier run",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help="directory holding the hash cache, defaults to $XDG_CACHE_HOME/package-wrapper",
+)
+@click.option(
+    "--summary-out",
+    type=click.Path(dir_okay=False, resolve_path=True, path_type=Path),
+    help="write the summary of the batch and of every job as JSON to this file",
+)
+def batch(job_file, workers, use_cache, cache_dir, summary_out):
+    """
+    Create many packages in one run.
+
+    JOB_FILE is a JSON (or YAML) list of jobs, each with a directory and
+    optionally meta-data, output, hash-type, archive-type, compression-level,
+    include, exclude, base, seekable, dedup, compact-manifest, stream-manifest
+    and binary-manifest. All jobs run in this process in a shared pool of
+    workers. A failing job does not stop the others.
+    """
+    try:
+        jobs = load_jobs(job_file)
+    except BatchE as exception:
+        raise click.ClickException(exception.msg)
+
+    def _progress(result):
+        if result["error"] is None:
+            click.echo(
+                f"ok: {result['directory']} -> {result['output']} "
+                f"({result['files']} files, {result['wall']:.2f} s)"
+            )
+        else:
+            click.echo(f"failed: {result['directory']}: {result['error']}")
+
+    hash_cache = HashCache(cache_dir=cache_dir) if use_cache else None
+    try:
+        summary = run_batch(
+            jobs, workers=workers, hash_cache=hash_cache, progress=_progress
+        )
+    except BatchE as exception:
+        raise click.ClickException(exception.msg)
+    finally:
+        if hash_cache:
+            hash_cache.close()
+
+    click.echo(
+        f"{summary['packages']} packages, {summary['failed']} failed, "
+        f"{summary['files']} files in {summary['wall']:.2f} s, "
+        f"{summary['bytes per second'] / 1e6:.1f} MB/s"
+    )
+    if summary_out:
+        summary_out.write_text(json.dumps(summary, indent=3))
+    if summary["failed"]:
+        raise click.ClickException("%d packages failed" % summary["failed"])
+
+
+@package.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, resolve_path=True, path_type=Path),
+    help="Unix socket to listen on, defaults to $XDG_RUNTIME_DIR/pkgwrap-<uid>.sock",
+)
+@click.option(
+    "--workers",
+    "-w",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of jobs run in parallel, 0 uses one per CPU core",
+)
+@click.option(
+    "--index-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="number of file hashes kept in memory before the least recently used are evicted",
+)
+@click.option(
+    "--cache/--no-cache",
+    "use_cache",
+    default=False,
+    show_default=True,
+    help="back the in-memory index with the persistent hash cache, so it starts warm and outlives the server",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help="directory holding the hash cache, defaults to $XDG_CACHE_HOME/package-wrapper",
+)
+def serve(socket_path, workers, index_size, use_cache, cache_dir):
+    """
+    Create and verify packages for clients of a Unix socket.
+
+    Runs until stopped by a client or SIGINT / SIGTERM. Jobs are submitted with
+    pkgwrap-client and run in a shared pool of workers. Hashes of the files
+    seen are kept in memory, files unchanged since an earlier job are not hashed
+    again.
+    """
+    hash_cache = HashCache(cache_dir=cache_dir) if use_cache else None
+    index = MemoryHashCache(max_entries=index_size, persistent=hash_cache)
+    try:
+        server = PackageServer(socket_path, workers=workers, index=index)
+        asyncio.run(
+            server.serve(
+                ready=lambda: click.echo(f"listening on {server.socket_path}")
+            )
+        )
+    except ServeE as exception:
+        raise click.ClickException(exception.msg)
+    finally:
+        index.close()
+
+
+@package.command()
+@click.option(
+    "--directory",
+    "-D",
+    required=True,
+    type=click.Path(exists=True, file_okay=False, resolve_path=True, path_type=Path),
+    help="directory written by the build",
+)
+@click.option(
+    "--hash-type",
+    "-#",
+    default="sha256",
+    callback=_hash_type,
+    metavar="METHOD[,METHOD...]",
+    help="hash algorithm of the package created afterwards, hashes are cached per algorithm",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="number of files hashed in parallel, 0 uses one per CPU core",
+)
+@click.option(
+    "--cache-dir",
+    type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+    help="directory holding the hash cache, defaults to $XDG_CACHE_HOME/package-wrapper",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="number of file hashes kept in the cache before the least recently used are evicted",
+)
+@click.argument("command", nargs=-1, type=click.UNPROCESSED)
+@click.pass_context
+def watch(ctx, directory, hash_type, jobs, cache_dir, cache_size, command):
+    """
+    Hash files while a build writes them.
+
+    Every file closed after writing in the directory is hashed right away and
+    its hash journaled in the hash cache, packaging the directory afterwards
+    with --cache only hashes the files changed since. Runs until SIGINT /
+    SIGTERM or, when a COMMAND is given after --, until the command exits and
+    then exits with its status.
+    """
+    _returncode = 0
+    hash_cache = HashCache(cache_dir=cache_dir, max_entries=cache_size)
+    try:
+        watcher = DirectoryWatcher(
+            directory, hash_cache, hash_method=hash_type, jobs=jobs
+        )
+
+        def _run():
+            nonlocal _returncode
+            try:
+                _returncode = subprocess.call(command)
+            except OSError as exception:
+                click.echo(f"could not run {command[0]}: {exception}", err=True)
+                _returncode = 127
+            watcher.stop()
+
+        def _ready():
+            click.echo(f"watching {directory}")
+            if command:
+                threading.Thread(target=_run, daemon=True).start()
+
+        for _signal in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(_signal, lambda *_args: watcher.stop())
+        watcher.watch(ready=_ready)
+    except WatchE as exception:
+        raise click.ClickException(exception.msg)
+    finally:
+        hash_cache.close()
+    click.echo(f"{watcher.hashed} files hashed, {watcher.journaled} journaled")
+    ctx.exit(_returncode)
+
+
+@package.command()
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="write the results as JSON to this file",
+)
+@click.option(
+    "--tree",
+    "trees",
+    multiple=True,
+    type=click.Choice(list(TREES)),
+    help="synthetic tree to benchmark, may be repeated  [default: all]",
+)
+@click.option(
+    "--benchmark",
+    "benchmarks",
+    multiple=True,
+    type=click.Choice(BENCHMARKS),
+    help="benchmark to run, may be repeated  [default: all]",
+)
+@click.option(
+    "--hash-type",
+    "-#",
+    "hash_methods",
+    multiple=True,
+    type=click.Choice(HASH_ALGORITHMS, case_sensitive=False),
+    help="hash algorithm timed by the hash benchmark, may be repeated  [default: all available]",
+)
+@click.option(
+    "--archive-type",
+    "-a",
+    "archive_types",
+    multiple=True,
+    type=click.Choice(ARCHIVE_TYPES, case_sensitive=False),
+    help="archive type compressed, extracted and verified, may be repeated  [default: all available]",
+)
+@click.option(
+    "--scale",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    show_default=True,
+    help="size of the synthetic trees, 1.0 writes "
+    + ", ".join(
+        "%.3g MiB for %s" % (tree_bytes(_tree) / (1 << 20), _tree) for _tree in TREES
+    ),
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="runs of every benchmark, the fastest is reported",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="workers of the parallel code paths, 0 uses one per CPU core",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=0,
+    show_default=True,
+    help="seed of the generated file contents",
+)
+@click.option(
+    "--work-dir",
+    type=click.Path(exists=True, file_okay=False, writable=True, path_type=Path),
+    help="directory the synthetic trees are generated in, defaults to the system temporary directory",
+)
+@click.option(
+    "--compare",
+    "baseline",
+    type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
+    help="results of an earlier run, fails if any benchmark got slower than the threshold",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=0),
+    default=0.1,
+    show_default=True,
+    help="relative slowdown counted as a regression with --compare",
+)
+def bench(
+    output,
+    trees,
+    benchmarks,
+    hash_methods,
+    archive_types,
+    scale,
+    repeat,
+    jobs,
+    seed,
+    work_dir,
+    baseline,
+    threshold,
+):
+    """
+    Benchmark hashing, scanning, archiving and verifying.
+
+    Synthetic trees (many tiny files, a few huge files, deep nesting and
+    duplicate heavy trees) are generated from a fixed seed, so runs on the same
+    machine are comparable.
+    """
+    try:
+        results = run_benchmarks(
+            trees=trees,
+            benchmarks=benchmarks,
+            hash_methods=[_method.lower() for _method in hash_methods],
+            archive_types=[_type.lower() for _type in archive_types],
+            scale=scale,
+            repeat=repeat,
+            jobs=jobs or os.cpu_count() or 1,
+            seed=seed,
+            work_dir=work_dir,
+            progress=lambda _message: click.echo(_message, err=True),
+        )
+    except BenchE as exception:
+        raise click.ClickException(exception.msg)
+
+    for _result in results["results"]:
+        click.echo(
+            f"{result_key(_result)}: {_result['wall']:.3f} s, "
+            f"{_result['bytes per second'] / 1e6:.1f} MB/s, "
+            f"{_result['files per second']:.0f} files/s"
+        )
+    if output:
+        output.write_text(json.dumps(results, indent=3))
+
+    if baseline:
+        try:
+            comparison = compare_results(
+                json.loads(baseline.read_bytes()), results, threshold=threshold
+            )
+        except BenchE as exception:
+            raise click.ClickException(exception.msg)
+        _regressions = [_entry for _entry in comparison if _entry["regression"]]
+        for _entry in _regressions:
+            click.echo(
+                f"regression: {_entry['benchmark']} {_entry['baseline wall']:.3f} s"
+                f" -> {_entry['wall']:.3f} s"
+            )
+        if _regressions:
+            raise click.ClickException(
+                f"{len(_regressions)} of {len(comparison)} benchmarks got slower"
+            )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,275 @@
+import array
+import bisect
+import json
+import mmap
+import struct
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from package_wrapper.manifest.filehash import (
+    HASH_SEPARATOR,
+    FileHashE,
+    entry_digest,
+    hash_methods,
+    manifest_entry,
+    new_hasher,
+)
+from package_wrapper.manifest.manifest import ManifestE
+
+BINARY_MANIFEST_NAME = "manifest.bin"
+# Layout, all integers little endian:
+#   header   magic, version, number of hash methods, then for every method the
+#            length of its name, the name and the size of its digest in bytes
+#   entries  sorted like scan_directory(), each the length of the posix path,
+#            the UTF-8 path and the raw digests of all methods
+#   metadata the manifest without its files, as compact JSON
+#   table    offset of every entry
+#   footer   number of entries, offsets of the table and the metadata, length
+#            of the metadata and the magic again
+_MAGIC = b"PWMB"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHH")
+_METHOD = struct.Struct("<B")
+_DIGEST_SIZE = struct.Struct("<H")
+_PATH_SIZE = struct.Struct("<H")
+_FOOTER = struct.Struct("<QQQQ4s")
+
+
+def _path_key(posix_path: str) -> List[str]:
+    # same order as the directory scanner, "a/b" comes before "a-c"
+    return posix_path.split("/")
+
+
+def is_binary_manifest(path: Path) -> bool:
+    """
+    :return: True if path is a binary manifest, and not a file that happens to
+        have its name
+    """
+    try:
+        with open(path, "rb") as file_pointer:
+            return file_pointer.read(len(_MAGIC)) == _MAGIC
+    except OSError:
+        return False
+
+
+def write_binary_manifest(
+    path: Path,
+    hash_method: str,
+    meta_data: Dict,
+    files: Iterable[Tuple[str, object]],
+):
+    """
+    Write a manifest in the compact binary format, the files are streamed into
+    it and only the offset of every entry is kept in memory
+    :param hash_method: hash method of every file, a comma separated list for
+        files with several digests
+    :param meta_data: manifest contents except for the files
+    :param files: relative path and manifest entry of every file, sorted like
+        scan_directory() returns them
+    """
+    try:
+        _methods = hash_methods(hash_method)
+        _sizes = [len(new_hasher(_method).hexdigest()) // 2 for _method in _methods]
+    except FileHashE as exception:
+        raise ManifestE(exception.msg)
+    _digest_method = HASH_SEPARATOR.join(_methods)
+    _offsets = array.array("Q")
+    _last_key = None
+
+    with open(path, "wb") as file_pointer:
+        _header = _HEADER.pack(_MAGIC, _VERSION, len(_methods))
+        for _method, _size in zip(_methods, _sizes):
+            _name = _method.encode()
+            _header += _METHOD.pack(len(_name)) + _name + _DIGEST_SIZE.pack(_size)
+        file_pointer.write(_header)
+        _offset = len(_header)
+
+        for _path, _entry in files:
+            _posix = Path(_path).as_posix()
+            _key = _path_key(_posix)
+            if _last_key is not None and _key <= _last_key:
+                raise ManifestE(f"files must be sorted: {_posix}")
+            _last_key = _key
+            _method, _hashes = entry_digest(_entry).split(":", 1)
+            if _method.lower() != _digest_method:
+                raise ManifestE(f"{_posix} is not hashed with {hash_method}")
+            _digest = bytes.fromhex(_hashes.replace(HASH_SEPARATOR, ""))
+            if len(_digest) != sum(_sizes):
+                raise ManifestE(f"invalid digest of {_posix}")
+            _name = _posix.encode()
+            _record = _PATH_SIZE.pack(len(_name)) + _name + _digest
+            file_pointer.write(_record)
+            _offsets.append(_offset)
+            _offset += len(_record)
+
+        _meta_data = json.dumps(meta_data, separators=(",", ":")).encode()
+        file_pointer.write(_meta_data)
+        _table_offset = _offset + len(_meta_data)
+        file_pointer.write(_offsets.tobytes())
+        file_pointer.write(
+            _FOOTER.pack(len(_offsets), _table_offset, _offset, len(_meta_data), _MAGIC)
+        )
+
+
+class _EntryKeys:
+    """
+    Sequence of the sort keys of the entries, lets bisect search the memory map
+    """
+
+    def __init__(self, manifest: "BinaryManifest"):
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, index: int):
+        return _path_key(self.manifest.path_at(index))
+
+
+class BinaryManifest:
+    """
+    Read only view of a binary manifest through a memory map, entries are found
+    by a binary search without loading the whole manifest
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as file_pointer:
+            try:
+                self._map = mmap.mmap(file_pointer.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ManifestE(f"{path} is not a binary manifest")
+        try:
+            self._parse()
+        except (ManifestE, struct.error, UnicodeDecodeError):
+            self._map.close()
+            raise ManifestE(f"{path} is not a binary manifest")
+
+    def _parse(self):
+        if len(self._map) < _HEADER.size + _FOOTER.size:
+            raise ManifestE("too short")
+        _magic, _version, _count = _HEADER.unpack_from(self._map, 0)
+        if _magic != _MAGIC or _version != _VERSION:
+            raise ManifestE("unknown format")
+        _offset = _HEADER.size
+        self.methods = []
+        self._sizes = []
+        for _ in range(_count):
+            (_length,) = _METHOD.unpack_from(self._map, _offset)
+            _offset += _METHOD.size
+            self.methods.append(self._map[_offset : _offset + _length].decode())
+            _offset += _length
+            (_size,) = _DIGEST_SIZE.unpack_from(self._map, _offset)
+            _offset += _DIGEST_SIZE.size
+            self._sizes.append(_size)
+        (
+            self._count,
+            self._table_offset,
+            self._meta_data_offset,
+            self._meta_data_size,
+            _magic,
+        ) = _FOOTER.unpack_from(self._map, len(self._map) - _FOOTER.size)
+        if _magic != _MAGIC:
+            raise ManifestE("unknown format")
+        self._table = memoryview(self._map)[
+            self._table_offset : self._table_offset + 8 * self._count
+        ].cast("Q")
+
+    def close(self):
+        self._table.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _entry_at(self, index: int) -> Tuple[str, bytes]:
+        _offset = self._table[index]
+        (_length,) = _PATH_SIZE.unpack_from(self._map, _offset)
+        _offset += _PATH_SIZE.size
+        _path = self._map[_offset : _offset + _length].decode()
+        _offset += _length
+        return _path, self._map[_offset : _offset + sum(self._sizes)]
+
+    def path_at(self, index: int) -> str:
+        return self._entry_at(index)[0]
+
+    def _digest(self, digest: bytes) -> str:
+        _hashes = []
+        _offset = 0
+        for _size in self._sizes:
+            _hashes.append(digest[_offset : _offset + _size].hex())
+            _offset += _size
+        return HASH_SEPARATOR.join(self.methods) + ":" + HASH_SEPARATOR.join(_hashes)
+
+    def lookup(self, path: str) -> Optional[str]:
+        """
+        :param path: relative path of a file
+        :return: its "method:hash", methods and digests joined by commas for
+            several digests, None if the manifest does not list it
+        """
+        _posix = Path(path).as_posix()
+        _key = _path_key(_posix)
+        _index = bisect.bisect_left(_EntryKeys(self), _key)
+        if _index == self._count:
+            return None
+        _path, _digest = self._entry_at(_index)
+        if _path != _posix:
+            return None
+        return self._digest(_digest)
+
+    def directory_files(self, directory: str) -> Iterator[Tuple[str, str]]:
+        """
+        :param directory: posix path of a directory, "" for the root
+        :return: posix path and "method:hash" of the files directly in the
+            directory, its subdirectories are skipped by a binary search
+        """
+        _parts = directory.split("/") if directory else []
+        _keys = _EntryKeys(self)
+        _index = bisect.bisect_left(_keys, _parts)
+        while _index < self._count:
+            _path, _digest = self._entry_at(_index)
+            _key = _path_key(_path)
+            if _key[: len(_parts)] != _parts:
+                break
+            if len(_key) == len(_parts) + 1:
+                yield _path, self._digest(_digest)
+                _index += 1
+                continue
+            # no name contains a NUL, this sorts right after the subdirectory
+            _next = _key[: len(_parts)] + [_key[len(_parts)] + "\0"]
+            _index = bisect.bisect_left(_keys, _next, _index)
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        """
+        :return: posix path and "method:hash" of every file, sorted
+        """
+        for _index in range(self._count):
+            _path, _digest = self._entry_at(_index)
+            yield _path, self._digest(_digest)
+
+    def meta_data(self) -> Dict:
+        """
+        :return: the manifest contents except for the files
+        """
+        return json.loads(
+            self._map[
+                self._meta_data_offset : self._meta_data_offset + self._meta_data_size
+            ]
+        )
+
+    def as_dict(self) -> Dict:
+        """
+        :return: the manifest contents as in the JSON manifest
+        """
+        _hash_method = HASH_SEPARATOR.join(self.methods)
+        _files = {
+            _path: manifest_entry(_hash_method, _digest.split(":", 1)[1])
+            for _path, _digest in self
+        }
+        return dict(self.meta_data(), files=_files)
@@ -1,9 +1,83 @@
+import functools
 import hashlib
+import mmap
+import os
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, List, Dict, Union
+
+try:
+    import blake3
+except ImportError:  # pragma: no cover - optional dependency
+    blake3 = None
+try:
+    import xxhash
+except ImportError:  # pragma: no cover - optional dependency
+    xxhash = None
 
 SHA256 = "SHA256"
-HASH_ALGORITHMS = [
+# names of the registered hash backends, the tag recorded with every digest
+HASH_ALGORITHMS = []
+# several hash methods are given as a comma separated list, their digests are
+# computed in one read and joined the same way: "sha256,md5:<sha256>,<md5>"
+HASH_SEPARATOR = ","
+# size of the buffer each file is read through while hashing
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# files at least this large are hashed through a read-only memory map
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# BLAKE3 spreads a single update over all cores, updates need to be this large
+# for the threads to pay off
+BLAKE3_UPDATE_SIZE = 16 * 1024 * 1024
+
+
+class FileHashE(BaseException):
+    def __init__(self, msg: str):
+        super(FileHashE, self).__init__()
+        self.msg = msg
+
+
+class HashBackend:
+    """
+    A hash algorithm files can be hashed with, registered under the name that is
+    recorded in front of its digests
+    """
+
+    def __init__(self, name: str, constructor: Callable, update_size: int = 0):
+        """
+        :param constructor: returns an empty hash object with update() and
+            hexdigest(), raises FileHashE if the algorithm is not available
+        :param update_size: least number of bytes passed to update() at once,
+            for hashers that split large updates over several threads
+        """
+        self.name = name.lower()
+        self.constructor = constructor
+        self.update_size = update_size
+
+
+_HASH_BACKENDS: Dict[str, HashBackend] = {}
+
+
+def register_hash_backend(backend: HashBackend):
+    """
+    Make a hash algorithm available to manifests, verification and the command line
+    """
+    if backend.name not in _HASH_BACKENDS:
+        HASH_ALGORITHMS.append(backend.name)
+    _HASH_BACKENDS[backend.name] = backend
+
+
+def _blake3():
+    if blake3 is None:
+        raise FileHashE("blake3 hashes require the 'blake3' package")
+    return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+
+def _xxh3():
+    if xxhash is None:
+        raise FileHashE("xxh3 hashes require the 'xxhash' package")
+    return xxhash.xxh3_64()
+
+
+for _hashlib_name in (
     "sha1",
     "sha224",
     "sha256",
@@ -12,37 +86,212 @@ HASH_ALGORITHMS = [
     "blake2b",
     "blake2s",
     "md5",
-]
+):
+    register_hash_backend(HashBackend(_hashlib_name, getattr(hashlib, _hashlib_name)))
+# BLAKE3 hashes a single file on all cores
+register_hash_backend(HashBackend("blake3", _blake3, update_size=BLAKE3_UPDATE_SIZE))
+# xxh3 is not cryptographic, it only detects accidental corruption
+register_hash_backend(HashBackend("xxh3", _xxh3))
 
 
-class FileHashE(BaseException):
-    def __init__(self, msg: str):
-        super(FileHashE, self).__init__()
-        self.msg = msg
+def hash_methods(hash_method: str) -> List[str]:
+    """
+    :param hash_method: one of HASH_ALGORITHMS or a comma separated list of them
+    :return: the hash methods in lower case
+    """
+    _methods = [
+        _method.strip().lower() for _method in hash_method.split(HASH_SEPARATOR)
+    ]
+    for _method in _methods:
+        if _method not in HASH_ALGORITHMS:
+            raise FileHashE(
+                "hash method not yet implemented or recognized: %s" % _method
+            )
+    if len(set(_methods)) != len(_methods):
+        raise FileHashE("hash method listed twice: %s" % hash_method)
+    return _methods
+
+
+class _MultiHasher:
+    """
+    Feeds every chunk to the hashers of several methods, so all digests are
+    computed in the same read. The hex digests are joined by HASH_SEPARATOR.
+    """
+
+    def __init__(self, methods: List[str]):
+        self.hashers = [_HASH_BACKENDS[_method].constructor() for _method in methods]
+
+    def update(self, data):
+        for _hasher in self.hashers:
+            _hasher.update(data)
+
+    def hexdigest(self) -> str:
+        return HASH_SEPARATOR.join(_hasher.hexdigest() for _hasher in self.hashers)
+
+
+def _hash_constructor(hash_method: str):
+    _methods = hash_methods(hash_method)
+    if len(_methods) > 1:
+        return functools.partial(_MultiHasher, _methods)
+    return _HASH_BACKENDS[_methods[0]].constructor
+
+
+def _update_size(hash_method: str, chunk_size: int) -> int:
+    """
+    :return: chunk_size, raised to what the hash backends need to hash in parallel
+    """
+    return max(
+        [chunk_size]
+        + [_HASH_BACKENDS[_method].update_size for _method in hash_methods(hash_method)]
+    )
+
+
+def available_hash_methods() -> List[str]:
+    """
+    :return: the hash algorithms whose optional packages are installed
+    """
+    _available = []
+    for _method in HASH_ALGORITHMS:
+        try:
+            _HASH_BACKENDS[_method].constructor()
+        except FileHashE:
+            continue
+        _available.append(_method)
+    return _available
+
+
+def manifest_entry(hash_method: str, hash_string: str) -> Union[str, List[str]]:
+    """
+    :param hash_string: hex digest, joined digests for several hash methods
+    :return: "method:hash" as stored in the files of a manifest, a list of them
+        for several hash methods
+    """
+    _methods = hash_methods(hash_method)
+    if len(_methods) == 1:
+        return hash_method + ":" + hash_string
+    return [
+        _method + ":" + _hash
+        for _method, _hash in zip(_methods, hash_string.split(HASH_SEPARATOR))
+    ]
+
+
+def entry_digest(entry: Union[str, List[str]]) -> str:
+    """
+    :param entry: digest of a file as stored in a manifest, "method:hash" or a
+        list of them
+    :return: "method:hash", with the methods and hashes joined by
+        HASH_SEPARATOR for several digests
+    """
+    if isinstance(entry, str):
+        return entry
+    _methods, _hashes = zip(*(_digest.split(":", 1) for _digest in entry))
+    return HASH_SEPARATOR.join(_methods) + ":" + HASH_SEPARATOR.join(_hashes)
+
+
+def _hash_update_from_file(hasher, file_pointer, chunk_size: int):
+    """
+    feed the hasher from an open binary file, reading into one reused buffer
+    so memory use does not depend on the file size
+    """
+    _buffer = bytearray(chunk_size)
+    with memoryview(_buffer) as _view:
+        while True:
+            _size = file_pointer.readinto(_buffer)
+            if not _size:
+                break
+            hasher.update(_view[:_size])
+
+
+def _hash_update_from_mmap(hasher, file_pointer, file_size: int, chunk_size: int):
+    """
+    feed the hasher from a read-only memory map of the file, avoiding the copy
+    into a user space buffer
+    """
+    with mmap.mmap(file_pointer.fileno(), 0, access=mmap.ACCESS_READ) as _mapped:
+        if hasattr(_mapped, "madvise"):
+            _mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(_mapped) as _view:
+            for _offset in range(0, file_size, chunk_size):
+                hasher.update(_view[_offset : _offset + chunk_size])
+
+
+def new_hasher(hash_method: str = SHA256):
+    """
+    :return: an empty hash object for one of HASH_ALGORITHMS
+    """
+    return _hash_constructor(hash_method)()
+
+
+class HashingReader:
+    """
+    Wraps a binary file object and feeds every chunk read through it to a hasher,
+    so a file can be hashed while something else, like an archive writer, consumes it
+    """
+
+    def __init__(self, file_pointer, hash_method: str = SHA256):
+        self.file_pointer = file_pointer
+        self.hasher = _hash_constructor(hash_method)()
+
+    def read(self, size: int = -1) -> bytes:
+        _data = self.file_pointer.read(size)
+        self.hasher.update(_data)
+        return _data
 
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
 
-def file_hash_create(file_name: Path, hash_method: str = SHA256) -> str:
+
+def file_hash_create(
+    file_name: Path, hash_method: str = SHA256, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> str:
     """
-    create hash for a given file with a given hash method
+    create hash for a given file with a given hash method.
+    The file is streamed in chunks, large files through a memory map,
+    so memory use stays flat regardless of the file size
     :param file_name, path to file to be hashed
     :param hash_method, string describing the hash method, defaults to SHA256
+    :param chunk_size, size in bytes of each read fed to the hash method
     """
     if not file_name.exists():
         raise FileHashE("could not find any file named: %s" % file_name)
+    if chunk_size < 1:
+        raise FileHashE("invalid chunk size: %s" % chunk_size)
 
-    _bytes = file_name.read_bytes()
-    if hash_method.lower() in HASH_ALGORITHMS:
-        # getattr is used to 'capture' the right hashlib function with same name as the hash method.
-        _hash_algorithm = getattr(hashlib, hash_method.lower())
-        hash_string = _hash_algorithm(_bytes).hexdigest()
-    else:
-        raise FileHashE("hash method not yet implemented or recognized")
+    _hasher = _hash_constructor(hash_method)()
+    chunk_size = _update_size(hash_method, chunk_size)
+    with open(file_name, "rb") as file_pointer:
+        _size = os.fstat(file_pointer.fileno()).st_size
+        if _size >= MMAP_THRESHOLD:
+            _hash_update_from_mmap(_hasher, file_pointer, _size, chunk_size)
+        else:
+            _hash_update_from_file(_hasher, file_pointer, chunk_size)
+
+    return _hasher.hexdigest()
 
-    return hash_string
+
+def file_hash_create_from_file_object(
+    file_pointer, hash_method: str = SHA256, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> str:
+    """
+    create hash of everything that can be read from an open binary file object,
+    such as a member streamed out of an archive
+    :param file_pointer, binary file object supporting readinto
+    :param hash_method, string describing the hash method, defaults to SHA256
+    :param chunk_size, size in bytes of each read fed to the hash method
+    """
+    if chunk_size < 1:
+        raise FileHashE("invalid chunk size: %s" % chunk_size)
+
+    _hasher = _hash_constructor(hash_method)()
+    _hash_update_from_file(_hasher, file_pointer, chunk_size)
+    return _hasher.hexdigest()
 
 
 def file_hash_check(
-    file_name: Path, hash_string: str, hash_method: str = SHA256
+    file_name: Path,
+    hash_string: str,
+    hash_method: str = SHA256,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
 ) -> bool:
     """
     hash the file and compare the hash with hash string passed,
@@ -51,23 +300,29 @@ def file_hash_check(
     :param file_name:
     :param hash_method: string, defaults to SHA256
     :param hash_string: string, may contain : and algorithm
+    :param chunk_size: size in bytes of each read while hashing
     :return: True if matching, otherwise false, raises if file
             doesn't exist
     """
-    if hash_method.lower() not in HASH_ALGORITHMS:
+    try:
+        hash_methods(hash_method)
+    except FileHashE:
         raise FileHashE("invalid hash method received: %s" % hash_method)
 
     _str = str(hash_string)
     if _str.find(":") > -1:
-        _hash_string_elements = _str.split(":")
-        assert _hash_string_elements[0].lower() in HASH_ALGORITHMS
+        _hash_string_elements = _str.split(":", 1)
+        try:
+            hash_methods(_hash_string_elements[0])
+        except FileHashE:
+            raise FileHashE("invalid hash method received: %s" % _str)
         _method = _hash_string_elements[0].lower()
         _hash = _hash_string_elements[1]
     else:
         _method = hash_method
         _hash = hash_string
 
-    return file_hash_create(file_name, hash_method) == _hash
+    return file_hash_create(file_name, _method, chunk_size=chunk_size) == _hash
 
 
 def file_hash_create_hash_file(
@@ -112,28 +367,21 @@ def file_hash_check_hash_file(file_path: Path) -> Dict:
     _path_to_hash_file = file_path
     _path_to_dir = file_path.parent
 
-    # lists all files present in the folder tree starting with file_path
-    _directory_contents = [
-        _file
-        for _file in _path_to_dir.glob("**/*")
-        if _path_to_dir.joinpath(_file).is_file()
-    ]
+    # index the hash file once, each line is "METHOD:HASH PATH"
+    _index = {}
+    for line in _path_to_hash_file.read_text().splitlines():
+        if not line.strip():
+            continue
+        _hash_string, _file = line.split(" ", 1)
+        _index[_file] = _hash_string
 
     result = {}
-    _hash_lines = _path_to_hash_file.read_text().splitlines()
-    for line in _hash_lines:
-
-        if line.split()[1] not in _directory_contents:
+    for _file, _hash_string in _index.items():
+        _path = _path_to_dir.joinpath(Path(_file))
+        if not _path.is_file():
             raise FileHashE(
-                "Unable to locate the file "
-                + line.split()[1]
-                + " in the compressed archive"
+                "Unable to locate the file " + _file + " in the compressed archive"
             )
-
-        for file in _directory_contents:
-            if line.split()[1] == file:
-                result[file] = file_hash_check(
-                    _path_to_dir.joinpath(Path(file)), line.split()[0]
-                )
+        result[_file] = file_hash_check(_path, _hash_string)
 
     return result
@@ -0,0 +1,270 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+CACHE_FILE_NAME = "hashes.sqlite3"
+DEFAULT_MAX_ENTRIES = 1000000
+# files modified this close to the lookup are not cached, a change within the same
+# mtime tick would otherwise go unnoticed on file systems with coarse timestamps
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+# pending cache updates are written to disk in batches of this size
+_FLUSH_INTERVAL = 10000
+
+
+class HashCacheE(BaseException):
+    def __init__(self, msg: str):
+        super(HashCacheE, self).__init__()
+        self.msg = msg
+
+
+def default_cache_dir() -> Path:
+    _base = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+    return Path(_base).joinpath("package-wrapper")
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes, keyed on the absolute path, size, mtime_ns
+    and inode of each file together with the hash method used. Entries not used
+    for the longest time are evicted once the cache holds more than max_entries.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = None,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        rehash: bool = False,
+    ):
+        """
+        :param cache_dir: directory holding the cache database, created if missing
+        :param max_entries: number of file hashes kept before evicting the least recently used
+        :param rehash: ignore cached hashes, files are hashed again and the cache refreshed
+        """
+        if max_entries < 1:
+            raise HashCacheE("invalid cache size: %s" % max_entries)
+
+        self.cache_dir = Path(cache_dir) if cache_dir else default_cache_dir()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.rehash = rehash
+        self._lock = threading.Lock()
+        self._used = []
+        self._stored = []
+        self._connection = sqlite3.connect(
+            str(self.cache_dir.joinpath(CACHE_FILE_NAME)), check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            " path TEXT NOT NULL,"
+            " hash_method TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " inode INTEGER NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " last_used INTEGER NOT NULL,"
+            " PRIMARY KEY (path, hash_method))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def stat_key(path_to_file: Path) -> Tuple[str, int, int, int]:
+        """
+        stat the file before hashing it, the returned key is what the hash is stored under
+        """
+        _stat = os.stat(path_to_file)
+        return (
+            str(Path(path_to_file).absolute()),
+            _stat.st_size,
+            _stat.st_mtime_ns,
+            _stat.st_ino,
+        )
+
+    @staticmethod
+    def entry_key(path_to_file: Path, entry) -> Tuple[str, int, int, int]:
+        """
+        key for a file already stat'ed by the directory scanner
+        :param entry: ScanEntry of the file
+        """
+        return (
+            str(Path(path_to_file).absolute()),
+            entry.size,
+            entry.mtime_ns,
+            entry.inode,
+        )
+
+    def lookup(
+        self, key: Tuple[str, int, int, int], hash_method: str
+    ) -> Optional[str]:
+        """
+        :return: the cached hash if the file is unchanged since it was stored, otherwise None
+        """
+        if self.rehash:
+            return None
+
+        _path, _size, _mtime_ns, _inode = key
+        with self._lock:
+            _row = self._connection.execute(
+                "SELECT hash FROM hashes WHERE path = ? AND hash_method = ?"
+                " AND size = ? AND mtime_ns = ? AND inode = ?",
+                (_path, hash_method.lower(), _size, _mtime_ns, _inode),
+            ).fetchone()
+            if _row is None:
+                return None
+            self._used.append((time.time_ns(), _path, hash_method.lower()))
+            self._flush_if_needed()
+        return _row[0]
+
+    def store(
+        self, key: Tuple[str, int, int, int], hash_method: str, hash_string: str
+    ):
+        _path, _size, _mtime_ns, _inode = key
+        _now = time.time_ns()
+        if _now - _mtime_ns < RACY_WINDOW_NS:
+            return
+
+        with self._lock:
+            self._stored.append(
+                (
+                    _path,
+                    hash_method.lower(),
+                    _size,
+                    _mtime_ns,
+                    _inode,
+                    hash_string,
+                    _now,
+                )
+            )
+            self._flush_if_needed()
+
+    def flush(self):
+        """
+        Write pending updates to disk, so other processes using the cache see them
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush_if_needed(self):
+        if len(self._used) + len(self._stored) >= _FLUSH_INTERVAL:
+            self._flush()
+
+    def _flush(self):
+        self._connection.executemany(
+            "UPDATE hashes SET last_used = ? WHERE path = ? AND hash_method = ?",
+            self._used,
+        )
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", self._stored
+        )
+        self._connection.commit()
+        self._used = []
+        self._stored = []
+
+    def _evict(self):
+        (_count,) = self._connection.execute("SELECT COUNT(*) FROM hashes").fetchone()
+        if _count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM hashes WHERE rowid IN"
+                " (SELECT rowid FROM hashes ORDER BY last_used ASC LIMIT ?)",
+                (_count - self.max_entries,),
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._evict()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MemoryHashCache:
+    """
+    In-memory index of file hashes for a process packaging the same trees over
+    and over (pkgwrap serve), with the interface of HashCache. Entries are kept
+    under the same key and evicted least recently used first. An optional
+    persistent HashCache is looked up on a miss and receives every new hash,
+    so the index starts warm and outlives the process.
+    """
+
+    stat_key = staticmethod(HashCache.stat_key)
+    entry_key = staticmethod(HashCache.entry_key)
+
+    def __init__(
+        self, max_entries: int = DEFAULT_MAX_ENTRIES, persistent: HashCache = None
+    ):
+        """
+        :param max_entries: number of file hashes kept before evicting the least recently used
+        :param persistent: optional persistent cache behind the index
+        """
+        if max_entries < 1:
+            raise HashCacheE("invalid cache size: %s" % max_entries)
+
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        # (path, hash method) to (size, mtime_ns, inode, hash)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(
+        self, key: Tuple[str, int, int, int], hash_method: str
+    ) -> Optional[str]:
+        """
+        :return: the hash if the file is unchanged since it was stored, otherwise None
+        """
+        _path, _size, _mtime_ns, _inode = key
+        _index_key = (_path, hash_method.lower())
+        with self._lock:
+            _entry = self._entries.get(_index_key)
+            if _entry is not None and _entry[:3] == (_size, _mtime_ns, _inode):
+                self._entries.move_to_end(_index_key)
+                return _entry[3]
+
+        if self.persistent is None:
+            return None
+        _hash = self.persistent.lookup(key, hash_method)
+        if _hash is not None:
+            self._add(key, hash_method, _hash)
+        return _hash
+
+    def store(
+        self, key: Tuple[str, int, int, int], hash_method: str, hash_string: str
+    ):
+        if time.time_ns() - key[2] < RACY_WINDOW_NS:
+            return
+        self._add(key, hash_method, hash_string)
+        if self.persistent is not None:
+            self.persistent.store(key, hash_method, hash_string)
+
+    def _add(self, key: Tuple[str, int, int, int], hash_method: str, hash_string: str):
+        _path, _size, _mtime_ns, _inode = key
+        _index_key = (_path, hash_method.lower())
+        with self._lock:
+            self._entries[_index_key] = (_size, _mtime_ns, _inode, hash_string)
+            self._entries.move_to_end(_index_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def close(self):
+        if self.persistent is not None:
+            self.persistent.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
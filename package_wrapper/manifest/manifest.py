@@ -1,12 +1,30 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import io
 import json
+import os
+import struct
+import tempfile
+import time
 
 from package_wrapper.manifest.filehash import (
+    DEFAULT_CHUNK_SIZE,
+    entry_digest,
     file_hash_create,
     file_hash_check,
     FileHashE,
+    hash_methods,
+    manifest_entry,
+    new_hasher,
 )
 from package_wrapper.manifest.filehash import file_hash_create_hash_file
+from package_wrapper.manifest.hashcache import HashCache
+from package_wrapper.scanner.scanner import ScanEntry, ScannerE, scan_directory
+
+MANIFEST_NAME = "manifest.json"
+# indentation of the JSON manifest, None writes it without any whitespace
+DEFAULT_INDENT = 3
 
 
 class ManifestE(BaseException):
@@ -19,14 +37,157 @@ class ManifestE(BaseException):
         self.msg = msg
 
 
+def _dumps(contents, indent: Optional[int]) -> str:
+    if indent is None:
+        return json.dumps(contents, separators=(",", ":"))
+    return json.dumps(contents, indent=indent)
+
+
+class _FileSpool:
+    """
+    Keeps the files of a manifest in a temporary file instead of memory. Every
+    entry is stored serialized the way it is written into the manifest, so
+    writing the manifest is a copy.
+    """
+
+    def __init__(self, indent: Optional[int]):
+        self.indent = indent
+        self.count = 0
+        self._last_key = None
+        self._file = tempfile.TemporaryFile()
+
+    def add(self, rel_file_path: str, entry):
+        # same order as the directory scanner, "a/b" comes before "a-c"
+        _key = rel_file_path.split(os.sep)
+        if self._last_key is not None and _key <= self._last_key:
+            if _key == self._last_key:
+                raise ManifestE(f"duplicated file: {rel_file_path}")
+            raise ManifestE(f"files must be added in sorted order: {rel_file_path}")
+        self._last_key = _key
+
+        _separator = ":" if self.indent is None else ": "
+        _entry = _dumps(entry, self.indent)
+        if self.indent is not None:
+            # entries are nested two levels deep in the manifest
+            _entry = _entry.replace("\n", "\n" + " " * 2 * self.indent)
+        _fragment = (json.dumps(rel_file_path) + _separator + _entry).encode()
+        self._file.write(struct.pack("<I", len(_fragment)) + _fragment)
+        self.count += 1
+
+    def fragments(self) -> Iterator[bytes]:
+        self._file.seek(0)
+        for _ in range(self.count):
+            (_size,) = struct.unpack("<I", self._file.read(4))
+            yield self._file.read(_size)
+        self._file.seek(0, os.SEEK_END)
+
+    def items(self) -> Iterator[Tuple[str, object]]:
+        for _fragment in self.fragments():
+            ((_path, _entry),) = json.loads(b"{" + _fragment + b"}").items()
+            yield _path, _entry
+
+
+def _tree_node(kind: bytes, name: str, digest: str) -> bytes:
+    return kind + b" " + name.encode() + b"\0" + digest.encode() + b"\0"
+
+
+def merkle_tree(files: Iterable[Tuple[str, str]], hash_method: str) -> Dict:
+    """
+    Digest every directory from the digests of the files and subdirectories it
+    contains, the root digest changes with any file of the tree
+    :param files: posix path and "method:hash" of every file, sorted like
+        scan_directory() returns them
+    :param hash_method: hash algorithm of the directory digests
+    :return: the "hash method", the "root" digest and the digest of every
+        other directory by its posix path in "directories"
+    """
+    _directories = {}
+    # directories from the root down to the one the last file is in
+    _stack = [([], new_hasher(hash_method))]
+
+    def _close_directory():
+        _path, _hasher = _stack.pop()
+        _digest = _hasher.hexdigest()
+        _directories["/".join(_path)] = _digest
+        _stack[-1][1].update(_tree_node(b"d", _path[-1], _digest))
+
+    _last = None
+    for _path, _digest in files:
+        _parts = _path.split("/")
+        if _last is not None and _parts <= _last:
+            raise ManifestE(f"files must be sorted: {_path}")
+        _last = _parts
+        while _stack[-1][0] != _parts[: len(_stack) - 1]:
+            _close_directory()
+        for _depth in range(len(_stack), len(_parts)):
+            _stack.append((_parts[:_depth], new_hasher(hash_method)))
+        _stack[-1][1].update(_tree_node(b"f", _parts[-1], _digest))
+    while len(_stack) > 1:
+        _close_directory()
+
+    return {
+        "hash method": hash_method,
+        "root": _stack[0][1].hexdigest(),
+        "directories": _directories,
+    }
+
+
+def _hash_artifact(path_to_file: Path, hash_method: str, chunk_size: int):
+    """
+    Worker used by the hashing pools, returns (hash, None, seconds) or
+    (None, error message, seconds) so that failures survive the trip back from a
+    worker process
+    """
+    _start = time.perf_counter()
+    try:
+        _hash = file_hash_create(
+            file_name=path_to_file, hash_method=hash_method, chunk_size=chunk_size
+        )
+        return _hash, None, time.perf_counter() - _start
+    except FileHashE as exception:
+        return None, exception.msg, time.perf_counter() - _start
+
+
 class ManifestFile:
     """
     Handle a manifest file that contains a list of artifacts (path to file, optional hash sum)
     """
 
-    def __init__(self, hash_method="sha256"):
+    def __init__(
+        self,
+        hash_method="sha256",
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        jobs: int = 1,
+        use_processes: bool = False,
+        cache: HashCache = None,
+        stats=None,
+        indent: Optional[int] = DEFAULT_INDENT,
+        spool: bool = False,
+    ):
+        """
+        :param hash_method: hash algorithm used for every artifact, a comma separated
+            list computes several digests of every artifact in the same read
+        :param chunk_size: size in bytes of each read while hashing
+        :param jobs: number of parallel hashing workers, 0 means one per core
+        :param use_processes: hash in a process pool instead of a thread pool
+        :param cache: optional persistent hash cache, unchanged files are not rehashed
+        :param stats: optional Stats, every hashed file is reported to its running stage
+        :param indent: indentation of the written manifest, None for no whitespace
+        :param spool: keep the files in a temporary file instead of memory and
+            serialize every entry when it is added, for trees with millions of files.
+            Files must then be added sorted like scan_directory() returns them.
+        """
+        if jobs < 0:
+            raise ManifestE(f"invalid number of jobs: {jobs}")
         self.database = dict()
         self.hash_method = hash_method
+        self.chunk_size = chunk_size
+        self.jobs = jobs or os.cpu_count() or 1
+        self.use_processes = use_processes
+        self.cache = cache
+        self.stats = stats
+        self.indent = indent
+        self._spool = _FileSpool(indent) if spool else None
 
     def add_meta_data(self, keyword: str, content):
         self.database[keyword] = content
@@ -36,63 +197,255 @@ class ManifestFile:
         for key, value in data.items():
             self.add_meta_data(keyword=key, content=value)
 
-    def add_folder(self, path_to_directory: Path):
+    def add_folder(self, path_to_directory: Path, entries: List[ScanEntry] = None):
         """
         Adds all files found in a certain folder to the manifest
         database
         :param path_to_directory:
+        :param entries: result of scan_directory() for the folder, scanned when not given
         :return: True if succeeded, otherwise False
         """
 
         if not path_to_directory.is_dir():
             raise ManifestE("No such directory")
 
-        files = [
-            _file
-            for _file in path_to_directory.glob("**/*")
-            if path_to_directory.joinpath(_file).is_file()
-        ]
+        if entries is None:
+            try:
+                entries = scan_directory(path_to_directory)
+            except ScannerE as exception:
+                raise ManifestE(exception.msg)
+
+        _hashes = self.hash_entries(path_to_directory, entries)
 
-        for file in files:
-            _abs_path = file.absolute()
-            self.add_artifact_to_db(_abs_path, path_to_directory)
+        # files are recorded in scan order, keeping the manifest identical to a serial run
+        for entry, _hash in zip(entries, _hashes):
+            self.add_artifact_hash(Path(entry.relpath), _hash)
 
         return True
 
+    def hash_entries(self, path_to_directory: Path, entries: List[ScanEntry]):
+        """
+        Hash files of a folder without recording them in the manifest, using the
+        cache and the configured workers
+        :param path_to_directory: folder the entries were scanned in
+        :param entries: files to hash, as returned by scan_directory()
+        :return: hex digests in the order of entries
+        """
+        path_to_directory = path_to_directory.absolute()
+        files = [path_to_directory.joinpath(entry.relpath) for entry in entries]
+        _keys = []
+        _hashes = []
+        for file, entry in zip(files, entries):
+            _key, _hash = self._lookup_cache(file, entry)
+            _keys.append(_key)
+            _hashes.append(_hash)
+            if _hash is not None and self.stats is not None:
+                self.stats.file_done(entry.relpath, entry.size)
+        _pending = [index for index, _hash in enumerate(_hashes) if _hash is None]
+        _pending_files = [files[index] for index in _pending]
+
+        if self.jobs == 1:
+            results = map(
+                _hash_artifact,
+                _pending_files,
+                [self.hash_method] * len(_pending),
+                [self.chunk_size] * len(_pending),
+            )
+            self._collect(_pending, results, _keys, _hashes, entries)
+        else:
+            _executor = (
+                ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            )
+            with _executor(max_workers=self.jobs) as executor:
+                results = executor.map(
+                    _hash_artifact,
+                    _pending_files,
+                    [self.hash_method] * len(_pending),
+                    [self.chunk_size] * len(_pending),
+                    chunksize=64 if self.use_processes else 1,
+                )
+                try:
+                    self._collect(_pending, results, _keys, _hashes, entries)
+                finally:
+                    # files not hashed yet are dropped when collecting is interrupted
+                    results.close()
+
+        return _hashes
+
+    def _collect(
+        self,
+        pending: List[int],
+        results,
+        keys: List,
+        hashes: List,
+        entries: List[ScanEntry],
+    ):
+        for index, (_hash, _error, _seconds) in zip(pending, results):
+            if _error is not None:
+                raise ManifestE(_error)
+            hashes[index] = _hash
+            self._store_cache(keys[index], _hash)
+            if self.stats is not None:
+                self.stats.file_done(
+                    entries[index].relpath, entries[index].size, _seconds
+                )
+
+    def _lookup_cache(self, path_to_file: Path, entry: ScanEntry = None):
+        if self.cache is None:
+            return None, None
+        if entry is None:
+            _key = self.cache.stat_key(path_to_file)
+        else:
+            _key = self.cache.entry_key(path_to_file, entry)
+        return _key, self.cache.lookup(_key, self.hash_method)
+
+    def _store_cache(self, key, hash_string: str):
+        if self.cache is not None:
+            self.cache.store(key, self.hash_method, hash_string)
+
     def add_artifact_to_db(self, path_to_file: Path, base_path: Path):
+        if not path_to_file.is_file():
+            raise ManifestE("could not find any file named: %s" % path_to_file)
+
+        _key, _hash = self._lookup_cache(path_to_file)
+        if _hash is None:
+            _hash, _error, _seconds = _hash_artifact(
+                path_to_file, self.hash_method, self.chunk_size
+            )
+            if _error is not None:
+                raise ManifestE(_error)
+            self._store_cache(_key, _hash)
+
+        rel_file_path = Path.relative_to(path_to_file, base_path)
+        return self.add_artifact_hash(rel_file_path, _hash)
+
+    def add_artifact_hash(self, rel_file_path: Path, hash_string: str):
+        """
+        Record an already computed hash for a file relative to the packaged directory
+        :param rel_file_path: path of the artifact relative to the package root
+        :param hash_string: hex digest created with the manifest hash method, the
+            digests joined by commas for several hash methods
+        :return: True if succeeded
+        """
+        _entry = manifest_entry(self.hash_method, hash_string)
+        if self._spool is not None:
+            self._spool.add(str(rel_file_path), _entry)
+            return True
+
         if "files" not in self.database.keys():
             self.database["files"] = dict()
 
-        _hash = None
-        if path_to_file in self.database.keys():
-            raise ManifestE("duplicated file: {path_to_file}")
+        if str(rel_file_path) in self.database["files"]:
+            raise ManifestE(f"duplicated file: {rel_file_path}")
+
+        self.database["files"][str(rel_file_path)] = _entry
+
+        return True
 
-        try:
-            _hash = (
-                self.hash_method
-                + ":"
-                + file_hash_create(file_name=path_to_file, hash_method=self.hash_method)
+    def iter_files(self) -> Iterator[Tuple[str, object]]:
+        """
+        :return: relative path and manifest entry of every artifact, in the order
+            they were added
+        """
+        if self._spool is not None:
+            return self._spool.items()
+        return iter(self.database.get("files", {}).items())
+
+    def iter_digests(self) -> Iterator[Tuple[str, str]]:
+        """
+        :return: relative path and "method:hash" of every artifact, in the order
+            they were added, methods and digests are joined by commas for several
+            hash methods
+        """
+        return ((_path, entry_digest(_entry)) for _path, _entry in self.iter_files())
+
+    def file_digests(self):
+        """
+        :return: relative path to "method:hash" of every artifact, see iter_digests()
+        """
+        return dict(self.iter_digests())
+
+    def merkle_tree(self) -> Dict:
+        """
+        :return: digests of every directory and of the root, see merkle_tree(),
+            using the first hash method of the manifest
+        """
+        _files = (
+            (Path(_path).as_posix(), entry_digest(_entry))
+            for _path, _entry in self.iter_files()
+        )
+        if self._spool is None:
+            # files may have been added in any order, spooled ones are sorted
+            _files = sorted(_files, key=lambda _file: _file[0].split("/"))
+        return merkle_tree(_files, hash_methods(self.hash_method)[0])
+
+    def write(self, file_pointer):
+        """
+        Write the manifest as JSON to a binary file object. Spooled files are
+        copied into it without holding the manifest in memory, they are written
+        after the meta-data.
+        """
+        if self._spool is None:
+            _encoder = json.JSONEncoder(
+                indent=self.indent,
+                separators=(",", ":") if self.indent is None else None,
             )
-        except FileHashE as exception:
-            raise ManifestE(exception.msg)
+            for _chunk in _encoder.iterencode(self.database):
+                file_pointer.write(_chunk.encode())
+            return
 
-        rel_file_path = Path.relative_to(path_to_file, base_path)
-        self.database["files"][str(rel_file_path)] = _hash
+        _head = _dumps(dict(self.database, files={}), self.indent)
+        if self.indent is None:
+            _open, _separator, _close = b"{", b",", b"}}"
+        else:
+            _newline = "\n" + " " * 2 * self.indent
+            _open = ("{" + _newline).encode()
+            _separator = ("," + _newline).encode()
+            _close = ("\n" + " " * self.indent + "}\n}").encode()
+        if not self._spool.count:
+            file_pointer.write(_head.encode())
+            return
+        # the empty files object closes the meta-data, the entries go inside it
+        file_pointer.write(_head[: _head.rindex("{}")].encode() + _open)
+        for index, _fragment in enumerate(self._spool.fragments()):
+            if index:
+                file_pointer.write(_separator)
+            file_pointer.write(_fragment)
+        file_pointer.write(_close)
 
-        return True
+    def serialize(self) -> bytes:
+        """
+        :return: the manifest as JSON
+        """
+        _buffer = io.BytesIO()
+        self.write(_buffer)
+        return _buffer.getvalue()
 
     def retrive_contents(self):
+        """
+        :return: the manifest contents, spooled files are loaded into memory
+        """
+        if self._spool is not None:
+            return dict(self.database, files=dict(self._spool.items()))
         return self.database
 
-    def check_hashes_in_db(self) -> bool:
+    def check_hashes_in_db(self, base_path: Path = None) -> bool:
+        """
+        Rehash every file in the manifest and compare with the recorded hash
+        :param base_path: directory the manifest paths are relative to, defaults
+            to the current working directory
+        :return: True if all files match, stops at the first mismatch
+        """
         _match = True
-        for _file in self.database["files"]:
-            (_hash_method, _hash_string) = self.database[_file].split(":")
+        for _file, _hash in self.iter_digests():
+            (_hash_method, _hash_string) = _hash.split(":", 1)
+            _path = Path(_file) if base_path is None else base_path.joinpath(_file)
             try:
                 _match = file_hash_check(
-                    file_name=Path(_file),
+                    file_name=_path,
                     hash_string=_hash_string,
                     hash_method=_hash_method,
+                    chunk_size=self.chunk_size,
                 )
             except FileHashE:
                 raise ManifestE(f"error when checking hash for {_file}")
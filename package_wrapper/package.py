@@ -1,47 +1,414 @@
+import asyncio
 import click
+import collections
+import contextlib
+import functools
+import io
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path
 import json
 from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
 
 from .version import __version__
-from package_wrapper.archiver.archiver import Archive
-from package_wrapper.manifest.manifest import ManifestFile
-from package_wrapper.manifest.filehash import HASH_ALGORITHMS
+from package_wrapper.archiver.archiver import (
+    Archive,
+    ArchiveE,
+    archive_type_from_file_name,
+    is_stream,
+)
+from package_wrapper.manifest.manifest import (
+    DEFAULT_INDENT,
+    MANIFEST_NAME,
+    ManifestE,
+    ManifestFile,
+)
+from package_wrapper.manifest.binary import (
+    BINARY_MANIFEST_NAME,
+    is_binary_manifest,
+    write_binary_manifest,
+)
+from package_wrapper.manifest.filehash import (
+    HASH_ALGORITHMS,
+    HashingReader,
+    new_hasher,
+)
+from package_wrapper.manifest.hashcache import HashCache
+from package_wrapper.chunkstore.chunkstore import (
+    CHUNK_STORE_TYPE,
+    ChunkStoreE,
+    store_files,
+)
+from package_wrapper.delta.delta import DeltaE, compute_delta, manifest_digest
+from package_wrapper.verify.verify import VerifyE, load_manifest_bytes
+from package_wrapper.scanner.scanner import ScanEntry, ScannerE, scan_directory
+from package_wrapper.stats.stats import Stage, Stats, StatsSink
+
+# least number of seconds between progress events of package_async()
+PROGRESS_INTERVAL = 0.1
+# bytes of the archived manifest kept in memory, larger ones go through a temporary file
+MANIFEST_SPOOL_SIZE = 16 << 20
+# largest file the hashing workers read ahead of the archive writer in a single
+# pass, larger files are hashed while they are archived
+READ_AHEAD_SIZE = 8 << 20
+
+
+class PackageE(BaseException):
+    """
+    Basic exception for packaging related tasks
+    """
+
+    def __init__(self, msg: str):
+        super(PackageE, self).__init__()
+        self.msg = msg
+
+
+class PackageCancelledE(PackageE):
+    """
+    Packaging was cancelled before it finished
+    """
 
 
 def get_compression_method_from_file_name(filename):
-    if str(filename).endswith(".tar.gz"):
-        compression_method = "tar.gz"
-    elif str(filename).endswith(".tar"):
-        compression_method = "tar"
-    elif str(filename).endswith(".zip"):
-        compression_method = "zip"
-    else:
+    try:
+        return archive_type_from_file_name(filename)
+    except ArchiveE:
         raise click.ClickException(
             "Could not determine compression method. Please specify parameter -a / --archive-type"
         )
-    return compression_method
 
 
-def package(directory, meta_data, output, hash_type, archive_type):
+def _record_manifest(manifest: ManifestFile, index=None, stats=None):
     """
-    Given a directory path and optional meta-information in a JSON formatted file.
-    Creates a deliverable archive file containing both the files and a manifest
-    with meta-data as well as file hashes for each file.
+    Records the Merkle tree of the files in the manifest
+    :param index: member offsets of a seekable archive, recorded in the manifest
+    :param stats: Stats of the run so far, recorded in the manifest
+    """
+    try:
+        manifest.database["package-wrapper"]["tree"] = manifest.merkle_tree()
+    except ManifestE as exception:
+        raise PackageE(exception.msg)
+    if index is not None:
+        manifest.database["package-wrapper"]["index"] = {
+            Path(_name).as_posix(): _offset for _name, _offset in index.items()
+        }
+    if stats is not None:
+        manifest.database["package-wrapper"]["stats"] = stats.as_dict()
+
+
+def _spool_manifest(manifest: ManifestFile, index=None, stats=None):
+    """
+    Records the Merkle tree of the files in the manifest and writes it into a
+    temporary file, which stays in memory up to MANIFEST_SPOOL_SIZE. Archives
+    read the manifest member from it, spooled files are copied without loading
+    the manifest.
+    :param index: member offsets of a seekable archive, recorded in the manifest
+    :param stats: Stats of the run so far, recorded in the manifest
+    :return: the temporary file, at its start
+    """
+    _record_manifest(manifest, index, stats)
+    _spooled = tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_SIZE)
+    manifest.write(_spooled)
+    _spooled.seek(0)
+    return _spooled
+
+
+def _write_manifests(directory: Path, manifest: ManifestFile, binary: bool = False):
+    """
+    Write the manifest into the packaged directory, streamed from the manifest
+    :param binary: also write the binary manifest next to it, otherwise a binary
+        manifest left by an earlier run is removed as it no longer matches
+    """
+    with open(directory.joinpath(MANIFEST_NAME), "wb") as file_pointer:
+        manifest.write(file_pointer)
+
+    _binary_path = directory.joinpath(BINARY_MANIFEST_NAME)
+    if binary:
+        _meta_data = {
+            _key: _value
+            for _key, _value in manifest.database.items()
+            if _key != "files"
+        }
+        try:
+            write_binary_manifest(
+                _binary_path, manifest.hash_method, _meta_data, manifest.iter_files()
+            )
+        except ManifestE as exception:
+            raise PackageE(exception.msg)
+    elif is_binary_manifest(_binary_path):
+        _binary_path.unlink()
+
+
+def _is_manifest(directory: Path, entry: ScanEntry) -> bool:
+    """
+    :return: True for the manifests of an earlier run, they are not packaged
+    """
+    if entry.relpath == MANIFEST_NAME:
+        return True
+    return entry.relpath == BINARY_MANIFEST_NAME and is_binary_manifest(
+        directory.joinpath(entry.relpath)
+    )
+
+
+def _stage(stats: Stats, name: str, entries: List[ScanEntry] = None):
+    """
+    :return: context timing a stage of the run, a no-op without stats
+    """
+    if stats is None:
+        return contextlib.nullcontext()
+    if entries is None:
+        return stats.stage(name)
+    return stats.stage(
+        name, files=len(entries), size=sum(entry.size for entry in entries)
+    )
+
+
+def _read_and_hash(path: Path, hash_method: str):
+    """
+    Read a whole file and hash it, run on the hashing workers ahead of the
+    archive writer
+    :return: contents of the file and its hex digest
+    """
+    with open(path, "rb") as file_pointer:
+        _data = file_pointer.read()
+    _hasher = new_hasher(hash_method)
+    _hasher.update(_data)
+    return _data, _hasher.hexdigest()
+
+
+def _archive_and_hash(
+    directory: Path,
+    entries: List[ScanEntry],
+    archive: Archive,
+    manifest: ManifestFile,
+    dedup: bool = False,
+    stats: Stats = None,
+    record_stats: bool = False,
+):
+    """
+    Single pass over the directory: every file is read once and its chunks feed
+    both the manifest hash and the archive writer. The manifest is added from a
+    temporary file as the last member of the archive.
+    With more than one job, files up to READ_AHEAD_SIZE are read and hashed by a
+    pool of worker threads ahead of the writer, which archives them from memory.
+    With dedup, files sharing their size with another file are hashed before
+    archiving, so duplicates can be archived as links to the first copy. Those
+    files are read twice.
+    :param record_stats: record the stats of the run up to writing the manifest in it
+    """
+    _known = {}
+    if dedup:
+        _sizes = collections.Counter(entry.size for entry in entries)
+        _candidates = [
+            entry for entry in entries if entry.size and _sizes[entry.size] > 1
+        ]
+        with _stage(stats, "hash duplicates", _candidates):
+            _known = dict(
+                zip(
+                    [entry.relpath for entry in _candidates],
+                    manifest.hash_entries(directory, _candidates),
+                )
+            )
+
+    cache = manifest.cache
+    _archived = {}
+    _pool = None
+    if manifest.jobs > 1:
+        _pool = ThreadPoolExecutor(max_workers=manifest.jobs)
+    _ahead = {}
+    _submitted = 0
+    with contextlib.ExitStack() as _stack:
+        if _pool is not None:
+            _stack.callback(_pool.shutdown)
+        _stack.enter_context(_stage(stats, "hash and archive", entries))
+        writer = _stack.enter_context(archive.writer())
+        for _index, entry in enumerate(entries):
+            # keep the workers busy with the files coming next, in bounded memory
+            while _pool is not None and _submitted < min(
+                len(entries), _index + 2 * manifest.jobs
+            ):
+                _next = entries[_submitted]
+                if _next.size <= READ_AHEAD_SIZE and _next.relpath not in _known:
+                    _ahead[_submitted] = _pool.submit(
+                        _read_and_hash,
+                        directory.joinpath(_next.relpath),
+                        manifest.hash_method,
+                    )
+                _submitted += 1
+
+            _start = time.perf_counter()
+            file = directory.joinpath(entry.relpath)
+            _key = cache.entry_key(file, entry) if cache is not None else None
+            _data = None
+            if _index in _ahead:
+                _data, _hash = _ahead.pop(_index).result()
+                if cache is not None:
+                    cache.store(_key, manifest.hash_method, _hash)
+            else:
+                _hash = _known.get(entry.relpath)
+                if _hash is None and cache is not None:
+                    _hash = cache.lookup(_key, manifest.hash_method)
+            if _hash is not None:
+                if dedup and entry.size and _hash in _archived:
+                    writer.add_link(
+                        file, arcname=entry.relpath, target=_archived[_hash]
+                    )
+                elif _data is not None:
+                    writer.add_file(
+                        file, arcname=entry.relpath, file_pointer=io.BytesIO(_data)
+                    )
+                else:
+                    writer.add_file(file, arcname=entry.relpath)
+            else:
+                with open(file, "rb") as file_pointer:
+                    reader = HashingReader(file_pointer, manifest.hash_method)
+                    writer.add_file(file, arcname=entry.relpath, file_pointer=reader)
+                _hash = reader.hexdigest()
+                if cache is not None:
+                    cache.store(_key, manifest.hash_method, _hash)
+            _archived.setdefault(_hash, entry.relpath)
+            manifest.add_artifact_hash(Path(entry.relpath), _hash)
+            if stats is not None:
+                stats.file_done(
+                    entry.relpath, entry.size, time.perf_counter() - _start
+                )
+        with _spool_manifest(
+            manifest,
+            getattr(writer, "index", None),
+            stats if record_stats else None,
+        ) as _spooled:
+            writer.add_stream(MANIFEST_NAME, _spooled)
+
 
-    Internal call
+def _output_and_type(directory: Path, output, archive_type, chunk_store=None):
     """
+    :return: the output file and archive type of a package, each defaulted from
+        the other when not given
+    """
+    if chunk_store is not None:
+        archive_type = CHUNK_STORE_TYPE
+        if not output:
+            output = directory.parent.joinpath(Path("output.json"))
+
+    if is_stream(output):
+        return output, archive_type or "tar.gz"
+
     if not archive_type and not output:
         archive_type = "tar.gz"
 
     if not archive_type and output:
-        archive_type = get_compression_method_from_file_name(output)
+        try:
+            archive_type = archive_type_from_file_name(output)
+        except ArchiveE:
+            raise PackageE(
+                "Could not determine compression method. Please specify parameter -a / --archive-type"
+            )
 
     if not output:
         output = directory.parent.joinpath(Path(f"output.{archive_type}"))
 
+    if not output.parent.exists():
+        raise PackageE("The specified output folder does not exist")
+    return output, archive_type
+
+
+def create_package(
+    directory,
+    meta_data,
+    output,
+    hash_type,
+    archive_type,
+    jobs=1,
+    use_processes=False,
+    single_pass=True,
+    hash_cache: HashCache = None,
+    compression_level=None,
+    compression_threads=1,
+    include=None,
+    exclude=None,
+    base=None,
+    chunk_store=None,
+    dedup=False,
+    seekable=False,
+    stats: Stats = None,
+    record_stats=False,
+    compact_manifest=False,
+    stream_manifest=False,
+    binary_manifest=False,
+    write_manifest=None,
+):
+    """
+    Given a directory path and optional meta-information in a JSON formatted file.
+    Creates a deliverable archive file containing both the files and a manifest
+    with meta-data as well as file hashes for each file.
+    Errors are raised as PackageE, the package() wrapper used by the command line
+    raises them as click.ClickException.
+
+    :return: path of the created package, or the file object it was written to
+    :param output: path of the package, or a writable binary file object (stdout,
+        a pipe or a socket) a tar archive is streamed to
+    :param jobs: number of parallel hashing workers, 0 means one per core. In a
+        single pass they are threads reading and hashing files ahead of the writer
+    :param use_processes: hash in a process pool instead of a thread pool, only
+        used when hashing before archiving
+    :param single_pass: hash files while writing them to the archive, reading
+        each file once. When False all files are hashed first (using jobs
+        workers) and archived in a second pass.
+    :param hash_cache: optional persistent hash cache, unchanged files are not rehashed
+    :param compression_level: compressor level for the archive type, None uses its default
+    :param compression_threads: number of compression threads, 0 means one per core
+    :param include: glob patterns, when given only matching files are packaged
+    :param exclude: glob patterns of files and directories left out of the package
+    :param base: previous package, or its manifest, to create a delta package against.
+        Only files added or changed since the base are archived, the manifest lists
+        all files and records the removed ones. Always hashes before archiving.
+    :param chunk_store: directory of a local chunk store. Instead of an archive the
+        file contents are stored there as deduplicated content defined chunks and
+        output is the manifest referencing them
+    :param dedup: archive files identical to an earlier file as a hard link to
+        it (tar), or by reusing its compressed data (zip). In single pass mode
+        files sharing their size with another file are read twice.
+    :param seekable: write a tar.gz in which every file can be extracted on its
+        own, the member offsets are recorded in the manifest
+    :param stats: optional Stats timing the scanning, hashing and archiving stages
+    :param record_stats: record the stats in the package-wrapper block of the
+        manifest, stages still running when the manifest is written (archiving in
+        a single pass) are recorded up to that point
+    :param compact_manifest: write the manifest without any indentation or whitespace
+    :param stream_manifest: keep the files of the manifest serialized in a temporary
+        file while hashing instead of in memory, for trees with millions of files
+    :param binary_manifest: also write manifest.bin into the directory, a sorted
+        binary manifest that verification looks files up in without parsing it
+    :param write_manifest: write the manifest into the directory, by default
+        unless the package is streamed to a file object. The archive always
+        contains the manifest, so the directory may be read only without it.
+    """
+    _recorded = stats if record_stats else None
+    if write_manifest is None:
+        write_manifest = not is_stream(output)
+    if chunk_store is not None and base is not None:
+        raise PackageE("a chunk store package can not be a delta package")
+    if binary_manifest and not write_manifest:
+        raise PackageE(
+            "the binary manifest is only written with the manifest in the directory"
+        )
+    output, archive_type = _output_and_type(
+        directory, output, archive_type, chunk_store
+    )
+
     # Create the complete meta-data file
-    manifest = ManifestFile(hash_method=hash_type)
+    manifest = ManifestFile(
+        hash_method=hash_type,
+        jobs=jobs,
+        use_processes=use_processes,
+        cache=hash_cache,
+        stats=stats,
+        indent=None if compact_manifest else DEFAULT_INDENT,
+        spool=stream_manifest,
+    )
     package_metadata = {
         "package created": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S (utc)"),
         "version of package-wrapper": __version__,
@@ -51,15 +418,258 @@ def package(directory, meta_data, output, hash_type, archive_type):
     if meta_data:
         manifest.add_meta_data_file(meta_data_path=meta_data)
 
-    # All folder to the manifest
-    manifest.add_folder(path_to_directory=directory)
-    output_manifest_path = directory.joinpath(Path("manifest.json"))
-    with open(output_manifest_path, "w") as file_pointer:
-        file_pointer.write(json.dumps(manifest.retrive_contents(), indent=3))
+    try:
+        archive = None
+        if chunk_store is None:
+            archive = Archive(
+                output,
+                archive_type=archive_type,
+                compression_level=compression_level,
+                threads=compression_threads,
+                seekable=seekable,
+            )
+    except ArchiveE as exception:
+        raise PackageE(exception.msg)
+
+    # The directory is walked once, manifest and archive share the file list
+    try:
+        with _stage(stats, "scan"):
+            entries = [
+                entry
+                for entry in scan_directory(
+                    directory, include=include, exclude=exclude
+                )
+                if not _is_manifest(directory, entry)
+            ]
+            if stats is not None:
+                stats.count(len(entries), sum(entry.size for entry in entries))
+    except ScannerE as exception:
+        raise PackageE(exception.msg)
 
-    if output.parent.exists():
-        # Create the compressed output file
-        archive = Archive(output, archive_type=archive_type)
-        archive.compress(dir_path=directory)
+    if chunk_store is not None:
+        with _stage(stats, "hash", entries):
+            manifest.add_folder(path_to_directory=directory, entries=entries)
+        try:
+            with _stage(stats, "chunk store"):
+                chunks = store_files(
+                    chunk_store,
+                    manifest.file_digests(),
+                    directory,
+                    jobs=manifest.jobs,
+                )
+                if stats is not None:
+                    stats.count(len(entries), sum(entry.size for entry in entries))
+        except ChunkStoreE as exception:
+            raise PackageE(exception.msg)
+        manifest.add_meta_data(keyword="chunks", content=chunks)
+        _record_manifest(manifest, stats=_recorded)
+        if write_manifest:
+            _write_manifests(directory, manifest, binary_manifest)
+        if is_stream(output):
+            manifest.write(output)
+            output.flush()
+            return output
+        with open(output, "wb") as file_pointer:
+            manifest.write(file_pointer)
+        return output
+
+    if base is not None:
+        try:
+            base_contents = load_manifest_bytes(base)
+        except VerifyE as exception:
+            raise PackageE(exception.msg)
+        with _stage(stats, "hash", entries):
+            manifest.add_folder(path_to_directory=directory, entries=entries)
+        try:
+            delta = compute_delta(json.loads(base_contents), manifest.file_digests())
+        except DeltaE as exception:
+            raise PackageE(exception.msg)
+        package_metadata["delta"] = {"base manifest": manifest_digest(base_contents)}
+        package_metadata["delta"].update(delta)
+        _archived = set(delta["added"] + delta["changed"])
+        entries = [
+            entry for entry in entries if Path(entry.relpath).as_posix() in _archived
+        ]
+    elif single_pass:
+        _archive_and_hash(
+            directory,
+            entries,
+            archive,
+            manifest,
+            dedup=dedup,
+            stats=stats,
+            record_stats=record_stats,
+        )
+        if write_manifest:
+            _write_manifests(directory, manifest, binary_manifest)
+        return output
     else:
-        raise click.ClickException("The specified output folder does not exist")
+        # All folder to the manifest
+        with _stage(stats, "hash", entries):
+            manifest.add_folder(path_to_directory=directory, entries=entries)
+
+    # Create the compressed output file, seekable ones add their index to the manifest
+    with _stage(stats, "archive", entries):
+        archive.compress(
+            dir_path=directory,
+            entries=entries,
+            extra_members={
+                MANIFEST_NAME: functools.partial(
+                    _spool_manifest, manifest, stats=_recorded
+                )
+            },
+            # looked up along with the entries, both are in scan order
+            hashes=manifest.iter_digests() if dedup else None,
+            stats=stats,
+        )
+    # the stats recorded in the archived manifest are kept as they are
+    if write_manifest:
+        _write_manifests(directory, manifest, binary_manifest)
+    return output
+
+
+@functools.wraps(create_package)
+def package(*args, **kwargs):
+    # the command line reports packaging errors through click
+    try:
+        return create_package(*args, **kwargs)
+    except PackageE as exception:
+        raise click.ClickException(exception.msg)
+
+
+class ProgressEvent(NamedTuple):
+    """
+    Progress of a package_async() call, event is "started", "progress" or
+    "finished" and the counters are those of the stage so far
+    """
+
+    directory: Path
+    event: str
+    stage: str
+    files: int
+    bytes: int
+    total_files: Optional[int]
+    total_bytes: Optional[int]
+
+
+class _AsyncSink(StatsSink):
+    """
+    Passes the progress of a packaging thread to the event loop and stops the
+    thread once the packaging is cancelled
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        loop: asyncio.AbstractEventLoop,
+        callback: Optional[Callable[[ProgressEvent], None]],
+        interval: float,
+    ):
+        self.directory = directory
+        self.loop = loop
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = threading.Event()
+        self._last = 0.0
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise PackageCancelledE("packaging of %s was cancelled" % self.directory)
+
+    def _emit(self, event: str, stage: Stage):
+        if self.callback is None:
+            return
+        self.loop.call_soon_threadsafe(
+            self.callback,
+            ProgressEvent(
+                self.directory,
+                event,
+                stage.name,
+                stage.files,
+                stage.bytes,
+                stage.total_files,
+                stage.total_bytes,
+            ),
+        )
+
+    def stage_started(self, stage: Stage):
+        self._check()
+        self._emit("started", stage)
+
+    def advance(self, stage: Stage, files: int, size: int):
+        self._check()
+        _now = time.monotonic()
+        if _now - self._last >= self.interval:
+            self._last = _now
+            self._emit("progress", stage)
+
+    def stage_finished(self, stage: Stage):
+        self._emit("finished", stage)
+
+
+async def package_async(
+    directory: Path,
+    meta_data: Path = None,
+    output: Path = None,
+    hash_type: str = "sha256",
+    archive_type: str = None,
+    limit: asyncio.Semaphore = None,
+    executor: Executor = None,
+    progress: Callable[[ProgressEvent], None] = None,
+    progress_interval: float = PROGRESS_INTERVAL,
+    sinks: List[StatsSink] = None,
+    **options,
+) -> Path:
+    """
+    Create a package without blocking the event loop, the packaging runs in an
+    executor thread. Cancelling the awaiting task stops the packaging at the next
+    file and removes the incomplete output.
+    :param limit: semaphore shared by concurrent calls, bounding the number of
+        packages created at the same time
+    :param executor: executor running the packaging, the loop's default executor
+        when not given
+    :param progress: called in the event loop with a ProgressEvent when a stage
+        starts or finishes, and at most every progress_interval seconds in between
+    :param sinks: further receivers of the statistics of the run
+    :param options: keyword arguments of create_package()
+    :return: path of the created package
+    """
+    loop = asyncio.get_running_loop()
+    output, archive_type = _output_and_type(
+        directory, output, archive_type, options.get("chunk_store")
+    )
+    sink = _AsyncSink(directory, loop, progress, progress_interval)
+    stats = Stats(sinks=[sink] + list(sinks or []))
+
+    def _run():
+        _path = create_package(
+            directory,
+            meta_data,
+            output,
+            hash_type,
+            archive_type,
+            stats=stats,
+            **options,
+        )
+        stats.close()
+        return _path
+
+    if limit is not None:
+        await limit.acquire()
+    try:
+        future = loop.run_in_executor(executor, _run)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            sink.cancelled.set()
+            # the thread stops at the next file, it must be done before cleaning up
+            with contextlib.suppress(PackageCancelledE):
+                await asyncio.wait([future])
+                future.result()
+            # what was streamed already can not be taken back
+            if not is_stream(output) and output.exists():
+                output.unlink()
+            raise
+    finally:
+        if limit is not None:
+            limit.release()
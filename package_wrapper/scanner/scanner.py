@@ -0,0 +1,86 @@
+import fnmatch
+import os
+import stat
+from pathlib import Path
+from typing import List, NamedTuple, Sequence
+
+
+class ScannerE(BaseException):
+    def __init__(self, msg: str):
+        super(ScannerE, self).__init__()
+        self.msg = msg
+
+
+class ScanEntry(NamedTuple):
+    """
+    A regular file found below the scanned directory
+    """
+
+    relpath: str
+    size: int
+    mtime_ns: int
+    mode: int
+    inode: int
+
+
+def _matches(relpath: str, patterns: Sequence[str]) -> bool:
+    _posix = relpath.replace(os.sep, "/")
+    return any(fnmatch.fnmatchcase(_posix, _pattern) for _pattern in patterns)
+
+
+def _sort_key(entry: ScanEntry):
+    # same order as sorting the paths, "a/b" comes before "a-c"
+    return entry.relpath.split(os.sep)
+
+
+def scan_directory(
+    directory: Path,
+    include: Sequence[str] = None,
+    exclude: Sequence[str] = None,
+) -> List[ScanEntry]:
+    """
+    Walk the directory once with os.scandir and list every regular file below it.
+    Symbolic links to files are followed, symbolic links to directories are not.
+    :param directory: root of the walk
+    :param include: glob patterns on the relative path, when given only matching files are listed
+    :param exclude: glob patterns on the relative path, matching files and directories are skipped
+    :return: entries sorted by relative path
+    """
+    if not Path(directory).is_dir():
+        raise ScannerE("path: %s is not a directory" % directory)
+
+    include = list(include or [])
+    exclude = list(exclude or [])
+    entries = []
+    _stack = [("", str(directory))]
+    while _stack:
+        _prefix, _path = _stack.pop()
+        with os.scandir(_path) as iterator:
+            for entry in iterator:
+                _relpath = os.path.join(_prefix, entry.name)
+                if exclude and _matches(_relpath, exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    _stack.append((_relpath, entry.path))
+                    continue
+                try:
+                    _stat = entry.stat()
+                except FileNotFoundError:
+                    # dangling symbolic link
+                    continue
+                if not stat.S_ISREG(_stat.st_mode):
+                    continue
+                if include and not _matches(_relpath, include):
+                    continue
+                entries.append(
+                    ScanEntry(
+                        _relpath,
+                        _stat.st_size,
+                        _stat.st_mtime_ns,
+                        _stat.st_mode,
+                        _stat.st_ino,
+                    )
+                )
+
+    entries.sort(key=_sort_key)
+    return entries
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+
+class ServeE(BaseException):
+    """
+    Basic exception for the packaging server and its clients
+    """
+
+    def __init__(self, msg: str):
+        super(ServeE, self).__init__()
+        self.msg = msg
+
+
+def default_socket_path() -> Path:
+    _base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return Path(_base).joinpath(f"pkgwrap-{os.getuid()}.sock")
+
+
+def request(message: Dict, socket_path: Path = None) -> Dict:
+    """
+    Send a request to the server and wait for its response
+    :param message: the request, a "command" and its arguments
+    :param socket_path: socket the server listens on, see default_socket_path()
+    """
+    socket_path = socket_path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(socket_path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise ServeE("no server is listening on %s" % socket_path)
+        connection.sendall(json.dumps(message).encode() + b"\n")
+        with connection.makefile("rb") as reader:
+            _response = reader.readline()
+    if not _response:
+        raise ServeE("the server closed the connection")
+    return json.loads(_response)
+
+
+def is_running(socket_path: Path = None) -> bool:
+    """
+    :return: True if a server listens on the socket
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(socket_path or default_socket_path()))
+        except OSError:
+            return False
+    return True
+
+
+def _option(value: str):
+    _key, _separator, _value = value.partition("=")
+    if not _separator:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got %s" % value)
+    try:
+        return _key, json.loads(_value)
+    except ValueError:
+        return _key, _value
+
+
+def _message(arguments) -> Dict:
+    if arguments.command == "package":
+        _job = dict(arguments.options or [])
+        _job["directory"] = arguments.directory
+        for _key in ("output", "meta_data", "hash_type", "archive_type"):
+            if getattr(arguments, _key) is not None:
+                _job[_key.replace("_", "-")] = getattr(arguments, _key)
+        return {"command": "package", "cwd": os.getcwd(), "job": _job}
+    if arguments.command == "verify":
+        return {
+            "command": "verify",
+            "cwd": os.getcwd(),
+            "path": arguments.path,
+            "jobs": arguments.jobs,
+        }
+    return {"command": arguments.command}
+
+
+def main(argv: List[str] = None):
+    """
+    pkgwrap-client, the thin client of pkgwrap serve. It only imports the
+    standard library, so a call starts in a fraction of the time of pkgwrap.
+    """
+    parser = argparse.ArgumentParser(
+        prog="pkgwrap-client",
+        description="Submit package and verify jobs to a running pkgwrap serve, "
+        "the response is printed as JSON",
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        help="socket of the server [default: %s]" % default_socket_path(),
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    _package = commands.add_parser("package", help="create a package")
+    _package.add_argument("directory")
+    _package.add_argument("-o", "--output")
+    _package.add_argument("-m", "--meta-data", dest="meta_data")
+    _package.add_argument("-#", "--hash-type", dest="hash_type")
+    _package.add_argument("-a", "--archive-type", dest="archive_type")
+    _package.add_argument(
+        "--option",
+        dest="options",
+        action="append",
+        type=_option,
+        metavar="KEY=VALUE",
+        help="further job key as in a pkgwrap batch job file, the value is "
+        "parsed as JSON if possible",
+    )
+    _verify = commands.add_parser("verify", help="verify a package")
+    _verify.add_argument("path")
+    _verify.add_argument("-j", "--jobs", type=int, default=1)
+    commands.add_parser("status", help="show the state of the server")
+    commands.add_parser("stop", help="stop the server once its jobs are done")
+    arguments = parser.parse_args(argv)
+
+    try:
+        response = request(_message(arguments), arguments.socket)
+    except ServeE as exception:
+        print("Error: %s" % exception.msg, file=sys.stderr)
+        sys.exit(2)
+    print(json.dumps(response, indent=3))
+    sys.exit(0 if response.get("ok") else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import asyncio
+import functools
+import json
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict
+
+from package_wrapper.batch.batch import BatchE, job_options, run_job
+from package_wrapper.manifest.hashcache import MemoryHashCache
+from package_wrapper.serve.client import ServeE, default_socket_path, is_running
+from package_wrapper.verify.verify import VerifyE, verify_package
+
+# longest request accepted, one line of JSON
+REQUEST_LIMIT = 1024 * 1024
+
+
+class PackageServer:
+    """
+    Creates and verifies packages on request of clients connecting to a Unix
+    socket. Requests and responses are single lines of JSON. All jobs run in
+    one shared pool of workers and use the same in-memory hash index, files
+    unchanged since an earlier request are not hashed again.
+    """
+
+    def __init__(
+        self,
+        socket_path: Path = None,
+        workers: int = 0,
+        index: MemoryHashCache = None,
+    ):
+        """
+        :param socket_path: socket to listen on, see default_socket_path()
+        :param workers: number of jobs run in parallel, 0 means one per core
+        :param index: hash index shared by all jobs, an empty one when not given
+        """
+        if workers < 0:
+            raise ServeE(f"invalid number of workers: {workers}")
+        self.socket_path = Path(socket_path or default_socket_path())
+        self.workers = workers or os.cpu_count() or 1
+        self.index = index if index is not None else MemoryHashCache()
+        self.requests = 0
+        self._executor = None
+        self._stopped = None
+        self._running = set()
+        # connections waiting for their next request
+        self._idle = set()
+
+    async def serve(self, ready: Callable[[], None] = None):
+        """
+        Serve until a client sends "stop" or, when serving in the main thread,
+        the process receives SIGINT or SIGTERM. Jobs in progress are finished
+        before returning.
+        :param ready: called once the server accepts connections
+        """
+        if self.socket_path.exists():
+            if is_running(self.socket_path):
+                raise ServeE("a server is already listening on %s" % self.socket_path)
+            # left by a server that did not shut down
+            self.socket_path.unlink()
+
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        # signals are only delivered to the main thread
+        _signals = []
+        if threading.current_thread() is threading.main_thread():
+            _signals = [signal.SIGINT, signal.SIGTERM]
+        for _signal in _signals:
+            loop.add_signal_handler(_signal, self.stop)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as self._executor:
+                server = await asyncio.start_unix_server(
+                    self._connection, path=str(self.socket_path), limit=REQUEST_LIMIT
+                )
+                # jobs read and write files as the user running the server
+                os.chmod(self.socket_path, 0o600)
+                try:
+                    if ready is not None:
+                        ready()
+                    await self._stopped.wait()
+                finally:
+                    server.close()
+                    await server.wait_closed()
+                    if self._running:
+                        await asyncio.wait(self._running)
+        finally:
+            for _signal in _signals:
+                loop.remove_signal_handler(_signal)
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+
+    def stop(self):
+        """
+        Stop accepting requests, must be called in the event loop of serve().
+        Connections waiting for a request are closed, the others once their
+        request is answered.
+        """
+        self._stopped.set()
+        for _connection in self._idle:
+            _connection.cancel()
+
+    async def _connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while not self._stopped.is_set():
+                self._idle.add(asyncio.current_task())
+                try:
+                    _line = await reader.readline()
+                finally:
+                    self._idle.discard(asyncio.current_task())
+                if not _line:
+                    break
+                _task = asyncio.ensure_future(self.handle(_line))
+                self._running.add(_task)
+                _task.add_done_callback(self._running.discard)
+                writer.write(json.dumps(await _task).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # a client gone, or a request over REQUEST_LIMIT
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, line: bytes) -> Dict:
+        """
+        :param line: a request, JSON with the "command" and its arguments
+        :return: the response, "ok" tells whether the command succeeded and
+            "error" holds the reason it failed, if any
+        """
+        self.requests += 1
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ServeE("a request must be an object")
+            _command = request.get("command")
+            if _command == "package":
+                return await self._package(request)
+            if _command == "verify":
+                return await self._verify(request)
+            if _command == "status":
+                return self.status()
+            if _command == "stop":
+                self.stop()
+                return {"ok": True, "error": None}
+            raise ServeE("unknown command: %s" % _command)
+        except ServeE as exception:
+            return {"ok": False, "error": exception.msg}
+        except ValueError:
+            return {"ok": False, "error": "a request must be JSON"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as exception:
+            # a bug must not take the connection down, the client gets the reason
+            return {
+                "ok": False,
+                "error": "%s: %s" % (type(exception).__name__, exception),
+            }
+
+    @staticmethod
+    def _cwd(request: Dict) -> Path:
+        # relative paths are relative to the working directory of the client
+        _cwd = request.get("cwd")
+        if _cwd is not None and not isinstance(_cwd, str):
+            raise ServeE("cwd must be a path")
+        return Path(_cwd or os.getcwd())
+
+    async def _package(self, request: Dict) -> Dict:
+        _job = request.get("job")
+        if not isinstance(_job, dict):
+            raise ServeE("a package request needs a job object")
+        try:
+            _options = job_options(_job, self._cwd(request))
+        except BatchE as exception:
+            raise ServeE(exception.msg)
+        _result = await run_job(
+            _options, executor=self._executor, hash_cache=self.index
+        )
+        return dict(_result, ok=_result["error"] is None)
+
+    async def _verify(self, request: Dict) -> Dict:
+        if not isinstance(request.get("path"), str):
+            raise ServeE("a verify request needs a path")
+        _path = self._cwd(request).joinpath(request["path"])
+        _jobs = request.get("jobs", 1)
+        if not isinstance(_jobs, int) or _jobs < 1:
+            raise ServeE("invalid number of jobs: %s" % _jobs)
+        loop = asyncio.get_running_loop()
+        try:
+            _result = await loop.run_in_executor(
+                self._executor, functools.partial(verify_package, _path, jobs=_jobs)
+            )
+        except VerifyE as exception:
+            raise ServeE(exception.msg)
+        except OSError as exception:
+            raise ServeE(str(exception))
+        return dict(_result.as_dict(), ok=_result.ok, error=None)
+
+    def status(self) -> Dict:
+        return {
+            "ok": True,
+            "error": None,
+            "pid": os.getpid(),
+            "workers": self.workers,
+            "requests": self.requests,
+            "index entries": len(self.index),
+        }
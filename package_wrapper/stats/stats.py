@@ -0,0 +1,256 @@
+import contextlib
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import click
+
+# number of slowest files kept for every stage
+SLOWEST_FILES = 10
+
+
+def _cpu_time() -> float:
+    # CPU time of all threads, worker processes count once their pool has shut down
+    _times = os.times()
+    return (
+        _times.user + _times.system + _times.children_user + _times.children_system
+    )
+
+
+class Stage:
+    """
+    Timing and counters of one stage of a run (scanning, hashing, archiving...)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        total_files: int = None,
+        total_bytes: int = None,
+        slowest: int = SLOWEST_FILES,
+    ):
+        """
+        :param total_files: number of files the stage will process, if known
+        :param total_bytes: number of bytes the stage will process, if known
+        :param slowest: number of slowest files kept
+        """
+        self.name = name
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.cached_files = 0
+        self.wall: Optional[float] = None
+        self.cpu: Optional[float] = None
+        self._slowest_count = slowest
+        self._slowest = []
+        self._start_wall = time.perf_counter()
+        self._start_cpu = _cpu_time()
+
+    @property
+    def finished(self) -> bool:
+        return self.wall is not None
+
+    def add_file(self, path: str, size: int, seconds: float = None):
+        """
+        :param seconds: time spent on the file, None for files taken from a cache
+        """
+        self.files += 1
+        self.bytes += size
+        if seconds is None:
+            self.cached_files += 1
+            return
+        _item = (seconds, str(path), size)
+        if len(self._slowest) < self._slowest_count:
+            heapq.heappush(self._slowest, _item)
+        elif self._slowest and _item > self._slowest[0]:
+            heapq.heapreplace(self._slowest, _item)
+
+    def add(self, files: int = 0, size: int = 0):
+        """
+        Count files and bytes processed without timing them one by one
+        """
+        self.files += files
+        self.bytes += size
+
+    def finish(self):
+        self.wall = time.perf_counter() - self._start_wall
+        self.cpu = _cpu_time() - self._start_cpu
+
+    def slowest_files(self) -> List[Dict]:
+        return [
+            {"path": _path, "seconds": _seconds, "bytes": _size}
+            for _seconds, _path, _size in sorted(self._slowest, reverse=True)
+        ]
+
+    def as_dict(self) -> Dict:
+        """
+        A stage still running is reported with its time and counters so far
+        """
+        _wall = self.wall
+        _cpu = self.cpu
+        if _wall is None:
+            _wall = time.perf_counter() - self._start_wall
+            _cpu = _cpu_time() - self._start_cpu
+        return {
+            "stage": self.name,
+            "finished": self.finished,
+            "wall": _wall,
+            "cpu": _cpu,
+            "files": self.files,
+            "cached files": self.cached_files,
+            "bytes": self.bytes,
+            "bytes per second": self.bytes / _wall if _wall else 0.0,
+            "files per second": self.files / _wall if _wall else 0.0,
+            "slowest files": self.slowest_files(),
+        }
+
+
+class StatsSink:
+    """
+    Receives the progress of a run, sinks override the notifications they need
+    """
+
+    def stage_started(self, stage: Stage):
+        pass
+
+    def advance(self, stage: Stage, files: int, size: int):
+        pass
+
+    def stage_finished(self, stage: Stage):
+        pass
+
+    def close(self, stats: "Stats"):
+        pass
+
+
+class ProgressSink(StatsSink):
+    """
+    Shows a progress bar for every stage with a known size and a summary line
+    once the stage is done
+    """
+
+    def __init__(self, file=None):
+        self.file = file or sys.stderr
+        self._bar = None
+        self._by_bytes = True
+        self._stack = contextlib.ExitStack()
+
+    def stage_started(self, stage: Stage):
+        self._by_bytes = bool(stage.total_bytes)
+        _length = stage.total_bytes if self._by_bytes else stage.total_files
+        if _length:
+            self._bar = self._stack.enter_context(
+                click.progressbar(length=_length, label=stage.name, file=self.file)
+            )
+
+    def advance(self, stage: Stage, files: int, size: int):
+        if self._bar is not None:
+            self._bar.update(size if self._by_bytes else files)
+
+    def stage_finished(self, stage: Stage):
+        self._stack.close()
+        self._bar = None
+        _stats = stage.as_dict()
+        click.echo(
+            f"{stage.name}: {_stats['wall']:.2f} s ({_stats['cpu']:.2f} s CPU), "
+            f"{stage.files} files, {_stats['bytes per second'] / 1e6:.1f} MB/s, "
+            f"{_stats['files per second']:.0f} files/s",
+            file=self.file,
+        )
+
+
+class JsonSink(StatsSink):
+    """
+    Writes the statistics of the run to a JSON file when it is done
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def close(self, stats: "Stats"):
+        self.path.write_text(json.dumps(stats.as_dict(), indent=3))
+
+
+class Stats:
+    """
+    Per stage wall and CPU time, throughput and slowest files of a run, passed on
+    to sinks while the run progresses. Stages run one after the other, files may
+    be reported from any thread.
+    """
+
+    def __init__(self, sinks: List[StatsSink] = None, slowest: int = SLOWEST_FILES):
+        """
+        :param sinks: receivers of the progress and of the final statistics
+        :param slowest: number of slowest files kept for every stage
+        """
+        self.sinks = list(sinks or [])
+        self.slowest = slowest
+        self.stages: List[Stage] = []
+        self._current: Optional[Stage] = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, files: int = None, size: int = None):
+        """
+        Time the enclosed block as a stage
+        :param files: number of files the stage will process, if known
+        :param size: number of bytes the stage will process, if known
+        """
+        _stage = Stage(name, total_files=files, total_bytes=size, slowest=self.slowest)
+        with self._lock:
+            self.stages.append(_stage)
+            self._current = _stage
+            for sink in self.sinks:
+                sink.stage_started(_stage)
+        try:
+            yield _stage
+        finally:
+            with self._lock:
+                _stage.finish()
+                self._current = None
+                for sink in self.sinks:
+                    sink.stage_finished(_stage)
+
+    def file_done(self, path, size: int, seconds: float = None):
+        """
+        Report a file processed by the running stage
+        :param seconds: time spent on the file, None for files taken from a cache
+        """
+        with self._lock:
+            if self._current is None:
+                return
+            self._current.add_file(path, size, seconds)
+            for sink in self.sinks:
+                sink.advance(self._current, 1, size)
+
+    def count(self, files: int = 0, size: int = 0):
+        """
+        Report files processed by the running stage without timing them
+        """
+        with self._lock:
+            if self._current is None:
+                return
+            self._current.add(files, size)
+            for sink in self.sinks:
+                sink.advance(self._current, files, size)
+
+    def as_dict(self) -> Dict:
+        _stages = [_stage.as_dict() for _stage in self.stages]
+        return {
+            "stages": _stages,
+            "wall": sum(_stage["wall"] for _stage in _stages),
+            "cpu": sum(_stage["cpu"] for _stage in _stages),
+        }
+
+    def close(self):
+        """
+        Hand the final statistics to the sinks
+        """
+        for sink in self.sinks:
+            sink.close(self)
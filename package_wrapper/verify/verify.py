@@ -0,0 +1,363 @@
+import contextlib
+import json
+import os
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from package_wrapper.archiver.archiver import (
+    Archive,
+    ArchiveE,
+    archive_type_from_file_name,
+)
+from package_wrapper.manifest.filehash import (
+    DEFAULT_CHUNK_SIZE,
+    SHA256,
+    FileHashE,
+    entry_digest,
+    file_hash_check,
+    file_hash_create_from_file_object,
+)
+from package_wrapper.manifest.binary import (
+    BINARY_MANIFEST_NAME,
+    BinaryManifest,
+    is_binary_manifest,
+)
+from package_wrapper.manifest.manifest import MANIFEST_NAME, ManifestE
+from package_wrapper.scanner.scanner import scan_directory
+
+
+class VerifyE(BaseException):
+    """
+    Basic exception for verification related tasks
+    """
+
+    def __init__(self, msg: str):
+        super(VerifyE, self).__init__()
+        self.msg = msg
+
+
+class VerifyResult:
+    """
+    Outcome of verifying a package against its manifest, all lists hold paths
+    relative to the package root in sorted order
+    """
+
+    def __init__(self):
+        self.matched: List[str] = []
+        self.mismatched: List[str] = []
+        self.missing: List[str] = []
+        self.extra: List[str] = []
+
+    @property
+    def ok(self) -> bool:
+        return not (self.mismatched or self.missing or self.extra)
+
+    def as_dict(self) -> Dict:
+        return {
+            "matched": self.matched,
+            "mismatched": self.mismatched,
+            "missing": self.missing,
+            "extra": self.extra,
+        }
+
+
+def _archive_type(file_name: Path) -> str:
+    try:
+        return archive_type_from_file_name(file_name)
+    except ArchiveE as exception:
+        raise VerifyE(exception.msg)
+
+
+def _member_name(name: str) -> str:
+    return Path(name).as_posix()
+
+
+def load_manifest_bytes(path: Path) -> bytes:
+    """
+    Read the manifest of a package directory or archive without parsing it
+    :param path: package directory, archive or the manifest file itself
+    :return: the manifest file contents
+    """
+    if path.is_dir():
+        path = path.joinpath(MANIFEST_NAME)
+    if not path.is_file():
+        raise VerifyE("could not find a manifest in %s" % path)
+
+    if path.name == MANIFEST_NAME:
+        return path.read_bytes()
+
+    _type = _archive_type(path)
+    try:
+        if _type == "zip":
+            # the central directory gives direct access to the manifest
+            with zipfile.ZipFile(path) as zip_ref:
+                return zip_ref.read(MANIFEST_NAME)
+        archive = Archive(path, archive_type=_type)
+        with contextlib.closing(archive.iter_members()) as members:
+            for _name, file_pointer in members:
+                if _member_name(_name) == MANIFEST_NAME:
+                    return file_pointer.read()
+    except KeyError:
+        pass
+    except (ArchiveE, tarfile.TarError, zipfile.BadZipFile) as exception:
+        raise VerifyE(getattr(exception, "msg", str(exception)))
+
+    raise VerifyE("archive %s does not contain a manifest" % path)
+
+
+def load_manifest(path: Path) -> Dict:
+    """
+    Load the manifest of a package directory or archive
+    :param path: package directory, archive or the manifest file itself, which
+        may also be a binary manifest
+    :return: the manifest contents
+    """
+    if path.name == BINARY_MANIFEST_NAME and is_binary_manifest(path):
+        try:
+            with BinaryManifest(path) as binary:
+                return binary.as_dict()
+        except ManifestE as exception:
+            raise VerifyE(exception.msg)
+    return json.loads(load_manifest_bytes(path))
+
+
+def _posix_path(path: str) -> str:
+    # manifests list normalized paths, where posix systems need no conversion
+    if os.sep == "/":
+        return path
+    return Path(path).as_posix()
+
+
+def manifest_index(manifest: Dict) -> Dict[str, str]:
+    """
+    :return: mapping of relative path to "method:hash" for every file in the manifest,
+        methods and digests are joined by commas for files with several digests
+    """
+    if "files" not in manifest:
+        raise VerifyE("manifest does not list any files")
+    try:
+        return {
+            _posix_path(_path): entry_digest(_hash)
+            for _path, _hash in manifest["files"].items()
+        }
+    except (TypeError, ValueError):
+        raise VerifyE("manifest lists invalid file digests")
+
+
+def delta_info(manifest: Dict):
+    """
+    :return: the delta block of a delta package manifest, None for a full package
+    """
+    return manifest.get("package-wrapper", {}).get("delta")
+
+
+def _check(path_to_file: Path, hash_string: str, chunk_size: int) -> bool:
+    _method, _hash = hash_string.split(":", 1)
+    return file_hash_check(
+        file_name=path_to_file,
+        hash_string=_hash,
+        hash_method=_method,
+        chunk_size=chunk_size,
+    )
+
+
+def _join_binary_manifest(
+    binary: BinaryManifest, present: List[str], result: VerifyResult
+) -> List[Tuple[str, str]]:
+    """
+    Merge the sorted files found in a directory with the sorted entries of a
+    binary manifest, without building an index of the manifest
+    :return: path and "method:hash" of the files to check
+    """
+    _to_check = []
+    _present = iter(present)
+    _path = next(_present, None)
+    for _listed, _digest in binary:
+        _key = _listed.split("/")
+        while _path is not None and _path.split("/") < _key:
+            result.extra.append(_path)
+            _path = next(_present, None)
+        if _path == _listed:
+            _to_check.append((_path, _digest))
+            _path = next(_present, None)
+        else:
+            result.missing.append(_listed)
+    while _path is not None:
+        result.extra.append(_path)
+        _path = next(_present, None)
+    return _to_check
+
+
+def verify_directory(
+    directory: Path,
+    manifest: Dict = None,
+    jobs: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> VerifyResult:
+    """
+    Verify the files of a package directory against a manifest
+    :param directory: root of the package
+    :param manifest: manifest contents, defaults to the manifest.bin in the
+        directory if it has one and to its manifest.json otherwise
+    :param jobs: number of files hashed in parallel
+    :param chunk_size: size in bytes of each read while hashing
+    """
+    if not directory.is_dir():
+        raise VerifyE("path: %s is not a directory" % directory)
+    _binary_path = directory.joinpath(BINARY_MANIFEST_NAME)
+    _binary = manifest is None and is_binary_manifest(_binary_path)
+    if manifest is None and not _binary:
+        manifest = load_manifest(directory)
+
+    present = [
+        Path(entry.relpath).as_posix()
+        for entry in scan_directory(directory)
+        if entry.relpath != MANIFEST_NAME
+        and not (entry.relpath == BINARY_MANIFEST_NAME and _binary)
+    ]
+
+    result = VerifyResult()
+    if _binary:
+        try:
+            with BinaryManifest(_binary_path) as binary:
+                _to_check = _join_binary_manifest(binary, present, result)
+        except ManifestE as exception:
+            raise VerifyE(exception.msg)
+    else:
+        index = manifest_index(manifest)
+        result.missing = sorted(set(index) - set(present))
+        result.extra = sorted(set(present) - set(index))
+        _to_check = [
+            (_path, index[_path]) for _path in sorted(set(present).intersection(index))
+        ]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            _matches = executor.map(
+                _check,
+                [directory.joinpath(_path) for _path, _digest in _to_check],
+                [_digest for _path, _digest in _to_check],
+                [chunk_size] * len(_to_check),
+            )
+            for (_path, _digest), _match in zip(_to_check, _matches):
+                (result.matched if _match else result.mismatched).append(_path)
+    except (FileHashE, ValueError) as exception:
+        raise VerifyE(getattr(exception, "msg", str(exception)))
+
+    return result
+
+
+def verify_archive(
+    path: Path, hash_method: str = SHA256, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> VerifyResult:
+    """
+    Verify an archive against the manifest it contains without extracting it.
+    Members are hashed while they are streamed out of the archive, so the whole
+    check is one sequential read and needs no temporary space.
+    Zip archives give direct access to the manifest. In tar balls members
+    stored before the manifest are hashed with hash_method, if the manifest
+    uses another method only those members are read again.
+    :param path: archive to verify
+    :param hash_method: method assumed for members preceding the manifest
+    :param chunk_size: size in bytes of each read while hashing
+    """
+    _type = _archive_type(path)
+    archive = Archive(path, archive_type=_type)
+    manifest = load_manifest(path) if _type == "zip" else None
+    index = manifest_index(manifest) if manifest is not None else None
+
+    def _method(name: str) -> str:
+        if index is None:
+            return hash_method.lower()
+        return index[name].split(":", 1)[0].lower()
+
+    links = {}
+
+    def _hash_members(names=None):
+        with contextlib.closing(archive.iter_entries()) as members:
+            for _name, file_pointer, _link in members:
+                _name = _member_name(_name)
+                if _name == MANIFEST_NAME:
+                    yield _name, file_pointer
+                elif _link is not None:
+                    # a duplicated file, it has the digest of the member it links to
+                    links[_name] = _member_name(_link)
+                    yield _name, None
+                elif names is None or _name in names:
+                    if index is not None and _name not in index:
+                        # not in the manifest, no need to hash it
+                        yield _name, None
+                        continue
+                    _hash = file_hash_create_from_file_object(
+                        file_pointer, _method(_name), chunk_size=chunk_size
+                    )
+                    yield _name, _method(_name) + ":" + _hash
+
+    digests = {}
+    try:
+        for _name, _digest in _hash_members():
+            if _name == MANIFEST_NAME:
+                manifest = json.load(_digest)
+                index = manifest_index(manifest)
+            else:
+                digests[_name] = _digest
+        if index is None:
+            raise VerifyE("archive %s does not contain a manifest" % path)
+
+        _rehash = set(
+            _name
+            for _name, _digest in digests.items()
+            if _name in index
+            and _digest is not None
+            and _digest.split(":", 1)[0] != _method(_name)
+        )
+        if _rehash:
+            for _name, _digest in _hash_members(_rehash):
+                if _name in _rehash:
+                    digests[_name] = _digest
+    except (ArchiveE, FileHashE) as exception:
+        raise VerifyE(exception.msg)
+    except (tarfile.TarError, zipfile.BadZipFile, ValueError) as exception:
+        raise VerifyE(str(exception))
+
+    for _name, _link in links.items():
+        digests[_name] = digests.get(_link)
+
+    return compare_digests(manifest, digests)
+
+
+def compare_digests(manifest: Dict, digests: Dict[str, str]) -> VerifyResult:
+    """
+    Compare the digests of the files found in a package with its manifest
+    :param manifest: manifest contents
+    :param digests: relative path to "method:hash" of every file found, None for
+        files not hashed because the manifest does not list them
+    """
+    index = manifest_index(manifest)
+    # a delta package only carries the files added or changed since its base
+    _delta = delta_info(manifest)
+    _expected = set(index)
+    if _delta is not None:
+        _expected = set(_delta["added"] + _delta["changed"])
+
+    result = VerifyResult()
+    result.missing = sorted(_expected - set(digests))
+    result.extra = sorted(set(digests) - set(index))
+    for _name in sorted(set(digests).intersection(index)):
+        _matches = (digests[_name] or "").lower() == index[_name].lower()
+        (result.matched if _matches else result.mismatched).append(_name)
+    return result
+
+
+def verify_package(
+    path: Path, jobs: int = 1, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> VerifyResult:
+    """
+    Verify a package directory or archive against the manifest it contains
+    """
+    if path.is_dir():
+        return verify_directory(path, jobs=jobs, chunk_size=chunk_size)
+    return verify_archive(path, chunk_size=chunk_size)
@@ -0,0 +1,293 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from package_wrapper.manifest.binary import BINARY_MANIFEST_NAME
+from package_wrapper.manifest.filehash import (
+    DEFAULT_CHUNK_SIZE,
+    FileHashE,
+    file_hash_create,
+    new_hasher,
+)
+from package_wrapper.manifest.hashcache import RACY_WINDOW_NS, HashCache
+from package_wrapper.manifest.manifest import MANIFEST_NAME
+from package_wrapper.scanner.scanner import ScannerE, scan_directory
+
+# flags of <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# wd, mask, cookie and length of the name following every event
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+# seconds between checks for stop() and for hashes ready to be journaled
+POLL_INTERVAL = 0.2
+
+
+class WatchE(BaseException):
+    """
+    Basic exception for watching a directory
+    """
+
+    def __init__(self, msg: str):
+        super(WatchE, self).__init__()
+        self.msg = msg
+
+
+class _Inotify:
+    """
+    The few inotify calls needed, through the C library
+    """
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise WatchE("watching a directory needs inotify, which only Linux has")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchE("inotify: %s" % os.strerror(ctypes.get_errno()))
+        self._poll = select.poll()
+        self._poll.register(self.fd, select.POLLIN)
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        :return: the watch descriptor, -1 if the path does not exist (anymore)
+        """
+        _wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if _wd < 0:
+            _errno = ctypes.get_errno()
+            if _errno in (errno.ENOENT, errno.ENOTDIR):
+                return -1
+            if _errno == errno.ENOSPC:
+                raise WatchE(
+                    "too many directories to watch, raise fs.inotify.max_user_watches"
+                )
+            raise WatchE("inotify: %s: %s" % (path, os.strerror(_errno)))
+        return _wd
+
+    def read(self, timeout: float) -> List[Tuple[int, int, str]]:
+        """
+        Wait at most timeout seconds for events
+        :return: wd, mask and name of every event read
+        """
+        events = []
+        if not self._poll.poll(int(timeout * 1000)):
+            return events
+        while True:
+            try:
+                _buffer = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                return events
+            _offset = 0
+            while _offset < len(_buffer):
+                _wd, _mask, _cookie, _length = _EVENT.unpack_from(_buffer, _offset)
+                _offset += _EVENT.size
+                _name = _buffer[_offset : _offset + _length].rstrip(b"\0")
+                _offset += _length
+                events.append((_wd, _mask, os.fsdecode(_name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    Hashes the files of a directory while they are written, e.g. by a build,
+    and journals their hashes in a HashCache. A file is hashed when it is
+    closed after writing or moved into the tree, files found when watching
+    starts are hashed unless the cache already has them. Packaging the
+    directory afterwards with the same cache only hashes the files changed
+    since they were journaled.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        cache: HashCache,
+        hash_method: str = "sha256",
+        jobs: int = 1,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
+        """
+        :param directory: tree to watch, including the directories created in it
+        :param cache: cache the hashes are journaled in
+        :param hash_method: hash method of the packages created afterwards
+        :param jobs: number of files hashed in parallel, 0 means one per core
+        :param chunk_size: size in bytes of each read while hashing
+        """
+        if not Path(directory).is_dir():
+            raise WatchE("path: %s is not a directory" % directory)
+        if jobs < 0:
+            raise WatchE(f"invalid number of jobs: {jobs}")
+        try:
+            new_hasher(hash_method)
+        except FileHashE as exception:
+            raise WatchE(exception.msg)
+
+        self.directory = Path(directory).absolute()
+        self.cache = cache
+        self.hash_method = hash_method
+        self.jobs = jobs or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.hashed = 0
+        self.journaled = 0
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # path to stat key and hash of the files not journaled yet
+        self._pending = {}
+        # watch descriptor to the directory it watches
+        self._watches = {}
+        self._inotify = None
+        self._executor = None
+
+    def watch(self, ready: Callable[[], None] = None):
+        """
+        Watch until stop() is called. Files being hashed are finished and
+        journaled before returning.
+        :param ready: called once every directory is watched
+        """
+        self._inotify = _Inotify()
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        try:
+            self._add_tree(str(self.directory))
+            if ready is not None:
+                ready()
+            while not self._stopped.is_set():
+                for _wd, _mask, _name in self._inotify.read(POLL_INTERVAL):
+                    self._event(_wd, _mask, _name)
+                self._journal()
+            # files closed before stop() was called
+            for _wd, _mask, _name in self._inotify.read(0):
+                self._event(_wd, _mask, _name)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._inotify.close()
+            self._journal(wait=True)
+
+    def stop(self):
+        """
+        Stop watching, may be called from any thread or a signal handler
+        """
+        self._stopped.set()
+
+    def _add_tree(self, path: str):
+        # watched before scanning, a file written in between is seen either way
+        for _root, _dirs, _files in os.walk(path):
+            _wd = self._inotify.add_watch(_root, _WATCH_MASK)
+            if _wd >= 0:
+                self._watches[_wd] = _root
+        try:
+            entries = scan_directory(Path(path))
+        except (ScannerE, OSError):
+            # removed again
+            return
+        for entry in entries:
+            self._submit(os.path.join(path, entry.relpath), lookup=True)
+
+    def _event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            # events were lost, scanning again finds the files written meanwhile
+            self._add_tree(str(self.directory))
+            return
+        _parent = self._watches.get(wd)
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            if _parent == str(self.directory):
+                raise WatchE("%s was removed while watching it" % self.directory)
+            return
+        if _parent is None:
+            return
+        _path = os.path.join(_parent, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(_path)
+        elif mask & IN_CLOSE_WRITE:
+            self._submit(_path, lookup=False)
+        elif mask & IN_MOVED_TO:
+            # a moved file keeps its inode and mtime, it may be cached already
+            self._submit(_path, lookup=True)
+
+    def _submit(self, path: str, lookup: bool):
+        if os.path.dirname(path) == str(self.directory) and os.path.basename(
+            path
+        ) in (MANIFEST_NAME, BINARY_MANIFEST_NAME):
+            return
+        self._executor.submit(self._hash, path, lookup)
+
+    def _hash(self, path: str, lookup: bool):
+        try:
+            if not os.path.isfile(path):
+                return
+            _key = self.cache.stat_key(path)
+            if lookup and self.cache.lookup(_key, self.hash_method) is not None:
+                return
+            _hash = file_hash_create(
+                file_name=Path(path),
+                hash_method=self.hash_method,
+                chunk_size=self.chunk_size,
+            )
+            if self.cache.stat_key(path) != _key:
+                # written again while hashing, closing it is another event
+                return
+        except (OSError, FileHashE):
+            # removed or replaced before it could be hashed
+            return
+        with self._lock:
+            self.hashed += 1
+            self._pending[_key[0]] = (_key, _hash)
+
+    def _journal(self, wait: bool = False):
+        """
+        Store the hashes of files last modified before the racy window of the
+        cache, a file written again within the window is hashed again first as
+        its close is another event
+        :param wait: wait for the window of every pending file to pass
+        """
+        if wait:
+            with self._lock:
+                _youngest = max(
+                    [_key[2] for _key, _hash in self._pending.values()], default=0
+                )
+            _delay = min(_youngest + RACY_WINDOW_NS - time.time_ns(), RACY_WINDOW_NS)
+            if _delay > 0:
+                time.sleep(_delay / 1e9)
+
+        _now = time.time_ns()
+        with self._lock:
+            _ready = [
+                _path
+                for _path, (_key, _hash) in self._pending.items()
+                if _now - _key[2] >= RACY_WINDOW_NS
+            ]
+            _entries = [self._pending.pop(_path) for _path in _ready]
+            if wait:
+                # modified in the future, the cache does not take these
+                self._pending.clear()
+        if not _entries:
+            return
+        for _key, _hash in _entries:
+            self.cache.store(_key, self.hash_method, _hash)
+        # visible to a package run while still watching
+        self.cache.flush()
+        self.journaled += len(_entries)
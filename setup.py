@@ -0,0 +1,13 @@
+from setuptools import Extension, setup
+
+setup(
+    ext_modules=[
+        # FastCDC chunking of the chunk store, chunkstore.py falls back to
+        # pure Python when it cannot be built
+        Extension(
+            "package_wrapper.chunkstore._gear",
+            sources=["package_wrapper/chunkstore/_gear.c"],
+            optional=True,
+        )
+    ]
+)
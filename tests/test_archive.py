@@ -1,10 +1,25 @@
+import gzip
+import hashlib
+import io
 import json
 import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import zipfile
 from pathlib import Path
 from typing import List
 
 import pytest
+from package_wrapper.archiver import archiver
 from package_wrapper.archiver.archiver import Archive, ArchiveE
+from package_wrapper.scanner.scanner import scan_directory
+
+
+class _FailingReader:
+    def read(self, size=-1):
+        raise OSError("read failed")
 
 
 @pytest.fixture()
@@ -47,3 +62,207 @@ class Test_archive:
         archive = Archive(file_name=archive_path, archive_type="zip")
         with pytest.raises(ArchiveE):
             archive.compress(dir_path=faulty_dir_path)
+
+    @pytest.mark.parametrize(
+        "archive_type, threads",
+        [
+            pytest.param("tar.bz2", 1, id="tar.bz2"),
+            pytest.param("tar.xz", 1, id="tar.xz"),
+            pytest.param("tar.gz", 3, id="tar.gz-parallel"),
+            pytest.param("tar.bz2", 2, id="tar.bz2-parallel"),
+            pytest.param("tar.xz", 2, id="tar.xz-parallel"),
+        ],
+    )
+    def test_round_trip(self, generate_files, tmpdir, archive_type, threads):
+        archive_path = Path(tmpdir).joinpath(Path(f"test.{archive_type}"))
+        archive = Archive(
+            file_name=archive_path,
+            archive_type=archive_type,
+            compression_level=1,
+            threads=threads,
+        )
+        archive.compress(dir_path=generate_files)
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        archive.extract(out_dir)
+        for _file in generate_files.glob("**/*"):
+            if _file.is_file():
+                _extracted = out_dir.joinpath(_file.relative_to(generate_files))
+                assert _extracted.read_bytes() == _file.read_bytes()
+
+    def test_parallel_gzip_is_multi_member(self, generate_files, tmpdir, monkeypatch):
+        monkeypatch.setitem(archiver.PARALLEL_BLOCK_SIZE, "tar.gz", 1024)
+        archive_path = Path(tmpdir).joinpath(Path("test.tar.gz"))
+        Archive(archive_path, archive_type="tar.gz", threads=4).compress(generate_files)
+        _compressed = archive_path.read_bytes()
+        assert _compressed.count(b"\x1f\x8b\x08") > 1
+        _tar = gzip.decompress(_compressed)
+        if shutil.which("gunzip"):
+            _gunzip = subprocess.run(
+                ["gunzip", "-c", str(archive_path)], capture_output=True, check=True
+            )
+            assert _gunzip.stdout == _tar
+
+    @pytest.mark.parametrize("archive_type", ["tar.gz", "tar.bz2", "tar.xz"])
+    def test_iter_members_reads_all_blocks(
+        self, generate_files, tmpdir, monkeypatch, archive_type
+    ):
+        monkeypatch.setitem(archiver.PARALLEL_BLOCK_SIZE, archive_type, 1024)
+        archive_path = Path(tmpdir).joinpath(Path(f"test.{archive_type}"))
+        archive = Archive(archive_path, archive_type=archive_type, threads=2)
+        archive.compress(generate_files)
+        members = {_name: _fp.read() for _name, _fp in archive.iter_members()}
+        assert len(members) == 5
+        for _name, _contents in members.items():
+            assert generate_files.joinpath(_name).read_bytes() == _contents
+
+    def test_invalid_compression_level_raises(self, tmpdir):
+        archive_path = Path(tmpdir).joinpath(Path("test.tar.gz"))
+        with pytest.raises(ArchiveE):
+            Archive(archive_path, archive_type="tar.gz", compression_level=10)
+
+    def test_compression_level_for_tar_raises(self, tmpdir):
+        archive_path = Path(tmpdir).joinpath(Path("test.tar"))
+        with pytest.raises(ArchiveE):
+            Archive(archive_path, archive_type="tar", compression_level=6)
+
+    @pytest.mark.skipif(archiver.zstandard is not None, reason="zstandard installed")
+    def test_zstd_requires_zstandard(self, generate_files, tmpdir):
+        archive_path = Path(tmpdir).joinpath(Path("test.tar.zst"))
+        archive = Archive(archive_path, archive_type="tar.zst")
+        with pytest.raises(ArchiveE):
+            archive.compress(dir_path=generate_files)
+
+    @pytest.mark.parametrize("threads", [1, 4])
+    def test_zip_members(self, generate_files, tmpdir, threads):
+        generate_files.joinpath("first/image.png").write_bytes(os.urandom(2048))
+        archive_path = Path(tmpdir).joinpath(Path("test.zip"))
+        Archive(archive_path, archive_type="zip", threads=threads).compress(
+            dir_path=generate_files
+        )
+        with zipfile.ZipFile(archive_path) as zip_ref:
+            assert zip_ref.testzip() is None
+            infos = {info.filename: info for info in zip_ref.infolist()}
+            assert infos["first/image.png"].compress_type == zipfile.ZIP_STORED
+            assert infos["first/test11"].compress_type == zipfile.ZIP_DEFLATED
+            for name in infos:
+                assert zip_ref.read(name) == generate_files.joinpath(name).read_bytes()
+
+    def test_parallel_zip_needs_tested_python(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(archiver, "ZIP_INTERNALS_PYTHON", ((2, 6), (2, 7)))
+        archive_path = Path(tmpdir).joinpath(Path("test.zip"))
+        with pytest.raises(ArchiveE):
+            Archive(archive_path, archive_type="zip", threads=2)
+        Archive(archive_path, archive_type="zip", threads=1)
+
+    def test_zip_link_without_internals(self, generate_files, tmpdir, monkeypatch):
+        monkeypatch.setattr(archiver, "ZIP_INTERNALS_PYTHON", ((2, 6), (2, 7)))
+        archive_path = Path(tmpdir).joinpath(Path("test.zip"))
+        _file = generate_files.joinpath("first/test11")
+        with Archive(archive_path, archive_type="zip").writer() as writer:
+            writer.add_file(_file, arcname="first/test11")
+            writer.add_link(_file, arcname="copy", target="first/test11")
+        with zipfile.ZipFile(archive_path) as zip_ref:
+            assert zip_ref.testzip() is None
+            assert zip_ref.read("copy") == _file.read_bytes()
+
+    def test_parallel_zip_keeps_order(self, generate_files, tmpdir):
+        serial_path = Path(tmpdir).joinpath(Path("serial.zip"))
+        parallel_path = Path(tmpdir).joinpath(Path("parallel.zip"))
+        Archive(serial_path, archive_type="zip").compress(generate_files)
+        Archive(parallel_path, archive_type="zip", threads=3).compress(generate_files)
+        with zipfile.ZipFile(serial_path) as serial, zipfile.ZipFile(
+            parallel_path
+        ) as parallel:
+            assert serial.namelist() == parallel.namelist()
+
+    @pytest.mark.parametrize(
+        "archive_type,seekable", [("tar", False), ("zip", False), ("tar.gz", True)]
+    )
+    def test_extra_member_from_file(
+        self, generate_files, tmpdir, archive_type, seekable
+    ):
+        archive_path = Path(tmpdir).joinpath(Path(f"test.{archive_type}"))
+        contents = os.urandom(4096)
+        spooled = tempfile.TemporaryFile()
+
+        def _member(index):
+            assert (index is not None) == seekable
+            # left at its end, it is read from its start
+            spooled.write(contents)
+            return spooled
+
+        archive = Archive(archive_path, archive_type=archive_type, seekable=seekable)
+        archive.compress(generate_files, extra_members={"extra": _member})
+        assert spooled.closed
+        members = {_name: _fp.read() for _name, _fp in archive.iter_members()}
+        assert members["extra"] == contents
+        if seekable:
+            _offset = archive.seekable_manifest_offset()
+            with archive.open_member_at(_offset) as (_member, _fp):
+                assert _member.name == "extra"
+                assert _fp.read() == contents
+
+    def test_hashes_read_along_entries(self, generate_files, tmpdir):
+        _contents = generate_files.joinpath("first/test11").read_bytes()
+        generate_files.joinpath("second/test22").write_bytes(_contents)
+        entries = scan_directory(generate_files)
+        pairs = [
+            (
+                str(Path(entry.relpath)),
+                "sha256:"
+                + hashlib.sha256(
+                    generate_files.joinpath(entry.relpath).read_bytes()
+                ).hexdigest(),
+            )
+            for entry in entries
+        ]
+        archive_path = Path(tmpdir).joinpath(Path("test.tar"))
+        # the pair of the first file is skipped, it is not archived
+        Archive(archive_path, archive_type="tar").compress(
+            generate_files, entries=entries[1:], hashes=iter(pairs)
+        )
+        with tarfile.open(archive_path) as tar_ref:
+            links = {
+                member.name: member.linkname
+                for member in tar_ref.getmembers()
+                if member.islnk()
+            }
+        assert links == {"second/test22": "first/test11"}
+
+    @pytest.mark.parametrize(
+        "archive_type,threads,seekable",
+        [
+            ("tar", 1, False),
+            ("tar.gz", 1, False),
+            ("tar.gz", 2, False),
+            ("tar.gz", 1, True),
+            ("tar.xz", 1, False),
+            ("zip", 1, False),
+            ("zip", 2, False),
+        ],
+    )
+    def test_failed_read_removes_archive(
+        self, generate_files, tmpdir, archive_type, threads, seekable
+    ):
+        archive_path = Path(tmpdir).joinpath(Path(f"test.{archive_type}"))
+        archive = Archive(
+            archive_path, archive_type=archive_type, threads=threads, seekable=seekable
+        )
+        _file = generate_files.joinpath("first/test11")
+        with pytest.raises(OSError, match="read failed"):
+            with archive.writer() as writer:
+                writer.add_file(_file, arcname="first")
+                writer.add_file(_file, arcname="second", file_pointer=_FailingReader())
+        assert not archive_path.exists()
+
+    def test_failed_read_leaves_stream_unfinished(self, generate_files):
+        output = io.BytesIO()
+        _file = generate_files.joinpath("first/test11")
+        with pytest.raises(OSError, match="read failed"):
+            with Archive(output, archive_type="tar.gz").writer() as writer:
+                writer.add_file(_file, arcname="first")
+                writer.add_file(_file, arcname="second", file_pointer=_FailingReader())
+        assert not output.closed
+        # the gzip stream was never ended
+        with pytest.raises(EOFError):
+            gzip.decompress(output.getvalue())
@@ -0,0 +1,131 @@
+import json
+import os
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pytest
+from package_wrapper.batch.batch import BatchE, load_jobs, run_batch
+from package_wrapper.manifest.hashcache import HashCache
+
+
+@pytest.fixture()
+def batch_dir(tmpdir):
+    base_dir = Path(tmpdir).joinpath("batch")
+    for _name in ("first", "second", "third"):
+        _directory = base_dir.joinpath("components", _name, "sub")
+        _directory.mkdir(parents=True)
+        _directory.joinpath("file").write_bytes(os.urandom(2048))
+    base_dir.joinpath("out").mkdir()
+    yield base_dir
+
+
+def _write_jobs(batch_dir: Path, contents, name="jobs.json") -> Path:
+    path = batch_dir.joinpath(name)
+    path.write_text(json.dumps(contents))
+    return path
+
+
+class TestLoadJobs:
+    def test_defaults_and_paths(self, batch_dir):
+        path = _write_jobs(
+            batch_dir,
+            {
+                "defaults": {"hash-type": "md5", "exclude": "*.tmp"},
+                "jobs": [
+                    {"directory": "components/first"},
+                    {"directory": "components/second", "output": "out/second.zip"},
+                ],
+            },
+        )
+        first, second = load_jobs(path)
+        components = batch_dir.joinpath("components")
+        assert first == {
+            "directory": components.joinpath("first"),
+            "output": components.joinpath("first.tar.gz"),
+            "hash_type": "md5",
+            "exclude": ["*.tmp"],
+        }
+        assert second["output"] == batch_dir.joinpath("out", "second.zip")
+        assert second["archive_type"] == "zip"
+
+    def test_hash_type(self, batch_dir):
+        path = _write_jobs(
+            batch_dir,
+            [
+                {"directory": "components/first", "hash-type": "SHA256, Md5"},
+                {"directory": "components/second", "hash-type": "crc"},
+            ],
+        )
+        with pytest.raises(BatchE) as info:
+            load_jobs(path)
+        assert info.value.msg.startswith("job 2 has an invalid hash-type")
+        _write_jobs(
+            batch_dir, [{"directory": "components/first", "hash-type": "SHA256, Md5"}]
+        )
+        (job,) = load_jobs(path)
+        assert job["hash_type"] == "sha256,md5"
+
+    def test_yaml(self, batch_dir):
+        yaml = pytest.importorskip("yaml")
+        path = batch_dir.joinpath("jobs.yaml")
+        path.write_text(yaml.safe_dump([{"directory": "components/first"}]))
+        (job,) = load_jobs(path)
+        assert job["directory"] == batch_dir.joinpath("components", "first")
+
+    @pytest.mark.parametrize(
+        "contents",
+        [
+            {"directory": "components/first"},
+            [{"directory": "components/first", "compresion-level": 3}],
+            [{"output": "out/first.tar"}],
+            [{"directory": "components/first", "compression-level": "9"}],
+            [{"directory": "components/first", "include": ["*.so", 5]}],
+            [{"directory": "components/first", "hash-type": "sha257"}],
+            [{"directory": "components/first", "hash-type": "md5,MD5"}],
+            [
+                {"directory": "components/first", "output": "out/same.tar"},
+                {"directory": "components/second", "output": "out/same.tar"},
+            ],
+        ],
+    )
+    def test_invalid(self, batch_dir, contents):
+        with pytest.raises(BatchE):
+            load_jobs(_write_jobs(batch_dir, contents))
+
+
+class TestRunBatch:
+    def test_run(self, batch_dir, tmpdir):
+        path = _write_jobs(
+            batch_dir,
+            [
+                {"directory": "components/first", "output": "out/first.tar"},
+                {"directory": "components/missing"},
+                {"directory": "components/second", "output": "out/second.zip"},
+                {"directory": "components/third", "archive-type": "tar.gz"},
+            ],
+        )
+        reported = []
+        with HashCache(cache_dir=Path(tmpdir).joinpath("cache")) as cache:
+            summary = run_batch(
+                load_jobs(path), workers=2, hash_cache=cache, progress=reported.append
+            )
+
+        assert summary["packages"] == 4
+        assert summary["failed"] == 1
+        assert summary["files"] == 3
+        assert [_result["output"] for _result in summary["jobs"]] == [
+            str(batch_dir.joinpath("out", "first.tar")),
+            str(batch_dir.joinpath("components", "missing.tar.gz")),
+            str(batch_dir.joinpath("out", "second.zip")),
+            str(batch_dir.joinpath("components", "third.tar.gz")),
+        ]
+        assert summary["jobs"][1]["error"] is not None
+        assert sorted(_result["output"] for _result in reported) == sorted(
+            _result["output"] for _result in summary["jobs"]
+        )
+        with tarfile.open(batch_dir.joinpath("out", "first.tar")) as tar_ref:
+            assert "sub/file" in tar_ref.getnames()
+        with zipfile.ZipFile(batch_dir.joinpath("out", "second.zip")) as zip_ref:
+            assert zip_ref.testzip() is None
+        assert tarfile.is_tarfile(batch_dir.joinpath("components", "third.tar.gz"))
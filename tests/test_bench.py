@@ -0,0 +1,107 @@
+import copy
+import json
+from pathlib import Path
+
+import pytest
+from package_wrapper.bench.bench import (
+    BenchE,
+    compare_results,
+    generate_tree,
+    result_key,
+    run_benchmarks,
+    tree_bytes,
+)
+
+
+def _contents(directory: Path):
+    return {
+        _file.relative_to(directory): _file.read_bytes()
+        for _file in directory.rglob("*")
+        if _file.is_file()
+    }
+
+
+class TestGenerateTree:
+    def test_same_seed_same_tree(self, tmpdir):
+        first = Path(tmpdir).joinpath("first")
+        second = Path(tmpdir).joinpath("second")
+        size = generate_tree(first, "deep-nesting", scale=0.02, seed=3)
+        generate_tree(second, "deep-nesting", scale=0.02, seed=3)
+        assert size == {"files": 10, "bytes": 10 * 8 * 1024}
+        assert _contents(first) == _contents(second)
+
+    def test_duplicates(self, tmpdir):
+        directory = Path(tmpdir).joinpath("tree")
+        generate_tree(directory, "duplicates", scale=0.05)
+        assert len(set(_contents(directory).values())) == 10
+
+    def test_unknown_tree_raises(self, tmpdir):
+        with pytest.raises(BenchE):
+            generate_tree(Path(tmpdir).joinpath("tree"), "no-such-tree")
+
+    @pytest.mark.parametrize(
+        "tree,scale", [("tiny-files", 0.01), ("huge-files", 1e-5), ("duplicates", 0.01)]
+    )
+    def test_tree_bytes(self, tmpdir, tree, scale):
+        size = generate_tree(Path(tmpdir).joinpath("tree"), tree, scale=scale)
+        assert size["bytes"] == tree_bytes(tree, scale=scale)
+
+
+class TestRunBenchmarks:
+    def test_results(self, tmpdir):
+        results = run_benchmarks(
+            trees=["tiny-files"],
+            hash_methods=["md5"],
+            archive_types=["tar.gz", "zip"],
+            scale=0.002,
+            repeat=1,
+            jobs=2,
+            work_dir=Path(tmpdir),
+        )
+        json.dumps(results)
+        keys = [result_key(_result) for _result in results["results"]]
+        assert "tiny-files/hash[algorithm=md5]" in keys
+        assert "tiny-files/compress[archive type=zip,threads=2]" in keys
+        assert "tiny-files/extract[archive type=tar.gz,verify=True]" in keys
+        assert "tiny-files/verify[directory=True,jobs=2]" in keys
+        for _result in results["results"]:
+            assert _result["files"] == 10
+            assert _result["wall"] >= 0
+        # the generated trees are removed
+        assert list(Path(tmpdir).iterdir()) == []
+
+    def test_unknown_benchmark_raises(self):
+        with pytest.raises(BenchE):
+            run_benchmarks(benchmarks=["compile"])
+
+
+class TestCompare:
+    def test_regression(self):
+        baseline = {
+            "format": 1,
+            "results": [
+                {
+                    "tree": "tiny-files",
+                    "benchmark": "scan",
+                    "parameters": {},
+                    "wall": 1.0,
+                },
+                {
+                    "tree": "tiny-files",
+                    "benchmark": "hash",
+                    "parameters": {"algorithm": "md5"},
+                    "wall": 1.0,
+                },
+            ],
+        }
+        current = copy.deepcopy(baseline)
+        current["results"][0]["wall"] = 1.5
+        current["results"][1]["wall"] = 1.05
+        comparison = compare_results(baseline, current, threshold=0.1)
+        assert [_entry["regression"] for _entry in comparison] == [False, True]
+        assert comparison[1]["benchmark"] == "tiny-files/scan[]"
+        assert comparison[1]["ratio"] == 1.5
+
+    def test_incompatible_format_raises(self):
+        with pytest.raises(BenchE):
+            compare_results({"format": 0, "results": []}, {"format": 1, "results": []})
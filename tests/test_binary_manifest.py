@@ -0,0 +1,120 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+from package_wrapper.manifest.binary import (
+    BINARY_MANIFEST_NAME,
+    BinaryManifest,
+    is_binary_manifest,
+    write_binary_manifest,
+)
+from package_wrapper.manifest.filehash import manifest_entry
+from package_wrapper.manifest.manifest import ManifestE
+from package_wrapper.package import package
+from package_wrapper.verify.verify import load_manifest, verify_directory
+
+FILES = ["a/b", "a/é", "a-c", "z/y/x"]
+
+
+def _sha256(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+@pytest.fixture()
+def binary_manifest(tmpdir):
+    path = Path(tmpdir).joinpath(BINARY_MANIFEST_NAME)
+    write_binary_manifest(
+        path,
+        "sha256",
+        {"package-wrapper": {"version": 1}},
+        [(_name, manifest_entry("sha256", _sha256(_name))) for _name in FILES],
+    )
+    yield path
+
+
+@pytest.fixture()
+def packaged_dir(tmpdir):
+    base_dir = Path(tmpdir).joinpath("base")
+    for _name in FILES:
+        base_dir.joinpath(_name).parent.mkdir(parents=True, exist_ok=True)
+        base_dir.joinpath(_name).write_text(_name)
+    package(
+        base_dir,
+        None,
+        Path(tmpdir).joinpath("out.tar"),
+        "sha256",
+        "tar",
+        binary_manifest=True,
+    )
+    yield base_dir
+
+
+class TestBinaryManifest:
+    def test_lookup(self, binary_manifest):
+        with BinaryManifest(binary_manifest) as manifest:
+            assert len(manifest) == len(FILES)
+            for _name in FILES:
+                assert manifest.lookup(_name) == "sha256:" + _sha256(_name)
+            assert manifest.lookup("a") is None
+            assert manifest.lookup("zz") is None
+
+    def test_as_dict(self, binary_manifest):
+        with BinaryManifest(binary_manifest) as manifest:
+            assert [_name for _name, _digest in manifest] == FILES
+            assert manifest.as_dict() == {
+                "package-wrapper": {"version": 1},
+                "files": {_name: "sha256:" + _sha256(_name) for _name in FILES},
+            }
+
+    def test_several_hash_methods(self, tmpdir):
+        path = Path(tmpdir).joinpath(BINARY_MANIFEST_NAME)
+        _hashes = _sha256("x") + "," + hashlib.md5(b"x").hexdigest()
+        write_binary_manifest(
+            path, "sha256,md5", {}, [("x", manifest_entry("sha256,md5", _hashes))]
+        )
+        with BinaryManifest(path) as manifest:
+            assert manifest.lookup("x") == "sha256,md5:" + _hashes
+
+    def test_unsorted_files_raise(self, tmpdir):
+        with pytest.raises(ManifestE):
+            write_binary_manifest(
+                Path(tmpdir).joinpath(BINARY_MANIFEST_NAME),
+                "sha256",
+                {},
+                [(_name, "sha256:" + _sha256(_name)) for _name in reversed(FILES)],
+            )
+
+    def test_not_a_binary_manifest(self, tmpdir):
+        path = Path(tmpdir).joinpath(BINARY_MANIFEST_NAME)
+        path.write_bytes(b"{}")
+        assert not is_binary_manifest(path)
+        with pytest.raises(ManifestE):
+            BinaryManifest(path)
+
+
+class TestPackageBinaryManifest:
+    def test_verify_uses_binary_manifest(self, packaged_dir):
+        assert is_binary_manifest(packaged_dir.joinpath(BINARY_MANIFEST_NAME))
+        assert load_manifest(packaged_dir.joinpath(BINARY_MANIFEST_NAME)) == (
+            load_manifest(packaged_dir)
+        )
+        result = verify_directory(packaged_dir)
+        assert result.ok
+        assert result.matched == FILES
+
+    def test_reports_missing_extra_and_mismatched(self, packaged_dir):
+        # the manifest.json is not needed, nor read
+        packaged_dir.joinpath("manifest.json").unlink()
+        packaged_dir.joinpath("a/é").unlink()
+        packaged_dir.joinpath("a-c").write_text("changed")
+        packaged_dir.joinpath("a/a").write_text("new")
+        packaged_dir.joinpath("zz").write_text("new")
+        result = verify_directory(packaged_dir)
+        assert result.missing == ["a/é"]
+        assert result.mismatched == ["a-c"]
+        assert result.extra == ["a/a", "zz"]
+
+    def test_stale_binary_manifest_is_removed(self, packaged_dir, tmpdir):
+        package(packaged_dir, None, Path(tmpdir).joinpath("out.tar"), "sha256", "tar")
+        assert not packaged_dir.joinpath(BINARY_MANIFEST_NAME).exists()
+        assert verify_directory(packaged_dir).ok
@@ -0,0 +1,154 @@
+import io
+import json
+import os
+import random
+import zlib
+from pathlib import Path
+
+import pytest
+from package_wrapper.manifest import filehash
+from package_wrapper.manifest.filehash import HashBackend, register_hash_backend
+from package_wrapper.chunkstore import chunkstore
+from package_wrapper.chunkstore.chunkstore import (
+    ChunkStore,
+    ChunkStoreE,
+    iter_chunks,
+    restore_files,
+)
+from package_wrapper.package import package
+
+
+def _random_bytes(size: int, seed: int) -> bytes:
+    return random.Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+
+@pytest.fixture()
+def source_dir(tmpdir):
+    source_dir = Path(tmpdir).joinpath(Path("source"))
+    _shared = _random_bytes(300 * 1024, 1)
+    for _file, _contents in (
+        ("first/test11", _shared),
+        ("first/test12", _random_bytes(200 * 1024, 2)),
+        ("second/test21", _shared),
+        ("second/empty", b""),
+    ):
+        file = source_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(_contents)
+    yield source_dir
+
+
+class _Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+class TestChunking:
+    def test_chunks_join_to_input(self):
+        data = _random_bytes(1024 * 1024, 3)
+        chunks = list(iter_chunks(io.BytesIO(data)))
+        assert b"".join(chunks) == data
+        assert all(len(_chunk) <= 256 * 1024 for _chunk in chunks)
+
+    def test_boundaries_survive_a_prefix_insert(self):
+        data = _random_bytes(1024 * 1024, 4)
+        chunks = set(iter_chunks(io.BytesIO(data)))
+        shifted = set(iter_chunks(io.BytesIO(b"inserted" + data)))
+        # only the chunks around the insert differ
+        assert len(chunks - shifted) <= 2
+
+    @pytest.mark.skipif(chunkstore._gear is None, reason="C extension not built")
+    @pytest.mark.parametrize(
+        "sizes", [(16 * 1024, 64 * 1024, 256 * 1024), (16, 64, 256), (2, 4, 6)]
+    )
+    def test_extension_matches_python(self, monkeypatch, sizes):
+        data = _random_bytes(1024 * 1024, 5)
+        chunks = [len(_chunk) for _chunk in iter_chunks(io.BytesIO(data), *sizes)]
+        monkeypatch.setattr(chunkstore, "_gear", None)
+        expected = [len(_chunk) for _chunk in iter_chunks(io.BytesIO(data), *sizes)]
+        assert chunks == expected
+
+    def test_invalid_sizes_raise(self):
+        with pytest.raises(ChunkStoreE):
+            list(iter_chunks(io.BytesIO(b"data"), min_size=10, avg_size=5))
+
+
+class TestChunkStore:
+    def test_package_and_restore(self, source_dir, tmpdir):
+        store_dir = Path(tmpdir).joinpath(Path("store"))
+        output = Path(tmpdir).joinpath(Path("package.json"))
+        package(source_dir, None, output, "sha256", None, chunk_store=store_dir)
+
+        manifest = json.loads(output.read_bytes())
+        assert manifest["package-wrapper"]["archive type used for packaging"] == "chunks"
+        assert manifest["chunks"]["first/test11"] == manifest["chunks"]["second/test21"]
+
+        out_dir = Path(tmpdir).joinpath(Path("restored"))
+        result = restore_files(store_dir, manifest, out_dir)
+        assert result.ok
+        assert len(result.matched) == 4
+        for _file in manifest["files"]:
+            assert (
+                out_dir.joinpath(_file).read_bytes()
+                == source_dir.joinpath(_file).read_bytes()
+            )
+
+    def test_restore_multiple_hash_methods(self, source_dir, tmpdir):
+        store_dir = Path(tmpdir).joinpath(Path("store"))
+        output = Path(tmpdir).joinpath(Path("package.json"))
+        package(source_dir, None, output, "sha256,md5", None, chunk_store=store_dir)
+        manifest = json.loads(output.read_bytes())
+        assert manifest["files"]["first/test11"][1].startswith("md5:")
+
+        result = restore_files(store_dir, manifest, Path(tmpdir).joinpath("restored"))
+        assert result.ok
+        assert len(result.matched) == 4
+
+    def test_restore_registered_hash_backend(self, source_dir, tmpdir, monkeypatch):
+        monkeypatch.setattr(
+            filehash, "HASH_ALGORITHMS", list(filehash.HASH_ALGORITHMS)
+        )
+        monkeypatch.setattr(filehash, "_HASH_BACKENDS", dict(filehash._HASH_BACKENDS))
+        register_hash_backend(HashBackend("crc32", _Crc32))
+        store_dir = Path(tmpdir).joinpath(Path("store"))
+        output = Path(tmpdir).joinpath(Path("package.json"))
+        package(source_dir, None, output, "crc32", None, chunk_store=store_dir)
+        manifest = json.loads(output.read_bytes())
+        assert manifest["files"]["first/test11"].startswith("crc32:")
+
+        result = restore_files(store_dir, manifest, Path(tmpdir).joinpath("restored"))
+        assert result.ok
+        assert len(result.matched) == 4
+
+    def test_shared_contents_are_stored_once(self, source_dir, tmpdir):
+        store_dir = Path(tmpdir).joinpath(Path("store"))
+        output = Path(tmpdir).joinpath(Path("package.json"))
+        package(source_dir, None, output, "sha256", None, chunk_store=store_dir, jobs=2)
+        _chunks = list(store_dir.joinpath("chunks").rglob("*"))
+
+        source_dir.joinpath("third/test31").parent.mkdir()
+        source_dir.joinpath("third/test31").write_bytes(
+            source_dir.joinpath("first/test12").read_bytes()
+        )
+        package(source_dir, None, output, "sha256", None, chunk_store=store_dir)
+        assert list(store_dir.joinpath("chunks").rglob("*")) == _chunks
+
+    def test_restore_detects_corrupt_chunk(self, source_dir, tmpdir):
+        store_dir = Path(tmpdir).joinpath(Path("store"))
+        output = Path(tmpdir).joinpath(Path("package.json"))
+        package(source_dir, None, output, "sha256", None, chunk_store=store_dir)
+        manifest = json.loads(output.read_bytes())
+
+        store = ChunkStore(store_dir)
+        _chunk_id = manifest["chunks"]["first/test12"][0]
+        store._write(store._chunk_path(_chunk_id), zlib.compress(os.urandom(64)))
+
+        result = restore_files(store_dir, manifest, Path(tmpdir).joinpath("restored"))
+        assert not result.ok
+        assert result.mismatched == ["first/test12"]
@@ -0,0 +1,94 @@
+import json
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+from package_wrapper.delta.delta import DeltaE, apply_delta, compute_delta
+from package_wrapper.package import package
+from package_wrapper.verify.verify import verify_archive, verify_directory
+
+
+@pytest.fixture()
+def base_package(tmpdir):
+    file_list = [
+        "first/test11",
+        "first/test12",
+        "second/test21",
+        "first/first_lvl2/test111",
+    ]
+    base_dir = Path(tmpdir).joinpath(Path("base"))
+    for _file in file_list:
+        file = base_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(os.urandom(2048))
+    output = Path(tmpdir).joinpath(Path("base.tar.gz"))
+    package(base_dir, None, output, "sha256", "tar.gz")
+    yield base_dir, output
+
+
+@pytest.fixture()
+def delta_package(base_package, tmpdir):
+    base_dir, base_output = base_package
+    base_dir.joinpath("first/test12").write_bytes(b"changed")
+    base_dir.joinpath("second/test21").unlink()
+    base_dir.joinpath("third/test31").parent.mkdir()
+    base_dir.joinpath("third/test31").write_bytes(b"added")
+    output = Path(tmpdir).joinpath(Path("delta.tar"))
+    package(base_dir, None, output, "sha256", "tar", base=base_output)
+    yield base_dir, base_output, output
+
+
+class TestDelta:
+    def test_compute_delta(self):
+        base = {"files": {"a": "md5:1", "b": "md5:2", "c": "md5:3"}}
+        delta = compute_delta(base, {"a": "md5:1", "b": "md5:4", "d": "md5:5"})
+        assert delta == {"added": ["d"], "changed": ["b"], "removed": ["c"]}
+
+    def test_compute_delta_other_method_raises(self):
+        with pytest.raises(DeltaE):
+            compute_delta({"files": {"a": "md5:1"}}, {"a": "sha1:1"})
+
+    def test_delta_package_contents(self, delta_package):
+        _, _, output = delta_package
+        with tarfile.open(output) as tar_ref:
+            names = tar_ref.getnames()
+            manifest = json.load(tar_ref.extractfile("manifest.json"))
+        assert names == ["first/test12", "third/test31", "manifest.json"]
+        delta = manifest["package-wrapper"]["delta"]
+        assert delta["removed"] == ["second/test21"]
+        assert delta["base manifest"].startswith("sha256:")
+        assert len(manifest["files"]) == 4
+        assert verify_archive(output).ok
+
+    def test_apply(self, delta_package, tmpdir):
+        base_dir, base_output, output = delta_package
+        out_dir = Path(tmpdir).joinpath(Path("rebuilt"))
+        result = apply_delta(base_output, output, out_dir)
+        assert result.ok
+        assert not out_dir.joinpath("second/test21").exists()
+        assert out_dir.joinpath("first/test12").read_bytes() == b"changed"
+        assert verify_directory(out_dir).ok
+
+    def test_apply_wrong_base_raises(self, delta_package, tmpdir):
+        _, _, output = delta_package
+        with pytest.raises(DeltaE):
+            apply_delta(output, output, Path(tmpdir).joinpath(Path("rebuilt")))
+
+    def test_apply_with_hard_links(self, tmpdir):
+        base_dir = Path(tmpdir).joinpath(Path("base"))
+        base_dir.mkdir()
+        for _name in ("a", "b", "c"):
+            base_dir.joinpath(_name).write_bytes(b"same")
+        base_output = Path(tmpdir).joinpath(Path("base.tar"))
+        package(base_dir, None, base_output, "sha256", "tar")
+        # a is linked from b and c in the base, the rebuilt b must not change with it
+        base_dir.joinpath("a").write_bytes(b"changed")
+        base_dir.joinpath("d").write_bytes(b"changed")
+        output = Path(tmpdir).joinpath(Path("delta.tar"))
+        package(base_dir, None, output, "sha256", "tar", base=base_output)
+
+        out_dir = Path(tmpdir).joinpath(Path("rebuilt"))
+        assert apply_delta(base_output, output, out_dir).ok
+        assert out_dir.joinpath("b").read_bytes() == b"same"
+        assert out_dir.joinpath("d").read_bytes() == b"changed"
@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+from package_wrapper.diff import diff
+from package_wrapper.diff.diff import DiffE, diff_packages
+from package_wrapper.package import package
+
+FILES = ["first/test11", "first/test12", "second/test21", "first/first_lvl2/test111"]
+
+
+@pytest.fixture()
+def packages(tmpdir):
+    old_dir = Path(tmpdir).joinpath("old")
+    for _file in FILES:
+        old_dir.joinpath(_file).parent.mkdir(parents=True, exist_ok=True)
+        old_dir.joinpath(_file).write_bytes(os.urandom(1024))
+    new_dir = Path(tmpdir).joinpath("new")
+    shutil.copytree(old_dir, new_dir)
+    new_dir.joinpath("first/test12").write_bytes(b"changed")
+    new_dir.joinpath("second/test21").unlink()
+    new_dir.joinpath("third").mkdir()
+    new_dir.joinpath("third/test31").write_bytes(b"added")
+    yield old_dir, new_dir
+
+
+def _package(directory: Path, archive_type: str, **options) -> Path:
+    output = directory.with_suffix("." + archive_type)
+    package(directory, None, output, "sha256", archive_type, **options)
+    return output
+
+
+EXPECTED = {
+    "added": ["third/test31"],
+    "changed": ["first/test12"],
+    "removed": ["second/test21"],
+}
+
+
+class TestDiff:
+    @pytest.mark.parametrize("archive_type", ["tar.gz", "zip"])
+    def test_archives(self, packages, archive_type):
+        old_dir, new_dir = packages
+        old = _package(old_dir, archive_type)
+        new = _package(new_dir, archive_type)
+        assert diff_packages(old, new) == EXPECTED
+        assert diff_packages(new, old) == {
+            "added": EXPECTED["removed"],
+            "changed": EXPECTED["changed"],
+            "removed": EXPECTED["added"],
+        }
+
+    def test_identical(self, packages):
+        old_dir, _ = packages
+        old = _package(old_dir, "tar")
+        assert diff_packages(old, old_dir) == {"added": [], "changed": [], "removed": []}
+
+    def test_binary_manifests(self, packages):
+        old_dir, new_dir = packages
+        _package(old_dir, "tar", binary_manifest=True)
+        _package(new_dir, "tar", binary_manifest=True)
+        old_dir.joinpath("manifest.json").unlink()
+        assert diff_packages(old_dir, new_dir) == EXPECTED
+
+    def test_manifests_without_tree(self, packages):
+        old_dir, new_dir = packages
+        _package(old_dir, "tar")
+        _package(new_dir, "tar")
+        _manifest = old_dir.joinpath("manifest.json")
+        contents = json.loads(_manifest.read_text())
+        del contents["package-wrapper"]["tree"]
+        _manifest.write_text(json.dumps(contents))
+        assert diff_packages(_manifest, new_dir) == EXPECTED
+
+    def test_only_differing_directories_are_compared(self, packages, monkeypatch):
+        old_dir, new_dir = packages
+        _package(old_dir, "tar")
+        _package(new_dir, "tar")
+        compared = []
+        _directory_files = diff._Manifest.directory_files
+
+        def _record(self, directory):
+            compared.append(directory)
+            return _directory_files(self, directory)
+
+        monkeypatch.setattr(diff._Manifest, "directory_files", _record)
+        diff_packages(old_dir, new_dir)
+        assert "first/first_lvl2" not in compared
+        assert sorted(set(compared)) == ["", "first", "second", "third"]
+
+    # a second method keeps the method of the tree, only the file entries differ
+    @pytest.mark.parametrize("hash_type", ["md5", "sha256,md5"])
+    def test_different_hash_types_raise(self, packages, hash_type):
+        old_dir, new_dir = packages
+        _package(old_dir, "tar")
+        package(new_dir, None, new_dir.with_suffix(".tar"), hash_type, "tar")
+        with pytest.raises(DiffE) as info:
+            diff_packages(old_dir, new_dir)
+        assert info.value.msg == (
+            "manifests use different hash methods: sha256 vs %s" % hash_type
+        )
@@ -0,0 +1,258 @@
+import gzip
+import io
+import json
+import os
+import tarfile
+import threading
+from pathlib import Path
+
+import pytest
+from package_wrapper.archiver.archiver import Archive, ArchiveE
+from package_wrapper.extract import extract
+from package_wrapper.extract.extract import (
+    ExtractE,
+    extract_members,
+    extract_package,
+)
+from package_wrapper.package import package
+
+
+@pytest.fixture()
+def package_dir(tmpdir):
+    file_list = [
+        "first/test11",
+        "first/test12",
+        "second/test21",
+        "first/first_lvl2/test111",
+    ]
+    base_dir = Path(tmpdir).joinpath(Path("base"))
+    for _file in file_list:
+        file = base_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(os.urandom(4096))
+    base_dir.joinpath("second/copy").write_bytes(
+        base_dir.joinpath("first/test12").read_bytes()
+    )
+    yield base_dir
+
+
+class TestSeekable:
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_archive_layout(self, package_dir, tmpdir, single_pass):
+        output = Path(tmpdir).joinpath(Path("out.tar.gz"))
+        package(
+            package_dir,
+            None,
+            output,
+            "sha256",
+            "tar.gz",
+            single_pass=single_pass,
+            seekable=True,
+            dedup=True,
+        )
+        archive = Archive(output, archive_type="tar.gz")
+        _offset = archive.seekable_manifest_offset()
+        with archive.open_member_at(_offset) as (member, file_pointer):
+            assert member.name == "manifest.json"
+            manifest = json.load(file_pointer)
+        assert manifest == json.loads(package_dir.joinpath("manifest.json").read_text())
+
+        index = manifest["package-wrapper"]["index"]
+        assert sorted(index) == sorted(manifest["files"])
+        assert index["second/copy"] == index["first/test12"]
+        for _name, _offset in index.items():
+            with archive.open_member_at(_offset) as (_, file_pointer):
+                assert file_pointer.read() == package_dir.joinpath(_name).read_bytes()
+        # still a plain tar.gz
+        assert len(gzip.decompress(output.read_bytes())) % 512 == 0
+
+    def test_plain_archive_is_not_seekable(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath(Path("out.tar.gz"))
+        package(package_dir, None, output, "sha256", "tar.gz")
+        assert Archive(output, archive_type="tar.gz").seekable_manifest_offset() is None
+
+    def test_only_tar_gz(self, tmpdir):
+        with pytest.raises(ArchiveE):
+            Archive(Path(tmpdir).joinpath("out.zip"), archive_type="zip", seekable=True)
+
+
+class TestExtractMembers:
+    def test_seeks_to_member(self, package_dir, tmpdir, monkeypatch):
+        output = Path(tmpdir).joinpath(Path("out.tar.gz"))
+        package(package_dir, None, output, "sha256", "tar.gz", seekable=True)
+
+        def _no_streaming(self):
+            raise AssertionError("archive streamed")
+
+        monkeypatch.setattr(Archive, "iter_entries", _no_streaming)
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        result = extract_members(output, ["second/copy", "first/test11"], out_dir)
+        assert result.matched == ["first/test11", "second/copy"]
+        for _name in result.matched:
+            assert (
+                out_dir.joinpath(_name).read_bytes()
+                == package_dir.joinpath(_name).read_bytes()
+            )
+
+    @pytest.mark.parametrize("archive_type", ["tar", "tar.gz", "zip"])
+    def test_streams_other_archives(self, package_dir, tmpdir, archive_type):
+        output = Path(tmpdir).joinpath(Path(f"out.{archive_type}"))
+        package(package_dir, None, output, "sha256", archive_type)
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        # second/copy is a hard link to first/test12 in tar balls
+        result = extract_members(output, ["second/copy", "not/in/package"], out_dir)
+        assert result.matched == ["second/copy"]
+        assert result.missing == ["not/in/package"]
+        assert (
+            out_dir.joinpath("second/copy").read_bytes()
+            == package_dir.joinpath("second/copy").read_bytes()
+        )
+        assert not out_dir.joinpath("first/test12").exists()
+
+    def test_detects_mismatch(self, package_dir, tmpdir):
+        package(package_dir, None, Path(tmpdir).joinpath("out.tar"), "sha256", "tar")
+        package_dir.joinpath("first/test11").write_bytes(b"tampered")
+        tampered = Path(tmpdir).joinpath(Path("tampered.tar"))
+        with tarfile.open(tampered, "w") as tar_ref:
+            for _name in ["first/test11", "manifest.json"]:
+                tar_ref.add(package_dir.joinpath(_name), arcname=_name)
+        result = extract_members(
+            tampered, ["first/test11"], Path(tmpdir).joinpath(Path("out"))
+        )
+        assert result.mismatched == ["first/test11"]
+
+    def test_missing_archive_raises(self, tmpdir):
+        with pytest.raises(ExtractE):
+            extract_members(
+                Path(tmpdir).joinpath("missing.tar.gz"), ["first/test11"], Path(tmpdir)
+            )
+
+
+def _assert_same_tree(package_dir: Path, out_dir: Path):
+    _files = sorted(
+        _file.relative_to(package_dir)
+        for _file in package_dir.rglob("*")
+        if _file.is_file()
+    )
+    assert _files == sorted(
+        _file.relative_to(out_dir) for _file in out_dir.rglob("*") if _file.is_file()
+    )
+    for _file in _files:
+        assert out_dir.joinpath(_file).read_bytes() == package_dir.joinpath(
+            _file
+        ).read_bytes()
+
+
+class TestExtractPackage:
+    @pytest.mark.parametrize(
+        "archive_type, hash_type, seekable, threads",
+        [
+            pytest.param("tar", "sha256", False, 1, id="tar"),
+            pytest.param("tar.gz", "md5", False, 1, id="tar.gz-md5"),
+            pytest.param("tar.xz", "sha256", False, 2, id="tar.xz-parallel"),
+            pytest.param("tar.gz", "sha256", True, 2, id="tar.gz-seekable"),
+            pytest.param("zip", "sha1", False, 2, id="zip"),
+        ],
+    )
+    def test_round_trip(
+        self, package_dir, tmpdir, archive_type, hash_type, seekable, threads
+    ):
+        output = Path(tmpdir).joinpath(Path(f"out.{archive_type}"))
+        package(
+            package_dir,
+            None,
+            output,
+            hash_type,
+            archive_type,
+            compression_threads=threads,
+            seekable=seekable,
+        )
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        result = extract_package(output, out_dir, jobs=3)
+        assert result.ok
+        assert len(result.matched) == 5
+        _assert_same_tree(package_dir, out_dir)
+
+    def test_reports_tampered_and_extra_members(self, package_dir, tmpdir):
+        package(package_dir, None, Path(tmpdir).joinpath("out.tar"), "sha256", "tar")
+        package_dir.joinpath("first/test11").write_bytes(b"tampered")
+        package_dir.joinpath("extra").write_bytes(b"extra")
+        tampered = Path(tmpdir).joinpath(Path("tampered.tar"))
+        with tarfile.open(tampered, "w") as tar_ref:
+            for _name in ["first/test11", "extra", "manifest.json"]:
+                tar_ref.add(package_dir.joinpath(_name), arcname=_name)
+
+        result = extract_package(tampered, Path(tmpdir).joinpath(Path("out")))
+        assert result.mismatched == ["first/test11"]
+        assert result.extra == ["extra"]
+        assert len(result.missing) == 4
+
+    def test_unexpected_write_error_raises(self, tmpdir):
+        writer = extract._WriteBehind(depth=2)
+        # more chunks than the queue holds, the reader must not block
+        source = io.BytesIO(b"x" * 1024)
+        # open() raises ValueError for a name with a null byte
+        destination = Path(tmpdir).joinpath("invalid\0name")
+        with pytest.raises(ExtractE):
+            try:
+                writer.write_member("invalid", source, destination, "sha256", 16)
+            finally:
+                writer.close()
+        assert not writer.thread.is_alive()
+
+    @staticmethod
+    def _failing_archive(event=None):
+        class _FailingReader:
+            reads = 0
+
+            def read(self, size):
+                self.reads += 1
+                if self.reads > 1:
+                    if event is not None:
+                        event.wait(5)
+                    raise OSError("read failed")
+                return b"x" * size
+
+        class _Archive:
+            @staticmethod
+            def iter_entries():
+                yield "member", _FailingReader(), None
+
+        return _Archive()
+
+    def test_read_error_closes_target(self, tmpdir, monkeypatch):
+        targets = []
+        opened = threading.Event()
+
+        def _open(destination):
+            targets.append(open(destination, "wb"))
+            opened.set()
+            return targets[-1]
+
+        monkeypatch.setattr(extract, "_open_destination", _open)
+        with pytest.raises(OSError, match="read failed"):
+            extract._extract_tar(self._failing_archive(opened), {}, Path(tmpdir), 16)
+        assert len(targets) == 1
+        assert targets[0].closed
+
+    def test_read_error_is_not_replaced(self, tmpdir, monkeypatch):
+        opened = threading.Event()
+
+        def _open(destination):
+            opened.set()
+            raise OSError("write failed")
+
+        monkeypatch.setattr(extract, "_open_destination", _open)
+        # the writer fails first, the error of the reader is still the one raised
+        with pytest.raises(OSError, match="read failed"):
+            extract._extract_tar(self._failing_archive(opened), {}, Path(tmpdir), 16)
+
+    def test_write_error_raises(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(package_dir, None, output, "sha256", "tar")
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        out_dir.mkdir()
+        # a file where the package has a directory
+        out_dir.joinpath("first").write_bytes(b"")
+        with pytest.raises(ExtractE):
+            extract_package(output, out_dir)
@@ -1,10 +1,24 @@
+import hashlib
 import json
+import os
+import zlib
 from pathlib import Path
 
 import pytest
+from package_wrapper.manifest import filehash
 from package_wrapper.manifest.filehash import (
+    HASH_ALGORITHMS,
+    FileHashE,
+    HashBackend,
+    available_hash_methods,
     file_hash_check,
+    file_hash_check_hash_file,
+    file_hash_create,
     file_hash_create_hash_file,
+    entry_digest,
+    hash_methods,
+    manifest_entry,
+    register_hash_backend,
 )
 
 
@@ -74,3 +88,112 @@ class TestHashes:
         )
         file_contents = file_path.read_text()
         assert file_contents == f"{expected_hash} hashed_file.json"
+
+    def test_hash_file_check(self, tmpdir, hash_file, expected_hash, hash_method):
+        file_path = Path(tmpdir).joinpath(Path("hash_file.json"))
+        file_hash_create_hash_file(
+            file_path=file_path, file_list=[hash_file], hash_method=hash_method
+        )
+        assert file_hash_check_hash_file(file_path) == {"hashed_file.json": True}
+
+
+@pytest.fixture()
+def binary_file(tmpdir):
+    _path = Path(tmpdir).joinpath(Path("binary_file.bin"))
+    _path.write_bytes(os.urandom(300 * 1024 + 7))
+    yield _path
+
+
+class TestStreamingHash:
+    @pytest.mark.parametrize("chunk_size", [1, 4096, 1024 * 1024])
+    def test_chunk_size_does_not_change_hash(self, binary_file, chunk_size):
+        expected = hashlib.sha256(binary_file.read_bytes()).hexdigest()
+        assert file_hash_create(binary_file, "sha256", chunk_size=chunk_size) == expected
+
+    def test_mmap_path_matches(self, binary_file, monkeypatch):
+        monkeypatch.setattr(filehash, "MMAP_THRESHOLD", 1)
+        expected = hashlib.blake2b(binary_file.read_bytes()).hexdigest()
+        assert file_hash_create(binary_file, "blake2b", chunk_size=65536) == expected
+
+    def test_empty_file(self, tmpdir):
+        _path = Path(tmpdir).joinpath(Path("empty"))
+        _path.write_bytes(b"")
+        assert file_hash_create(_path, "md5") == hashlib.md5(b"").hexdigest()
+
+    def test_invalid_chunk_size_raises(self, binary_file):
+        with pytest.raises(FileHashE):
+            file_hash_create(binary_file, "sha256", chunk_size=0)
+
+
+class TestMultipleHashMethods:
+    def test_hash_methods(self):
+        assert hash_methods("SHA256, blake2b,md5") == ["sha256", "blake2b", "md5"]
+        for _invalid in ("sha256,foo", "md5,md5", ""):
+            with pytest.raises(FileHashE):
+                hash_methods(_invalid)
+
+    @pytest.mark.parametrize("mmap", [True, False])
+    def test_one_read_gives_every_digest(self, binary_file, monkeypatch, mmap):
+        if mmap:
+            monkeypatch.setattr(filehash, "MMAP_THRESHOLD", 1)
+        _data = binary_file.read_bytes()
+        expected = ",".join(
+            [
+                hashlib.sha256(_data).hexdigest(),
+                hashlib.blake2b(_data).hexdigest(),
+                hashlib.md5(_data).hexdigest(),
+            ]
+        )
+        assert file_hash_create(binary_file, "sha256,blake2b,md5") == expected
+        assert file_hash_check(binary_file, "sha256,blake2b,md5:" + expected)
+        assert not file_hash_check(
+            binary_file, "sha256,blake2b,md5:" + expected[:-1] + "x"
+        )
+
+    def test_manifest_entry(self):
+        entry = manifest_entry("sha256,md5", "aa,bb")
+        assert entry == ["sha256:aa", "md5:bb"]
+        assert entry_digest(entry) == "sha256,md5:aa,bb"
+        assert manifest_entry("md5", "bb") == entry_digest("md5:bb") == "md5:bb"
+
+
+class _Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+class TestHashBackends:
+    def test_register(self, binary_file, monkeypatch):
+        monkeypatch.setattr(filehash, "HASH_ALGORITHMS", list(HASH_ALGORITHMS))
+        monkeypatch.setattr(filehash, "_HASH_BACKENDS", dict(filehash._HASH_BACKENDS))
+        register_hash_backend(HashBackend("CRC32", _Crc32))
+        assert "crc32" in filehash.HASH_ALGORITHMS
+        expected = "%08x" % zlib.crc32(binary_file.read_bytes())
+        assert file_hash_create(binary_file, "crc32") == expected
+        assert file_hash_check(binary_file, "crc32:" + expected)
+
+    @pytest.mark.parametrize("mmap", [True, False])
+    def test_blake3(self, binary_file, monkeypatch, mmap):
+        blake3 = pytest.importorskip("blake3")
+        if mmap:
+            monkeypatch.setattr(filehash, "MMAP_THRESHOLD", 1)
+        expected = blake3.blake3(binary_file.read_bytes()).hexdigest()
+        assert file_hash_create(binary_file, "blake3", chunk_size=1000) == expected
+
+    def test_xxh3(self, binary_file):
+        xxhash = pytest.importorskip("xxhash")
+        expected = xxhash.xxh3_64(binary_file.read_bytes()).hexdigest()
+        assert file_hash_check(binary_file, "xxh3:" + expected)
+
+    def test_missing_package(self, binary_file, monkeypatch):
+        monkeypatch.setattr(filehash, "blake3", None)
+        assert "blake3" in HASH_ALGORITHMS
+        assert "blake3" not in available_hash_methods()
+        with pytest.raises(FileHashE):
+            file_hash_create(binary_file, "blake3")
@@ -0,0 +1,101 @@
+import os
+from pathlib import Path
+
+import pytest
+from package_wrapper.manifest import manifest as manifest_module
+from package_wrapper.manifest.hashcache import HashCache, HashCacheE
+from package_wrapper.manifest.manifest import ManifestFile
+
+OLD_MTIME = 1600000000
+
+
+@pytest.fixture()
+def cached_files(tmpdir):
+    base_path = Path(tmpdir).joinpath(Path("files"))
+    base_path.mkdir()
+    for index in range(3):
+        _path = base_path.joinpath(Path(f"file_{index}.txt"))
+        _path.write_text(f"file {index}")
+        # files modified just now are never cached
+        os.utime(_path, (OLD_MTIME, OLD_MTIME))
+    yield base_path
+
+
+@pytest.fixture()
+def cache_dir(tmpdir):
+    yield Path(tmpdir).joinpath(Path("cache"))
+
+
+class TestHashCache:
+    def test_store_and_lookup(self, cached_files, cache_dir):
+        _file = cached_files.joinpath("file_0.txt")
+        with HashCache(cache_dir=cache_dir) as cache:
+            cache.store(HashCache.stat_key(_file), "sha256", "abc")
+        with HashCache(cache_dir=cache_dir) as cache:
+            assert cache.lookup(HashCache.stat_key(_file), "sha256") == "abc"
+            assert cache.lookup(HashCache.stat_key(_file), "md5") is None
+
+    def test_flush(self, cached_files, cache_dir):
+        _file = cached_files.joinpath("file_0.txt")
+        with HashCache(cache_dir=cache_dir) as cache:
+            cache.store(HashCache.stat_key(_file), "sha256", "abc")
+            cache.flush()
+            # seen by another process while the cache is still open
+            with HashCache(cache_dir=cache_dir) as other:
+                assert other.lookup(HashCache.stat_key(_file), "sha256") == "abc"
+
+    def test_changed_file_misses(self, cached_files, cache_dir):
+        _file = cached_files.joinpath("file_0.txt")
+        with HashCache(cache_dir=cache_dir) as cache:
+            cache.store(HashCache.stat_key(_file), "sha256", "abc")
+        _file.write_text("changed")
+        os.utime(_file, (OLD_MTIME + 1, OLD_MTIME + 1))
+        with HashCache(cache_dir=cache_dir) as cache:
+            assert cache.lookup(HashCache.stat_key(_file), "sha256") is None
+
+    def test_recently_modified_file_not_stored(self, cached_files, cache_dir):
+        _file = cached_files.joinpath("file_0.txt")
+        _file.write_text("just written")
+        with HashCache(cache_dir=cache_dir) as cache:
+            cache.store(HashCache.stat_key(_file), "sha256", "abc")
+            cache._flush()
+            assert cache.lookup(HashCache.stat_key(_file), "sha256") is None
+
+    def test_rehash_ignores_entries(self, cached_files, cache_dir):
+        _file = cached_files.joinpath("file_0.txt")
+        with HashCache(cache_dir=cache_dir) as cache:
+            cache.store(HashCache.stat_key(_file), "sha256", "abc")
+        with HashCache(cache_dir=cache_dir, rehash=True) as cache:
+            assert cache.lookup(HashCache.stat_key(_file), "sha256") is None
+
+    def test_least_recently_used_evicted(self, cached_files, cache_dir):
+        _keys = [
+            HashCache.stat_key(cached_files.joinpath(f"file_{index}.txt"))
+            for index in range(3)
+        ]
+        with HashCache(cache_dir=cache_dir, max_entries=2) as cache:
+            for key in _keys:
+                cache.store(key, "sha256", key[0])
+        with HashCache(cache_dir=cache_dir, max_entries=2) as cache:
+            assert cache.lookup(_keys[0], "sha256") is None
+            assert cache.lookup(_keys[1], "sha256") == _keys[1][0]
+            assert cache.lookup(_keys[2], "sha256") == _keys[2][0]
+
+    def test_invalid_size_raises(self, cache_dir):
+        with pytest.raises(HashCacheE):
+            HashCache(cache_dir=cache_dir, max_entries=0)
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_manifest_uses_cache(self, cached_files, cache_dir, monkeypatch, jobs):
+        with HashCache(cache_dir=cache_dir) as cache:
+            first = ManifestFile(hash_method="sha256", jobs=jobs, cache=cache)
+            first.add_folder(cached_files)
+
+        def _fail(*args):
+            raise AssertionError("cached file was hashed again")
+
+        monkeypatch.setattr(manifest_module, "_hash_artifact", _fail)
+        with HashCache(cache_dir=cache_dir) as cache:
+            second = ManifestFile(hash_method="sha256", jobs=jobs, cache=cache)
+            second.add_folder(cached_files)
+        assert second.retrive_contents() == first.retrive_contents()
@@ -3,7 +3,7 @@ import re
 from pathlib import Path
 
 import pytest
-from package_wrapper.manifest.manifest import ManifestE, ManifestFile
+from package_wrapper.manifest.manifest import ManifestE, ManifestFile, merkle_tree
 
 TIME_FORMAT = re.compile(
     r"[0-3][0-9]\/[0-1][0-9]\/[0-9][0-9][0-9][0-9] [0-2][0-9]:[0-6][0-9]:[0-6][0-9]"
@@ -67,6 +67,41 @@ class TestManifest:
         assert "files" in manifest.database
 
 
+@pytest.fixture()
+def wide_folder_structure(tmpdir):
+    base_path = Path(tmpdir).joinpath(Path("wide"))
+    for index in range(40):
+        _path = base_path.joinpath(Path(f"dir_{index % 5}/file_{index}.txt"))
+        _path.parent.mkdir(parents=True, exist_ok=True)
+        _path.write_text(f"contents of file {index}\n" * index)
+    yield base_path
+
+
+class TestParallelManifest:
+    @pytest.mark.parametrize(
+        "jobs, use_processes",
+        [
+            pytest.param(4, False, id="threads"),
+            pytest.param(0, False, id="threads-per-core"),
+            pytest.param(2, True, id="processes"),
+        ],
+    )
+    def test_parallel_matches_serial(self, wide_folder_structure, jobs, use_processes):
+        serial = ManifestFile(hash_method="sha256")
+        serial.add_folder(wide_folder_structure)
+        parallel = ManifestFile(
+            hash_method="sha256", jobs=jobs, use_processes=use_processes
+        )
+        parallel.add_folder(wide_folder_structure)
+        assert json.dumps(parallel.retrive_contents(), indent=3) == json.dumps(
+            serial.retrive_contents(), indent=3
+        )
+
+    def test_invalid_jobs_raises(self):
+        with pytest.raises(ManifestE):
+            ManifestFile(hash_method="sha256", jobs=-1)
+
+
 class TestMetaData:
     def test_add_meta_data(self):
         manifest = ManifestFile(hash_method="sha256")
@@ -82,3 +117,78 @@ class TestMetaData:
         assert manifest.database["second"] == 2
         assert manifest.database["third"] == 3
         assert manifest.database["fourth"] == 4
+
+
+class TestCheckHashes:
+    def test_check_hashes_in_db(self, folder_structure):
+        manifest = ManifestFile(hash_method="sha256")
+        dir_path, file_path = folder_structure
+        manifest.add_folder(dir_path)
+        assert manifest.check_hashes_in_db(base_path=dir_path)
+        file_path.write_text("changed")
+        assert not manifest.check_hashes_in_db(base_path=dir_path)
+
+
+class TestStreamedManifest:
+    @pytest.mark.parametrize("indent", [3, None])
+    @pytest.mark.parametrize("hash_method", ["sha256", "sha256,md5"])
+    def test_spool_matches_memory(self, wide_folder_structure, indent, hash_method):
+        in_memory = ManifestFile(hash_method=hash_method, indent=indent)
+        in_memory.add_meta_data("package-wrapper", {"nested": [1, 2]})
+        in_memory.add_folder(wide_folder_structure)
+        spooled = ManifestFile(hash_method=hash_method, indent=indent, spool=True)
+        spooled.add_meta_data("package-wrapper", {"nested": [1, 2]})
+        spooled.add_folder(wide_folder_structure)
+
+        _expected = json.dumps(
+            in_memory.retrive_contents(),
+            indent=indent,
+            separators=(",", ":") if indent is None else None,
+        ).encode()
+        assert in_memory.serialize() == _expected
+        assert spooled.serialize() == _expected
+        assert spooled.retrive_contents() == in_memory.retrive_contents()
+        assert spooled.file_digests() == in_memory.file_digests()
+
+    def test_empty_spool(self):
+        manifest = ManifestFile(hash_method="sha256", spool=True)
+        assert json.loads(manifest.serialize()) == {"files": {}}
+
+    def test_spool_requires_sorted_files(self):
+        manifest = ManifestFile(hash_method="sha256", spool=True)
+        manifest.add_artifact_hash(Path("a/b"), "00")
+        manifest.add_artifact_hash(Path("a-c"), "00")
+        with pytest.raises(ManifestE):
+            manifest.add_artifact_hash(Path("a/c"), "00")
+        with pytest.raises(ManifestE):
+            manifest.add_artifact_hash(Path("a-c"), "00")
+
+
+class TestMerkleTree:
+    FILES = [("a/b/x", "sha256:1"), ("a/c", "sha256:2"), ("a-c", "sha256:3")]
+
+    def test_directories(self):
+        tree = merkle_tree(self.FILES, "sha256")
+        assert tree["hash method"] == "sha256"
+        assert sorted(tree["directories"]) == ["a", "a/b"]
+
+    def test_change_propagates_to_the_root(self):
+        tree = merkle_tree(self.FILES, "sha256")
+        changed = merkle_tree(
+            [self.FILES[0], ("a/c", "sha256:0"), self.FILES[2]], "sha256"
+        )
+        assert changed["directories"]["a/b"] == tree["directories"]["a/b"]
+        assert changed["directories"]["a"] != tree["directories"]["a"]
+        assert changed["root"] != tree["root"]
+
+    def test_unsorted_files_raise(self):
+        with pytest.raises(ManifestE):
+            merkle_tree(list(reversed(self.FILES)), "sha256")
+
+    def test_spool_matches_memory(self, wide_folder_structure):
+        in_memory = ManifestFile(hash_method="sha256")
+        in_memory.add_folder(wide_folder_structure)
+        spooled = ManifestFile(hash_method="sha256", spool=True)
+        spooled.add_folder(wide_folder_structure)
+        assert in_memory.merkle_tree() == spooled.merkle_tree()
+        assert len(in_memory.merkle_tree()["directories"]) == 5
@@ -0,0 +1,440 @@
+import asyncio
+import json
+import os
+import tarfile
+import threading
+import zipfile
+from pathlib import Path
+
+import pytest
+from package_wrapper import package as package_module
+from package_wrapper.manifest.filehash import HashingReader, file_hash_create
+from package_wrapper.manifest.manifest import ManifestFile
+from package_wrapper.package import (
+    PackageE,
+    create_package,
+    package,
+    package_async,
+)
+from package_wrapper.stats.stats import StatsSink
+from package_wrapper.verify.verify import load_manifest, verify_archive
+
+
+@pytest.fixture()
+def package_dir(tmpdir):
+    file_list = [
+        "first/test11",
+        "first/test12",
+        "second/test21",
+        "first/first_lvl2/test111",
+    ]
+    base_dir = Path(tmpdir).joinpath(Path("base"))
+    for _file in file_list:
+        file = base_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(os.urandom(4096))
+    yield base_dir
+
+
+def _members(output: Path, archive_type: str):
+    if archive_type == "zip":
+        with zipfile.ZipFile(output) as zip_ref:
+            names = zip_ref.namelist()
+            return names, json.loads(zip_ref.read(names[-1]))
+    with tarfile.open(output) as tar_ref:
+        names = tar_ref.getnames()
+        return names, json.load(tar_ref.extractfile(names[-1]))
+
+
+class TestPackage:
+    @pytest.mark.parametrize("archive_type", ["tar", "tar.gz", "zip"])
+    def test_single_pass(self, package_dir, tmpdir, archive_type):
+        output = Path(tmpdir).joinpath(Path(f"out.{archive_type}"))
+        package(package_dir, None, output, "sha256", archive_type)
+
+        names, manifest = _members(output, archive_type)
+        assert names[-1] == "manifest.json"
+        assert sorted(names[:-1]) == sorted(manifest["files"])
+        for name, _hash in manifest["files"].items():
+            expected = file_hash_create(package_dir.joinpath(name), "sha256")
+            assert _hash == f"sha256:{expected}"
+        assert json.loads(package_dir.joinpath("manifest.json").read_text()) == manifest
+
+    def test_single_pass_matches_two_pass(self, package_dir, tmpdir):
+        single = Path(tmpdir).joinpath(Path("single.tar"))
+        package(package_dir, None, single, "md5", "tar")
+        package_dir.joinpath("manifest.json").unlink()
+        two_pass = Path(tmpdir).joinpath(Path("two_pass.tar"))
+        package(package_dir, None, two_pass, "md5", "tar", jobs=2, single_pass=False)
+
+        _, single_manifest = _members(single, "tar")
+        two_pass_manifest = json.loads(package_dir.joinpath("manifest.json").read_text())
+        assert single_manifest["files"] == two_pass_manifest["files"]
+
+    @pytest.mark.parametrize("archive_type", ["tar", "tar.gz", "zip"])
+    def test_symlinked_file(self, package_dir, tmpdir, archive_type):
+        os.symlink(
+            package_dir.joinpath("first/test11"), package_dir.joinpath("second/link")
+        )
+        single = Path(tmpdir).joinpath(Path(f"single.{archive_type}"))
+        package(package_dir, None, single, "sha256", archive_type)
+        two_pass = Path(tmpdir).joinpath(Path(f"two_pass.{archive_type}"))
+        package(package_dir, None, two_pass, "sha256", archive_type, single_pass=False)
+
+        _, single_manifest = _members(single, archive_type)
+        _, two_pass_manifest = _members(two_pass, archive_type)
+        assert single_manifest["files"] == two_pass_manifest["files"]
+        expected = file_hash_create(package_dir.joinpath("first/test11"), "sha256")
+        assert single_manifest["files"]["second/link"] == f"sha256:{expected}"
+        assert verify_archive(single).ok
+        assert verify_archive(two_pass).ok
+
+    @pytest.mark.parametrize("archive_type", ["tar", "zip"])
+    def test_single_pass_jobs(self, package_dir, tmpdir, monkeypatch, archive_type):
+        _read_and_hash = package_module._read_and_hash
+        threads = set()
+
+        def _read_ahead(*args):
+            threads.add(threading.current_thread())
+            return _read_and_hash(*args)
+
+        monkeypatch.setattr(package_module, "_read_and_hash", _read_ahead)
+        serial = Path(tmpdir).joinpath(Path(f"serial.{archive_type}"))
+        package(package_dir, None, serial, "sha256", archive_type)
+        assert not threads
+
+        parallel = Path(tmpdir).joinpath(Path(f"parallel.{archive_type}"))
+        package(package_dir, None, parallel, "sha256", archive_type, jobs=2)
+        assert threads and threading.current_thread() not in threads
+        serial_names, serial_manifest = _members(serial, archive_type)
+        parallel_names, parallel_manifest = _members(parallel, archive_type)
+        assert serial_names == parallel_names
+        assert serial_manifest["files"] == parallel_manifest["files"]
+        assert verify_archive(parallel).ok
+
+    def test_repackaging_skips_previous_manifest(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(package_dir, None, output, "sha256", "tar")
+        package(package_dir, None, output, "sha256", "tar")
+        names, manifest = _members(output, "tar")
+        assert names.count("manifest.json") == 1
+        assert "manifest.json" not in manifest["files"]
+
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_exclude(self, package_dir, tmpdir, single_pass):
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(
+            package_dir,
+            None,
+            output,
+            "sha256",
+            "tar",
+            single_pass=single_pass,
+            exclude=["first/first_lvl2"],
+        )
+        names, manifest = _members(output, "tar")
+        assert names == ["first/test11", "first/test12", "second/test21", "manifest.json"]
+        assert list(manifest["files"]) == names[:-1]
+
+
+class TestDedup:
+    @pytest.fixture()
+    def duplicated_dir(self, package_dir):
+        _contents = package_dir.joinpath("first/test11").read_bytes()
+        package_dir.joinpath("second/copy").write_bytes(_contents)
+        package_dir.joinpath("third/copy").parent.mkdir()
+        package_dir.joinpath("third/copy").write_bytes(_contents)
+        yield package_dir
+
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_tar_duplicates_are_hard_links(self, duplicated_dir, tmpdir, single_pass):
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(
+            duplicated_dir,
+            None,
+            output,
+            "sha256",
+            "tar",
+            single_pass=single_pass,
+            dedup=True,
+        )
+        with tarfile.open(output) as tar_ref:
+            links = {
+                member.name: member.linkname
+                for member in tar_ref.getmembers()
+                if member.islnk()
+            }
+        assert links == {"second/copy": "first/test11", "third/copy": "first/test11"}
+
+        out_dir = Path(tmpdir).joinpath(Path("out"))
+        with tarfile.open(output) as tar_ref:
+            tar_ref.extractall(out_dir)
+        for _file in ("first/test11", "second/copy", "third/copy"):
+            assert (
+                out_dir.joinpath(_file).read_bytes()
+                == duplicated_dir.joinpath(_file).read_bytes()
+            )
+
+    @pytest.mark.parametrize("threads", [1, 2])
+    def test_zip_duplicates(self, duplicated_dir, tmpdir, threads):
+        output = Path(tmpdir).joinpath(Path("out.zip"))
+        package(
+            duplicated_dir,
+            None,
+            output,
+            "sha256",
+            "zip",
+            compression_threads=threads,
+            dedup=True,
+        )
+        with zipfile.ZipFile(output) as zip_ref:
+            assert zip_ref.testzip() is None
+            for name in ("first/test11", "second/copy", "third/copy"):
+                assert (
+                    zip_ref.read(name)
+                    == duplicated_dir.joinpath("first/test11").read_bytes()
+                )
+
+    def test_no_dedup_by_default(self, duplicated_dir, tmpdir, monkeypatch):
+        def _hash_entries(*args):
+            raise AssertionError("files were hashed before archiving")
+
+        # every file is read once, while it is archived
+        monkeypatch.setattr(ManifestFile, "hash_entries", _hash_entries)
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(duplicated_dir, None, output, "sha256", "tar")
+        with tarfile.open(output) as tar_ref:
+            assert not any(member.islnk() for member in tar_ref.getmembers())
+
+
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_streamed_manifest(self, duplicated_dir, tmpdir, monkeypatch, single_pass):
+        def _in_memory(*args):
+            raise AssertionError("the manifest was held in memory")
+
+        # hashes are looked up per file and the manifest member is copied from a file
+        monkeypatch.setattr(ManifestFile, "file_digests", _in_memory)
+        monkeypatch.setattr(ManifestFile, "serialize", _in_memory)
+        output = Path(tmpdir).joinpath(Path("out.tar"))
+        package(
+            duplicated_dir,
+            None,
+            output,
+            "sha256",
+            "tar",
+            single_pass=single_pass,
+            dedup=True,
+            stream_manifest=True,
+        )
+        with tarfile.open(output) as tar_ref:
+            links = {
+                member.name: member.linkname
+                for member in tar_ref.getmembers()
+                if member.islnk()
+            }
+        assert links == {"second/copy": "first/test11", "third/copy": "first/test11"}
+        _, manifest = _members(output, "tar")
+        assert manifest == json.loads(
+            duplicated_dir.joinpath("manifest.json").read_bytes()
+        )
+        assert len(manifest["files"]) == 6
+
+
+class _BlockingSink(StatsSink):
+    """
+    Holds the packaging thread at its first file until released
+    """
+
+    def __init__(self):
+        self.reached = threading.Event()
+        self.release = threading.Event()
+
+    def advance(self, stage, files, size):
+        if not self.reached.is_set():
+            self.reached.set()
+            self.release.wait()
+
+
+class TestCreatePackage:
+    def test_errors_are_package_errors(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath("missing", "out.tar")
+        with pytest.raises(PackageE):
+            create_package(package_dir, None, output, "sha256", "tar")
+
+    @pytest.mark.parametrize("archive_type", ["tar.gz", "zip"])
+    def test_failed_package_is_removed(
+        self, package_dir, tmpdir, monkeypatch, archive_type
+    ):
+        class _FailingReader(HashingReader):
+            def read(self, size=-1):
+                raise OSError("read failed")
+
+        monkeypatch.setattr(package_module, "HashingReader", _FailingReader)
+        output = Path(tmpdir).joinpath(f"out.{archive_type}")
+        with pytest.raises(OSError, match="read failed"):
+            create_package(package_dir, None, output, "sha256", archive_type)
+        assert not output.exists()
+
+    def test_returns_output(self, package_dir, tmpdir):
+        output = create_package(package_dir, None, None, "sha256", "zip")
+        assert output == package_dir.parent.joinpath("output.zip")
+        assert zipfile.is_zipfile(output)
+
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_compact_streamed_manifest(self, package_dir, tmpdir, single_pass):
+        output = Path(tmpdir).joinpath("out.tar")
+        create_package(
+            package_dir,
+            None,
+            output,
+            "sha256",
+            "tar",
+            single_pass=single_pass,
+            compact_manifest=True,
+            stream_manifest=True,
+        )
+        _, manifest = _members(output, "tar")
+        contents = package_dir.joinpath("manifest.json").read_bytes()
+        assert b": " not in contents and b"\n" not in contents
+        assert json.loads(contents) == manifest
+        assert len(manifest["files"]) == 4
+
+
+class _Pipe:
+    """
+    write only file object without tell() or seek(), like a pipe
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data) -> int:
+        self.data += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class TestStreamedPackage:
+    @pytest.mark.parametrize("archive_type", ["tar", "tar.gz", "tar.bz2", "tar.xz"])
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_stream(self, package_dir, tmpdir, archive_type, single_pass):
+        pipe = _Pipe()
+        create_package(
+            package_dir,
+            None,
+            pipe,
+            "sha256",
+            archive_type,
+            single_pass=single_pass,
+        )
+        output = Path(tmpdir).joinpath(f"out.{archive_type}")
+        output.write_bytes(bytes(pipe.data))
+        names, manifest = _members(output, archive_type)
+        assert names[-1] == "manifest.json"
+        assert sorted(names[:-1]) == sorted(manifest["files"])
+        assert not package_dir.joinpath("manifest.json").exists()
+        assert verify_archive(output).ok
+
+    @pytest.mark.parametrize("compression_threads", [1, 2])
+    def test_stream_seekable(self, package_dir, tmpdir, compression_threads):
+        pipe = _Pipe()
+        create_package(
+            package_dir,
+            None,
+            pipe,
+            "sha256",
+            "tar.gz",
+            seekable=True,
+            compression_threads=compression_threads,
+        )
+        output = Path(tmpdir).joinpath("out.tar.gz")
+        output.write_bytes(bytes(pipe.data))
+        assert verify_archive(output).ok
+        assert load_manifest(output)["files"]
+
+    def test_write_manifest(self, package_dir):
+        pipe = _Pipe()
+        create_package(package_dir, None, pipe, "sha256", "tar", write_manifest=True)
+        assert json.loads(package_dir.joinpath("manifest.json").read_text())["files"]
+
+    def test_no_write_manifest_to_file(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath("out.tar")
+        create_package(
+            package_dir, None, output, "sha256", "tar", write_manifest=False
+        )
+        assert not package_dir.joinpath("manifest.json").exists()
+        assert verify_archive(output).ok
+
+    def test_zip_cannot_be_streamed(self, package_dir):
+        with pytest.raises(PackageE):
+            create_package(package_dir, None, _Pipe(), "sha256", "zip")
+
+    def test_binary_manifest_needs_directory_manifest(self, package_dir):
+        with pytest.raises(PackageE):
+            create_package(
+                package_dir, None, _Pipe(), "sha256", "tar", binary_manifest=True
+            )
+
+
+class TestPackageAsync:
+    def test_concurrent_packages(self, tmpdir):
+        directories = []
+        for index in range(4):
+            directory = Path(tmpdir).joinpath(f"tree{index}")
+            directory.joinpath("sub").mkdir(parents=True)
+            directory.joinpath("sub", "file").write_bytes(os.urandom(4096))
+            directories.append(directory)
+        events = []
+
+        async def _package_all():
+            limit = asyncio.Semaphore(2)
+            return await asyncio.gather(
+                *[
+                    package_async(
+                        directory,
+                        output=directory.with_suffix(".tar.gz"),
+                        limit=limit,
+                        progress=events.append,
+                        jobs=2,
+                    )
+                    for directory in directories
+                ]
+            )
+
+        outputs = asyncio.run(_package_all())
+        assert outputs == [directory.with_suffix(".tar.gz") for directory in directories]
+        for directory, output in zip(directories, outputs):
+            names, manifest = _members(output, "tar.gz")
+            assert "sub/file" in manifest["files"]
+            finished = [
+                event
+                for event in events
+                if event.directory == directory and event.event == "finished"
+            ]
+            assert [event.stage for event in finished] == ["scan", "hash and archive"]
+            assert finished[-1].files == 1
+
+    def test_cancel(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath("out.tar.gz")
+        sink = _BlockingSink()
+
+        async def _cancel():
+            task = asyncio.ensure_future(
+                package_async(package_dir, output=output, sinks=[sink])
+            )
+            await asyncio.get_running_loop().run_in_executor(None, sink.reached.wait)
+            task.cancel()
+            sink.release.set()
+            await task
+
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(_cancel())
+        assert not output.exists()
+        assert not package_dir.joinpath("manifest.json").exists()
+
+    def test_errors(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath("missing", "out.tar")
+        with pytest.raises(PackageE):
+            asyncio.run(package_async(package_dir, output=output))
@@ -0,0 +1,60 @@
+import os
+from pathlib import Path
+
+import pytest
+from package_wrapper.scanner.scanner import ScannerE, scan_directory
+
+
+@pytest.fixture()
+def tree(tmpdir):
+    file_list = [
+        "a/b/file1.txt",
+        "a-c/file2.log",
+        "a/file3.bin",
+        "top.txt",
+        "logs/build.log",
+    ]
+    base_dir = Path(tmpdir).joinpath(Path("tree"))
+    for _file in file_list:
+        file = base_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(_file.encode())
+    base_dir.joinpath("empty_dir").mkdir()
+    yield base_dir
+
+
+class TestScanner:
+    def test_lists_files_in_path_order(self, tree):
+        expected = sorted(
+            _file.relative_to(tree) for _file in tree.glob("**/*") if _file.is_file()
+        )
+        entries = scan_directory(tree)
+        assert [Path(entry.relpath) for entry in entries] == expected
+
+    def test_entry_stat(self, tree):
+        entry = [entry for entry in scan_directory(tree) if entry.relpath == "top.txt"][0]
+        _stat = os.stat(tree.joinpath("top.txt"))
+        assert entry.size == _stat.st_size == len(b"top.txt")
+        assert entry.mtime_ns == _stat.st_mtime_ns
+        assert entry.inode == _stat.st_ino
+
+    def test_include_and_exclude(self, tree):
+        entries = scan_directory(tree, include=["*.txt", "*.log"], exclude=["logs"])
+        assert [entry.relpath for entry in entries] == [
+            "a/b/file1.txt",
+            "a-c/file2.log",
+            "top.txt",
+        ]
+
+    def test_symlinks(self, tree):
+        os.symlink(tree.joinpath("top.txt"), tree.joinpath("link.txt"))
+        os.symlink(tree.joinpath("a"), tree.joinpath("link_dir"))
+        os.symlink(tree.joinpath("missing"), tree.joinpath("dangling"))
+        relpaths = [entry.relpath for entry in scan_directory(tree)]
+        assert "link.txt" in relpaths
+        assert not [_path for _path in relpaths if _path.startswith("link_dir")]
+        assert "dangling" not in relpaths
+
+    def test_not_a_directory_raises(self, tree):
+        with pytest.raises(ScannerE):
+            scan_directory(tree.joinpath("top.txt"))
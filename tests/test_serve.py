@@ -0,0 +1,258 @@
+import asyncio
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+from package_wrapper.manifest.hashcache import HashCache, MemoryHashCache
+from package_wrapper.serve import client
+from package_wrapper.serve.client import ServeE, is_running, request
+from package_wrapper.serve.serve import PackageServer
+
+
+@pytest.fixture()
+def tree(tmpdir):
+    base_dir = Path(tmpdir).joinpath("tree")
+    for index in range(10):
+        _path = base_dir.joinpath(f"dir_{index % 2}", f"file_{index}")
+        _path.parent.mkdir(parents=True, exist_ok=True)
+        _path.write_bytes(os.urandom(1024))
+        # older than the racy window of the index
+        os.utime(_path, ns=(0, 0))
+    yield base_dir
+
+
+def _serve(server: PackageServer, *requests):
+    """
+    Send the requests one after the other to a served server
+    :return: the response of every request
+    """
+
+    async def _scenario():
+        ready = asyncio.Event()
+        serving = asyncio.ensure_future(server.serve(ready=ready.set))
+        await ready.wait()
+        loop = asyncio.get_running_loop()
+        responses = []
+        for _message in requests:
+            responses.append(
+                await loop.run_in_executor(
+                    None, request, _message, server.socket_path
+                )
+            )
+        await loop.run_in_executor(
+            None, request, {"command": "stop"}, server.socket_path
+        )
+        await serving
+        return responses
+
+    return asyncio.run(_scenario())
+
+
+class TestMemoryHashCache:
+    def test_lookup(self, tree):
+        _file = tree.joinpath("dir_0", "file_0")
+        index = MemoryHashCache(max_entries=2)
+        key = index.stat_key(_file)
+        index.store(key, "SHA256", "abc")
+        assert index.lookup(key, "sha256") == "abc"
+        assert index.lookup(key, "md5") is None
+        _file.write_bytes(b"changed")
+        assert index.lookup(index.stat_key(_file), "sha256") is None
+
+    def test_evicts_least_recently_used(self, tree):
+        index = MemoryHashCache(max_entries=2)
+        keys = [index.stat_key(tree.joinpath("dir_0", f"file_{n}")) for n in (0, 2, 4)]
+        index.store(keys[0], "sha256", "0")
+        index.store(keys[1], "sha256", "1")
+        index.lookup(keys[0], "sha256")
+        index.store(keys[2], "sha256", "2")
+        assert len(index) == 2
+        assert index.lookup(keys[1], "sha256") is None
+        assert index.lookup(keys[0], "sha256") == "0"
+
+    def test_persistent_cache(self, tree, tmpdir):
+        key = MemoryHashCache.stat_key(tree.joinpath("dir_0", "file_0"))
+        with MemoryHashCache(persistent=HashCache(Path(tmpdir, "cache"))) as index:
+            index.store(key, "sha256", "abc")
+        with MemoryHashCache(persistent=HashCache(Path(tmpdir, "cache"))) as index:
+            assert index.lookup(key, "sha256") == "abc"
+            assert len(index) == 1
+
+
+class TestPackageServer:
+    def test_package_and_verify(self, tree, tmpdir):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"), workers=2)
+        _package = {
+            "command": "package",
+            "cwd": str(tmpdir),
+            "job": {"directory": "tree", "output": "out.tar"},
+        }
+        responses = _serve(
+            server,
+            _package,
+            _package,
+            {"command": "verify", "cwd": str(tmpdir), "path": "out.tar"},
+            {"command": "status"},
+        )
+        assert [_response["ok"] for _response in responses] == [True] * 4
+        assert responses[0]["files"] == 10
+        with tarfile.open(Path(tmpdir, "out.tar")) as tar_ref:
+            assert len(tar_ref.getnames()) == 11
+        assert responses[2]["matched"] == sorted(
+            str(_path.relative_to(tree).as_posix())
+            for _path in tree.rglob("file_*")
+        )
+        assert responses[3]["index entries"] == 10
+        assert responses[3]["requests"] == 4
+        assert not Path(tmpdir, "pkgwrap.sock").exists()
+
+    def test_unchanged_files_are_not_hashed_again(self, tree, tmpdir, monkeypatch):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+        _package = {
+            "command": "package",
+            "job": {"directory": str(tree), "output": str(Path(tmpdir, "out.tar"))},
+        }
+        _serve(server, _package)
+
+        def _lookup(key, hash_method):
+            _hash = MemoryHashCache.lookup(server.index, key, hash_method)
+            assert _hash is not None
+            return _hash
+
+        monkeypatch.setattr(server.index, "lookup", _lookup)
+        assert _serve(server, _package)[0]["ok"]
+
+    @pytest.mark.parametrize(
+        "message, error",
+        [
+            ({"command": "unknown"}, "unknown command"),
+            ({"command": "package"}, "job"),
+            ({"command": "package", "job": {"output": "x.tar"}}, "no directory"),
+            ({"command": "verify", "path": "missing"}, "manifest"),
+            (
+                {"command": "package", "job": {"directory": 5}},
+                "invalid directory",
+            ),
+            (
+                {"command": "package", "job": {"directory": "x", "include": 5}},
+                "invalid include",
+            ),
+            (
+                {"command": "package", "job": {"directory": "x", "exclude": [5]}},
+                "invalid exclude",
+            ),
+            (
+                {
+                    "command": "package",
+                    "job": {"directory": "x", "compression-level": "x"},
+                },
+                "invalid compression-level",
+            ),
+            (
+                {"command": "package", "job": {"directory": "x", "seekable": "yes"}},
+                "invalid seekable",
+            ),
+        ],
+    )
+    def test_errors(self, tmpdir, message, error):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+        (response,) = _serve(server, dict(message, cwd=str(tmpdir)))
+        assert not response["ok"]
+        assert error in response["error"]
+
+    def test_unexpected_error(self, tmpdir, monkeypatch):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+
+        def _status():
+            raise TypeError("unexpected")
+
+        monkeypatch.setattr(server, "status", _status)
+        (response, unknown) = _serve(server, {"command": "status"}, {"command": "x"})
+        assert not response["ok"]
+        assert response["error"] == "TypeError: unexpected"
+        # the server keeps serving
+        assert "unknown command" in unknown["error"]
+
+    def test_invalid_cwd(self, tmpdir):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+        (response,) = _serve(server, {"command": "verify", "path": "x", "cwd": 5})
+        assert not response["ok"]
+        assert "cwd" in response["error"]
+
+    def test_failed_job(self, tree, tmpdir):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+        _job = {"directory": str(tree), "output": str(Path(tmpdir, "missing", "a.tar"))}
+        _invalid = {"directory": str(tree), "hash-type": "unknown"}
+        response, invalid = _serve(
+            server,
+            {"command": "package", "job": _job},
+            {"command": "package", "job": _invalid},
+        )
+        assert not response["ok"]
+        assert "does not exist" in response["error"]
+        assert response["directory"] == str(tree)
+        # the hash type is checked before the job runs
+        assert not invalid["ok"]
+        assert "invalid hash-type" in invalid["error"]
+
+    def test_stop_closes_idle_connections(self, tmpdir):
+        server = PackageServer(Path(tmpdir, "pkgwrap.sock"))
+
+        async def _scenario():
+            ready = asyncio.Event()
+            serving = asyncio.ensure_future(server.serve(ready=ready.set))
+            await ready.wait()
+            # a client connected without sending a request
+            reader, writer = await asyncio.open_unix_connection(str(server.socket_path))
+            await asyncio.get_running_loop().run_in_executor(
+                None, request, {"command": "stop"}, server.socket_path
+            )
+            await asyncio.wait_for(serving, 5)
+            _data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return _data
+
+        assert asyncio.run(_scenario()) == b""
+
+
+class TestClient:
+    def test_no_server(self, tmpdir):
+        assert not is_running(Path(tmpdir, "pkgwrap.sock"))
+        with pytest.raises(ServeE):
+            request({"command": "status"}, Path(tmpdir, "pkgwrap.sock"))
+
+    def test_message(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir)
+        arguments = [
+            "package",
+            "tree",
+            "-o",
+            "out.zip",
+            "--option",
+            "seekable=true",
+            "--option",
+            "exclude=*.log",
+        ]
+        sent = []
+
+        def _request(message, socket_path):
+            sent.append(message)
+            return {"ok": True}
+
+        monkeypatch.setattr(client, "request", _request)
+        with pytest.raises(SystemExit) as exit_info:
+            client.main(arguments)
+        assert exit_info.value.code == 0
+        assert sent == [
+            {
+                "command": "package",
+                "cwd": str(tmpdir),
+                "job": {
+                    "seekable": True,
+                    "exclude": "*.log",
+                    "directory": "tree",
+                    "output": "out.zip",
+                },
+            }
+        ]
@@ -0,0 +1,138 @@
+import io
+import json
+import os
+from pathlib import Path
+
+import pytest
+from package_wrapper.package import package
+from package_wrapper.stats.stats import JsonSink, ProgressSink, Stats, StatsSink
+
+
+@pytest.fixture()
+def package_dir(tmpdir):
+    base_dir = Path(tmpdir).joinpath(Path("base"))
+    for index in range(12):
+        file = base_dir.joinpath(f"dir{index % 3}", f"file{index}")
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(os.urandom(1024 * (index + 1)))
+    yield base_dir
+
+
+class _Recorder(StatsSink):
+    def __init__(self):
+        self.events = []
+
+    def stage_started(self, stage):
+        self.events.append(("started", stage.name))
+
+    def advance(self, stage, files, size):
+        self.events.append(("advance", stage.name, files, size))
+
+    def stage_finished(self, stage):
+        self.events.append(("finished", stage.name))
+
+    def close(self, stats):
+        self.events.append(("close",))
+
+
+class TestStats:
+    def test_stages(self):
+        recorder = _Recorder()
+        stats = Stats(sinks=[recorder], slowest=2)
+        with stats.stage("scan"):
+            stats.count(3, 300)
+        with stats.stage("hash", files=3, size=300):
+            stats.file_done("a", 100, 0.1)
+            stats.file_done("b", 100, 0.3)
+            stats.file_done("c", 100, None)
+        stats.close()
+        # files reported outside of a stage are ignored
+        stats.file_done("d", 100, 1.0)
+
+        assert recorder.events == [
+            ("started", "scan"),
+            ("advance", "scan", 3, 300),
+            ("finished", "scan"),
+            ("started", "hash"),
+            ("advance", "hash", 1, 100),
+            ("advance", "hash", 1, 100),
+            ("advance", "hash", 1, 100),
+            ("finished", "hash"),
+            ("close",),
+        ]
+        scan, hashing = stats.as_dict()["stages"]
+        assert scan["files"] == 3 and scan["bytes"] == 300
+        assert scan["slowest files"] == []
+        assert hashing["finished"]
+        assert hashing["cached files"] == 1
+        assert hashing["slowest files"] == [
+            {"path": "b", "seconds": 0.3, "bytes": 100},
+            {"path": "a", "seconds": 0.1, "bytes": 100},
+        ]
+
+    def test_running_stage(self):
+        stats = Stats()
+        with stats.stage("archive"):
+            stats.file_done("a", 100, 0.1)
+            running = stats.as_dict()["stages"][0]
+        assert not running["finished"]
+        assert running["files"] == 1
+
+    def test_sinks(self, tmpdir):
+        output = Path(tmpdir).joinpath("stats.json")
+        progress = io.StringIO()
+        stats = Stats(sinks=[ProgressSink(file=progress), JsonSink(output)])
+        with stats.stage("hash", files=1, size=100):
+            stats.file_done("a", 100, 0.1)
+        stats.close()
+        assert json.loads(output.read_text()) == json.loads(json.dumps(stats.as_dict()))
+        assert "hash: " in progress.getvalue()
+
+
+class TestPackageStats:
+    @pytest.mark.parametrize(
+        "single_pass, stages",
+        [
+            (True, ["scan", "hash and archive"]),
+            (False, ["scan", "hash", "archive"]),
+        ],
+    )
+    def test_stages(self, package_dir, tmpdir, single_pass, stages):
+        output = Path(tmpdir).joinpath("out.tar.gz")
+        stats = Stats()
+        package(
+            package_dir,
+            None,
+            output,
+            "sha256",
+            None,
+            single_pass=single_pass,
+            stats=stats,
+        )
+        result = stats.as_dict()
+        assert [_stage["stage"] for _stage in result["stages"]] == stages
+        _last = result["stages"][-1]
+        assert _last["files"] == 12
+        assert _last["bytes"] == sum(1024 * (index + 1) for index in range(12))
+        assert _last["slowest files"][0]["seconds"] >= _last["slowest files"][-1][
+            "seconds"
+        ]
+        manifest = json.loads(package_dir.joinpath("manifest.json").read_text())
+        assert "stats" not in manifest["package-wrapper"]
+
+    def test_record_stats(self, package_dir, tmpdir):
+        output = Path(tmpdir).joinpath("out.zip")
+        package(
+            package_dir,
+            None,
+            output,
+            "sha256",
+            None,
+            single_pass=False,
+            stats=Stats(),
+            record_stats=True,
+        )
+        manifest = json.loads(package_dir.joinpath("manifest.json").read_text())
+        recorded = manifest["package-wrapper"]["stats"]["stages"]
+        assert [_stage["stage"] for _stage in recorded] == ["scan", "hash", "archive"]
+        assert recorded[1]["finished"] and not recorded[2]["finished"]
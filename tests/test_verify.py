@@ -0,0 +1,152 @@
+import json
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+from package_wrapper.archiver import archiver
+from package_wrapper.archiver.archiver import Archive
+from package_wrapper.package import create_package, package
+from package_wrapper.verify.verify import (
+    VerifyE,
+    load_manifest,
+    verify_archive,
+    verify_directory,
+    verify_package,
+)
+
+
+@pytest.fixture()
+def packaged_dir(tmpdir):
+    file_list = [
+        "first/test11",
+        "first/test12",
+        "second/test21",
+        "first/first_lvl2/test111",
+    ]
+    base_dir = Path(tmpdir).joinpath(Path("base"))
+    for _file in file_list:
+        file = base_dir.joinpath(Path(_file))
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(os.urandom(2048))
+    output = Path(tmpdir).joinpath(Path("out.tar.gz"))
+    package(base_dir, None, output, "sha256", "tar.gz")
+    yield base_dir, output
+
+
+class TestVerify:
+    @pytest.mark.parametrize("jobs", [1, 4])
+    def test_directory_matches(self, packaged_dir, jobs):
+        base_dir, _ = packaged_dir
+        result = verify_directory(base_dir, jobs=jobs)
+        assert result.ok
+        assert result.matched == sorted(load_manifest(base_dir)["files"])
+
+    def test_archive_matches(self, packaged_dir):
+        _, output = packaged_dir
+        assert verify_package(output).ok
+
+    def test_reports_missing_extra_and_mismatched(self, packaged_dir):
+        base_dir, _ = packaged_dir
+        base_dir.joinpath("first/test11").unlink()
+        base_dir.joinpath("first/test12").write_bytes(b"changed")
+        base_dir.joinpath("new_file").write_bytes(b"new")
+        result = verify_directory(base_dir, jobs=2)
+        assert not result.ok
+        assert result.missing == ["first/test11"]
+        assert result.mismatched == ["first/test12"]
+        assert result.extra == ["new_file"]
+
+    def test_load_manifest_from_archive(self, packaged_dir):
+        base_dir, output = packaged_dir
+        assert load_manifest(output) == json.loads(
+            base_dir.joinpath("manifest.json").read_text()
+        )
+
+    def test_no_manifest_raises(self, tmpdir):
+        with pytest.raises(VerifyE):
+            verify_directory(Path(tmpdir))
+
+    @pytest.mark.parametrize("single_pass", [True, False])
+    def test_every_digest_is_checked(self, tmpdir, single_pass):
+        base_dir = Path(tmpdir).joinpath("multi")
+        base_dir.mkdir()
+        base_dir.joinpath("file").write_bytes(os.urandom(2048))
+        output = Path(tmpdir).joinpath("multi.tar.gz")
+        package(
+            base_dir, None, output, "sha256,blake2b,md5", None, single_pass=single_pass
+        )
+        manifest = load_manifest(base_dir)
+        assert [_digest.split(":")[0] for _digest in manifest["files"]["file"]] == [
+            "sha256",
+            "blake2b",
+            "md5",
+        ]
+        assert verify_directory(base_dir).ok
+        assert verify_package(output).ok
+
+        manifest["files"]["file"][2] = "md5:" + "0" * 32
+        base_dir.joinpath("manifest.json").write_text(json.dumps(manifest))
+        assert verify_directory(base_dir).mismatched == ["file"]
+
+
+class TestVerifyArchive:
+    @pytest.mark.parametrize("archive_type", ["tar.gz", "tar.bz2", "tar.xz"])
+    def test_parallel_compressed(self, packaged_dir, tmpdir, monkeypatch, archive_type):
+        base_dir, _ = packaged_dir
+        # every member ends up in blocks compressed independently
+        monkeypatch.setitem(archiver.PARALLEL_BLOCK_SIZE, archive_type, 1024)
+        output = Path(tmpdir).joinpath(Path(f"parallel.{archive_type}"))
+        create_package(
+            base_dir, None, output, "sha256", archive_type, compression_threads=2
+        )
+        result = verify_archive(output)
+        assert result.ok
+        assert len(result.matched) == 4
+
+    @pytest.mark.parametrize("archive_type", ["tar", "tar.gz", "tar.xz", "zip"])
+    def test_streams_members(self, packaged_dir, tmpdir, monkeypatch, archive_type):
+        base_dir, _ = packaged_dir
+        output = Path(tmpdir).joinpath(Path(f"stream.{archive_type}"))
+        package(base_dir, None, output, "sha256", archive_type)
+
+        def _no_extract(*args):
+            raise AssertionError("archive was extracted")
+
+        monkeypatch.setattr(Archive, "extract", _no_extract)
+        result = verify_archive(output)
+        assert result.ok
+        assert len(result.matched) == 4
+
+    def test_manifest_last_with_other_method(self, packaged_dir, tmpdir):
+        base_dir, _ = packaged_dir
+        output = Path(tmpdir).joinpath(Path("md5.tar"))
+        package(base_dir, None, output, "md5", "tar")
+        # members preceding the manifest are hashed with sha256 and read again
+        result = verify_archive(output, hash_method="sha256")
+        assert result.ok
+        assert len(result.matched) == 4
+
+    def test_detects_tampered_member(self, packaged_dir, tmpdir):
+        base_dir, output = packaged_dir
+        base_dir.joinpath("second/test21").write_bytes(b"tampered")
+        tampered = Path(tmpdir).joinpath(Path("tampered.tar"))
+        with tarfile.open(tampered, "w") as tar_ref:
+            for _name in ["first/test11", "second/test21", "manifest.json"]:
+                tar_ref.add(base_dir.joinpath(_name), arcname=_name)
+        result = verify_archive(tampered)
+        assert result.matched == ["first/test11"]
+        assert result.mismatched == ["second/test21"]
+        assert result.missing == ["first/first_lvl2/test111", "first/test12"]
+
+    @pytest.mark.parametrize("hash_type", ["sha256", "md5"])
+    def test_hard_linked_duplicates(self, packaged_dir, tmpdir, hash_type):
+        base_dir, _ = packaged_dir
+        base_dir.joinpath("second/copy").write_bytes(
+            base_dir.joinpath("first/test12").read_bytes()
+        )
+        output = Path(tmpdir).joinpath(Path("dedup.tar"))
+        package(base_dir, None, output, hash_type, "tar", single_pass=False, dedup=True)
+        result = verify_archive(output)
+        assert result.ok
+        assert "second/copy" in result.matched
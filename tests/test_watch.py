@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from package_wrapper.manifest.filehash import file_hash_create
+from package_wrapper.manifest import hashcache
+from package_wrapper.manifest.hashcache import HashCache
+from package_wrapper.package import create_package
+from package_wrapper.watch import watch
+from package_wrapper.watch.watch import DirectoryWatcher, WatchE
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is only available on Linux"
+)
+
+
+@pytest.fixture(autouse=True)
+def racy_window(monkeypatch):
+    # shorter than the default of two seconds the watcher waits for on stopping
+    monkeypatch.setattr(hashcache, "RACY_WINDOW_NS", 200 * 1000 * 1000)
+    monkeypatch.setattr(watch, "RACY_WINDOW_NS", 200 * 1000 * 1000)
+
+
+@pytest.fixture()
+def cache(tmpdir):
+    hash_cache = HashCache(cache_dir=Path(tmpdir).joinpath("cache"))
+    yield hash_cache
+    hash_cache.close()
+
+
+@pytest.fixture()
+def build_dir(tmpdir):
+    base_dir = Path(tmpdir).joinpath("build")
+    base_dir.mkdir()
+    yield base_dir
+
+
+class _Watching:
+    """
+    Runs a watcher in a thread for the duration of a with block
+    """
+
+    def __init__(self, watcher: DirectoryWatcher):
+        self.watcher = watcher
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=watcher.watch, kwargs={"ready": self._ready.set}
+        )
+
+    def wait_hashed(self, count: int):
+        _deadline = time.monotonic() + 10
+        while self.watcher.hashed < count and time.monotonic() < _deadline:
+            time.sleep(0.05)
+        assert self.watcher.hashed >= count
+
+    def __enter__(self):
+        self._thread.start()
+        assert self._ready.wait(10)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.watcher.stop()
+        self._thread.join()
+
+
+def _cached(cache: HashCache, path: Path):
+    return cache.lookup(cache.stat_key(path), "sha256")
+
+
+class TestDirectoryWatcher:
+    def test_not_a_directory(self, build_dir, cache):
+        with pytest.raises(WatchE):
+            DirectoryWatcher(build_dir.joinpath("missing"), cache)
+
+    def test_unknown_hash_method(self, build_dir, cache):
+        with pytest.raises(WatchE):
+            DirectoryWatcher(build_dir, cache, hash_method="foo")
+
+    def test_existing_files(self, build_dir, cache):
+        _file = build_dir.joinpath("sub", "existing")
+        _file.parent.mkdir()
+        _file.write_bytes(os.urandom(1024))
+        os.utime(_file, ns=(0, 0))
+        with _Watching(DirectoryWatcher(build_dir, cache)) as watching:
+            watching.wait_hashed(1)
+        assert _cached(cache, _file) == file_hash_create(_file, "sha256")
+
+    def test_written_files(self, build_dir, cache):
+        files = [
+            build_dir.joinpath("first"),
+            build_dir.joinpath("sub", "second"),
+            build_dir.joinpath("sub", "deeper", "third"),
+        ]
+        with _Watching(DirectoryWatcher(build_dir, cache, jobs=2)) as watching:
+            for _file in files:
+                _file.parent.mkdir(parents=True, exist_ok=True)
+                _file.write_bytes(os.urandom(4096))
+            watching.wait_hashed(len(files))
+        # journaled once the racy window of the cache passed
+        assert watching.watcher.journaled == len(files)
+        for _file in files:
+            assert _cached(cache, _file) == file_hash_create(_file, "sha256")
+
+    def test_moved_files(self, build_dir, cache, tmpdir):
+        _outside = Path(tmpdir).joinpath("outside")
+        _outside.write_bytes(os.urandom(1024))
+        with _Watching(DirectoryWatcher(build_dir, cache)) as watching:
+            _outside.rename(build_dir.joinpath("moved"))
+            watching.wait_hashed(1)
+        _file = build_dir.joinpath("moved")
+        assert _cached(cache, _file) == file_hash_create(_file, "sha256")
+
+    def test_manifests_are_skipped(self, build_dir, cache):
+        with _Watching(DirectoryWatcher(build_dir, cache)):
+            build_dir.joinpath("manifest.json").write_text("{}")
+            build_dir.joinpath("file").write_text("contents")
+        assert _cached(cache, build_dir.joinpath("manifest.json")) is None
+        assert _cached(cache, build_dir.joinpath("file")) is not None
+
+    def test_package_uses_journal(self, build_dir, cache, tmpdir):
+        with _Watching(DirectoryWatcher(build_dir, cache)) as watching:
+            for index in range(4):
+                build_dir.joinpath(f"file_{index}").write_bytes(os.urandom(1024))
+            watching.wait_hashed(4)
+        # modified after it was journaled, hashed again when packaging
+        build_dir.joinpath("file_0").write_bytes(b"changed")
+
+        output = Path(tmpdir).joinpath("out.tar")
+        create_package(build_dir, None, output, "sha256", "tar", hash_cache=cache)
+        with tarfile.open(output) as tar_ref:
+            manifest = json.load(tar_ref.extractfile("manifest.json"))
+        for index in range(4):
+            _file = build_dir.joinpath(f"file_{index}")
+            expected = file_hash_create(_file, "sha256")
+            assert manifest["files"][f"file_{index}"] == f"sha256:{expected}"